@@ -0,0 +1 @@
+__author__ = 'Denis Mikhalkin'
@@ -0,0 +1,213 @@
+import os
+import sys
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+from time import time
+from engine import Engine, Resource, EventCondition, ResourceCondition
+from engine.async import ResultObj
+from engine.fakeaws import FakeSQSConnection, FakeEC2Connection
+from engine.handlers import SQSHandler, EC2InstanceHandler
+
+__author__ = 'Denis Mikhalkin'
+
+# Benchmarks of the engine core. They run offline against generated repositories and the fake AWS
+# connections, and return plain dicts so that benchmarks.run can emit them as JSON.
+
+@contextmanager
+def quietStdout():
+    # Engine.start() dumps every resource to stdout, which would drown the results
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if len(values) > 0 else None
+
+def latencies(samples):
+    return {"p50Micros": percentile(samples, 0.5) * 1e6, "p99Micros": percentile(samples, 0.99) * 1e6,
+            "maxMicros": max(samples) * 1e6}
+
+# size resource descriptors in environment/server/application levels, plus a handler per resource type
+def generateRepository(path, size):
+    fanOut = max(1, int(round(size ** (1 / 3.0))))
+    written = 0
+    for envIndex in range(fanOut):
+        envPath = os.path.join(path, "env%d" % envIndex)
+        written += writeDescriptor(envPath + ".env", {"tier": "env%d" % envIndex})
+        for serverIndex in range(fanOut):
+            serverPath = os.path.join(envPath, "server%d" % serverIndex)
+            written += writeDescriptor(serverPath + ".ec2instance", {"region": "local", "image-id": "ami-%d" % envIndex,
+                                                                    "instance-type": "t2.micro", "key-name": "key",
+                                                                    "security-groups": ["default"]})
+            for appIndex in range(fanOut):
+                if written >= size: break
+                written += writeDescriptor(os.path.join(serverPath, "app%d.app" % appIndex), {"port": 8080 + appIndex})
+    for resourceType in ["env", "ec2instance", "app"]:
+        handlerPath = os.path.join(path, "on.activated.%s.sh" % resourceType)
+        with open(handlerPath, "w") as opened:
+            opened.write("#!/bin/sh\nexit 0\n")
+        os.chmod(handlerPath, 0o755)
+    return written
+
+def writeDescriptor(fullPath, desc):
+    directory = os.path.dirname(fullPath)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(fullPath, "w") as opened:
+        opened.write("desc:\n")
+        for (key, value) in sorted(desc.items()):
+            opened.write("  %s: %s\n" % (key, value))
+    return 1
+
+def benchmarkScan(size):
+    path = tempfile.mkdtemp()
+    try:
+        repositoryPath = os.path.join(path, "repository")
+        files = generateRepository(repositoryPath, size)
+        config = {"repositoryPath": repositoryPath, "parseCache": os.path.join(path, "parse.cache")}
+        results = {"files": files}
+        for run in ["cold", "warm"]:
+            started = time()
+            engine = Engine(config)
+            seconds = time() - started
+            results[run] = {"seconds": seconds, "filesPerSecond": files / seconds, "stats": engine.repository.stats}
+            engine.stop()
+        return results
+    finally:
+        shutil.rmtree(path)
+
+def benchmarkPublish(size, backgroundHandlers=100):
+    results = dict()
+    for mode in ["sync", "async"]:
+        engine = Engine({"eventBus": {"async": mode == "async", "workers": 4}})
+        try:
+            for i in range(backgroundHandlers):
+                engine.handlerManager.registerOn(lambda eventName, resource, payload: True,
+                                                 EventCondition("event%d" % (i % 10), "type%d" % (i % 20)))
+            queues = [Resource("queue%d" % i, "sqs", engine.resourceManager.root) for i in range(10)]
+            for queue in queues:
+                engine.resourceManager.registerResource(queue)
+            received = [0]
+            engine.handlerManager.registerOn(lambda eventName, resource, payload: received.__setitem__(0, received[0] + 1) or True,
+                                             EventCondition("received", "sqs"))
+            count = size * 10
+            samples = list()
+            pending = list()
+            started = time()
+            for i in xrange(count):
+                publishStarted = time()
+                pending.append(engine.eventBus.publish("received", queues[i % len(queues)], i))
+                samples.append(time() - publishStarted)
+            ResultObj.all_of(pending).wait(60)
+            seconds = time() - started
+            results[mode] = dict(latencies(samples), events=count, delivered=received[0], seconds=seconds,
+                                 eventsPerSecond=count / seconds)
+        finally:
+            engine.stop()
+    return results
+
+def benchmarkGetHandlers(size, lookups=10000):
+    results = dict()
+    counts = sorted(set([10, 100, 1000, max(10, size)]))
+    for count in counts:
+        engine = Engine({})
+        try:
+            handler = lambda eventName, resource, payload: True
+            # Handlers for other events and types, a tenth of them with a predicate (an ancestor condition)
+            for i in range(count):
+                condition = EventCondition("event%d" % (i % 20), "type%d" % (i % 50), "name%d" % i)
+                if i % 10 == 0:
+                    condition.ancestor = "env"
+                engine.handlerManager.handlers.add(condition, handler)
+            engine.handlerManager.handlers.add(EventCondition("received", "sqs"), handler)
+            engine.handlerManager.handlers.add(EventCondition("received", "sqs", ancestor="env"), handler)
+            resource = Resource("queue", "sqs", Resource("env", "env", None))
+            started = time()
+            for i in xrange(lookups):
+                found = engine.handlerManager.getHandlers("received", resource)
+            seconds = time() - started
+            results[str(count)] = {"microsPerLookup": seconds / lookups * 1e6, "matched": len(found)}
+        finally:
+            engine.stop()
+    return results
+
+def benchmarkActivation(size, instances=100):
+    results = dict()
+    engine = Engine({})
+    try:
+        engine.handlerManager.registerOn(lambda eventName, resource, payload: True, EventCondition("activate", "node"))
+        fanOut = max(1, int(round(size ** (1 / 3.0))))
+        resources = list()
+        parents = [engine.resourceManager.root]
+        for level in range(3):
+            children = [Resource("%s-%d" % (parent.name, i), "node", parent) for parent in parents for i in range(fanOut)]
+            resources.extend(children)
+            parents = children
+        for resource in resources:
+            engine.resourceManager.addResource(resource)
+        started = time()
+        with quietStdout():
+            engine.start()
+        activated = engine.resourceManager.waitForStates(resources, "ACTIVATED", 60)
+        plan = engine.resourceManager.planner.history[-1] if len(engine.resourceManager.planner.history) > 0 else None
+        results["tree"] = {"resources": len(resources), "activated": activated, "seconds": time() - started,
+                           "waves": plan.waves if plan is not None else []}
+    finally:
+        engine.stop()
+
+    conn = FakeEC2Connection(pendingDescribes=2)
+    engine = Engine({"ec2": {"monitorPeriod": 0.05, "launchBatchWindow": 0.05}})
+    try:
+        engine.connections.setFactory("ec2", lambda region, **kwargs: conn)
+        engine.handlerManager.registerHandler(EC2InstanceHandler(engine))
+        servers = [Resource("server%d" % i, "ec2instance", engine.resourceManager.root,
+                            desc={"region": "local", "image-id": "ami-%d" % (i % 3), "instance-type": "t2.micro",
+                                  "key-name": "key", "security-groups": ["default"]}) for i in range(instances)]
+        for server in servers:
+            engine.resourceManager.addResource(server)
+        started = time()
+        with quietStdout():
+            engine.start()
+        activated = engine.resourceManager.waitForStates(servers, "ACTIVATED", 60)
+        results["ec2"] = {"instances": instances, "activated": activated, "seconds": time() - started,
+                          "requests": dict(conn.requestsByAction)}
+    finally:
+        engine.stop()
+    return results
+
+def benchmarkSQS(size, concurrency=4):
+    conn = FakeSQSConnection()
+    queue = conn.create_queue("benchmark")
+    count = size * 10
+    queue.write_batch(["message %d" % i for i in range(count)])
+    engine = Engine({"sqs": {"consumer": True, "concurrency": concurrency, "waitTimeSeconds": 1}})
+    try:
+        engine.connections.setFactory("sqs", lambda region, **kwargs: conn)
+        engine.handlerManager.registerSubscribe(SQSHandler(engine), ResourceCondition("sqs"))
+        engine.resourceManager.addResource(Resource("benchmark", "sqs", engine.resourceManager.root,
+                                                    desc={"region": "local", "queueName": "benchmark"}, raisesEvents=["received"]))
+        lock = threading.Lock()
+        received = [0]
+        done = threading.Event()
+        def onReceived(eventName, resource, payload):
+            with lock:
+                received[0] += 1
+                if received[0] == count:
+                    done.set()
+            return True
+        requestsBefore = conn.requests
+        started = time()
+        engine.handlerManager.registerOn(onReceived, EventCondition("received", "sqs"))
+        done.wait(60)
+        seconds = time() - started
+        return {"messages": count, "received": received[0], "seconds": seconds, "messagesPerSecond": received[0] / seconds,
+                "requests": conn.requests - requestsBefore}
+    finally:
+        engine.stop()
@@ -0,0 +1,103 @@
+import gc
+import os
+import sys
+import json
+import argparse
+from multiprocessing import Process, Queue
+
+__author__ = 'Denis Mikhalkin'
+
+# Per-resource memory of the engine's Resource compared with the layout it had before it was slotted:
+# a __dict__ per instance and desc held as a dict, with the state shared from STATES.
+#
+#   python -m benchmarks.memory [--count 100000] [--output json]
+
+# Fewer resources than this do not move the resident size measurably
+MIN_COUNT = 20000
+
+LEGACY_STATES = {"INVALID": {"name": "INVALID", "order": -2}, "ADDED": {"name": "ADDED", "order": 0}}
+
+# Resource as it was before the memory work - nothing but these attributes is set per instance
+class LegacyResource(object):
+    parentResource = None
+    children = list()
+    engine = None
+
+    def __init__(self, name, resourceType, parent, desc=None, raisesEvents=list(), altName=None, behavior=None):
+        self.name = name
+        self.type = resourceType
+        self.parent = parent
+        self.desc = desc
+        self.behavior = behavior
+        self.raisesEvents = raisesEvents
+        self.altName = altName
+        self.state = LEGACY_STATES["INVALID"]
+        self.dynamicState = {}
+
+def createDesc(i):
+    return {"region": "ap-southeast-2", "image-id": "ami-%08x" % i, "instance-type": "t2.micro",
+            "key-name": "key", "security-groups": ["default"]}
+
+def legacyResource(i):
+    return LegacyResource("instance%d" % i, "ec2instance", "environment%d" % (i // 100), desc=createDesc(i))
+
+def packedResource(i):
+    from engine import Resource
+    return Resource("instance%d" % i, "ec2instance", "environment%d" % (i // 100), desc=createDesc(i))
+
+def materialisedResource(i):
+    resource = packedResource(i)
+    resource.desc
+    return resource
+
+LAYOUTS = [("legacy", legacyResource), ("slots", materialisedResource), ("slots+packedDesc", packedResource)]
+
+def residentBytes():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def measure(factory, count):
+    factory(0)  # Imports and one-off allocations are not part of the footprint
+    gc.collect()
+    before = residentBytes()
+    resources = [factory(i) for i in xrange(count)]
+    gc.collect()
+    after = residentBytes()
+    return {"count": len(resources), "bytesPerResource": (after - before) / float(count)}
+
+# Each layout is measured in a fresh process, so memory freed by one does not hide the growth of the next
+def measureInProcess(factory, count):
+    results = Queue()
+    process = Process(target=lambda: results.put(measure(factory, count)))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+def run(count=100000):
+    results = dict()
+    for (name, factory) in LAYOUTS:
+        results[name] = measureInProcess(factory, count)
+    legacy = results["legacy"]["bytesPerResource"]
+    for result in results.values():
+        result["ratioToLegacy"] = result["bytesPerResource"] / legacy if legacy > 0 else None
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Per-resource memory footprint")
+    parser.add_argument("--count", type=int, default=100000)
+    parser.add_argument("--output", choices=["text", "json"], default="text")
+    args = parser.parse_args(argv)
+    results = run(args.count)
+    if args.output == "json":
+        print json.dumps(results, indent=2, sort_keys=True)
+    else:
+        for (name, factory) in LAYOUTS:
+            print "%-18s %8.0f bytes/resource  (%.2fx legacy)" % (name, results[name]["bytesPerResource"], results[name]["ratioToLegacy"])
+
+if __name__ == '__main__':
+    sys.exit(main())
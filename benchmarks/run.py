@@ -0,0 +1,70 @@
+import sys
+import json
+import logging
+import platform
+import argparse
+from time import time
+from benchmarks import core, memory
+
+__author__ = 'Denis Mikhalkin'
+
+# Runs the offline benchmark suite and reports the results as JSON (or text), e.g.
+#
+#   python -m benchmarks.run --size 1000 --output json --file results.json
+#
+# size scales every benchmark: the number of repository files, resources in the activation tree and
+# resources measured for memory (at least memory.MIN_COUNT); publish and SQS benchmarks send 10 events per unit of size.
+
+BENCHMARKS = [("scan", core.benchmarkScan),
+              ("publish", core.benchmarkPublish),
+              ("getHandlers", core.benchmarkGetHandlers),
+              ("activation", core.benchmarkActivation),
+              ("sqs", core.benchmarkSQS),
+              ("memory", lambda size: memory.run(max(size, memory.MIN_COUNT)))]
+
+def run(size, names=None):
+    results = dict()
+    for (name, benchmark) in BENCHMARKS:
+        if names is not None and name not in names: continue
+        started = time()
+        results[name] = benchmark(size)
+        logging.getLogger("gears.benchmarks").info("%s took %.2fs" % (name, time() - started))
+    return {"meta": {"size": size, "python": platform.python_version(), "platform": platform.platform(),
+                     "startedAt": int(time())},
+            "results": results}
+
+def flatten(value, prefix=""):
+    if isinstance(value, dict):
+        for key in sorted(value.keys()):
+            for item in flatten(value[key], "%s.%s" % (prefix, key) if prefix else str(key)):
+                yield item
+    elif isinstance(value, list):
+        for (index, item) in enumerate(value):
+            for flattened in flatten(item, "%s[%d]" % (prefix, index)):
+                yield flattened
+    else:
+        yield (prefix, value)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmarks of the engine core")
+    parser.add_argument("--size", type=int, default=1000)
+    parser.add_argument("--only", help="comma separated benchmarks to run: %s" % ", ".join(name for (name, _) in BENCHMARKS))
+    parser.add_argument("--output", choices=["text", "json"], default="text")
+    parser.add_argument("--file", help="write the results to this file instead of stdout")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARN)
+
+    results = run(args.size, args.only.split(",") if args.only else None)
+    if args.output == "json":
+        output = json.dumps(results, indent=2, sort_keys=True)
+    else:
+        output = "\n".join("%-60s %s" % (key, ("%.4f" % value) if isinstance(value, float) else value)
+                           for (key, value) in flatten(results))
+    if args.file:
+        with open(args.file, "w") as opened:
+            opened.write(output + "\n")
+    else:
+        print output
+
+if __name__ == '__main__':
+    sys.exit(main())
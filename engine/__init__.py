@@ -1,12 +1,26 @@
 import datetime
-from time import sleep
+import threading
+from time import time
 from engine.async import ResultObj
+from engine.dispatch import DispatchIndex
+from engine.pipeline import EventPipeline
+from engine.aws import ConnectionRegistry
+from engine.watcher import createWatcher, listFiles, DELETED
+from engine.snapshot import Snapshot
+from engine.activation import ActivationPlanner
+from engine.coalescing import CoalescingBuffer, Debouncer
+from engine.metrics import REGISTRY, Counter, Gauge, MetricsServer
+from engine.query import QueryServer
+from engine.tracing import Tracer, activate
 
 __author__ = 'Denis Mikhalkin'
 
 import os
+import re
+import marshal
 import subprocess
 import uuid
+from functools import partial
 from collections import OrderedDict
 
 from boto import sqs
@@ -16,10 +30,18 @@ from apscheduler.jobstores.memory import MemoryJobStore
 from apscheduler.triggers.interval import IntervalTrigger
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.executors.pool import ThreadPoolExecutor
+from apscheduler.events import EVENT_JOB_EXECUTED, EVENT_JOB_ERROR, EVENT_JOB_MISSED, EVENT_JOB_MAX_INSTANCES
 import logging
 
 DEFAULT_SUBSCRIBE_PERIOD = 15 # 1 minute in seconds
 
+EVENTS_DISPATCHED = REGISTRY.counter("gears_events_dispatched_total", "Events dispatched to listeners and handlers", ["event"])
+EVENT_SECONDS = REGISTRY.histogram("gears_event_dispatch_seconds", "Time from dispatching an event until every listener completed", ["event"])
+HANDLER_CALLS = REGISTRY.counter("gears_handler_calls_total", "Handler invocations by outcome (success, failure, error)",
+                                 ["event", "handler", "outcome"])
+HANDLER_SECONDS = REGISTRY.histogram("gears_handler_seconds", "Time from invoking a handler until its result completed", ["event", "handler"])
+SCHEDULER_LAG = REGISTRY.histogram("gears_scheduler_lag_seconds", "Delay of scheduled job runs waiting for a free executor thread", ["executor"])
+
 def get_class( kls ):
     parts = kls.split('.')
     module = ".".join(parts[:-1])
@@ -46,37 +68,105 @@ class Engine(object):
     """:type HandlerManager"""
     scheduler = None
     """:type Scheduler"""
+    connections = None
+    """:type ConnectionRegistry"""
 
     def __init__(self, config):
         self.LOG.info("Starting engine")
         self.config = config
+        self._stopCallbacks = list()
+        self._services = dict()
+        self._servicesLock = threading.Lock()
+        self._snapshotLock = threading.Lock()
+        self.snapshot = Snapshot.load(config.get("snapshotPath"))
+        if "repositoryPath" in config:
+            # Parsing may fork worker processes, which has to happen before any of the engine's threads start
+            self.repository = Repository(self, config["repositoryPath"])
+            self.repository.read(parallel=True)
+        self.tracer = Tracer(config["tracing"] if "tracing" in config else {})
+        self.connections = ConnectionRegistry(self)
+        self.onStop(self.connections.close)
         self.eventBus = EventBus(self)
         self.scheduler = Scheduler(self)
         self.resourceManager = ResourceManager(self)
         self.handlerManager = HandlerManager(self)
+        REGISTRY.addCollector(self.collectMetrics)
+        self.onStop(partial(REGISTRY.removeCollector, self.collectMetrics))
+        # Handlers are told where to send resource lookups before the server is up
+        self.querySocket = QueryServer.socketPath(self)
         if "repositoryPath" in config:
-            self.repository = Repository(self, config["repositoryPath"])
             self.repository.scan()
 
         self.LOG.info("Created")
 
     def start(self):
-        self.resourceManager.start()
+        if self.querySocket is not None:
+            self.getService("queryServer", lambda: QueryServer(self, self.querySocket).start())
+        metricsConfig = self.config["metrics"] if "metrics" in self.config else {}
+        if "port" in metricsConfig:
+            self.getService("metricsServer", lambda: MetricsServer(REGISTRY, metricsConfig["port"], metricsConfig.get("host", "")).start())
+        self.tracer.start(self.scheduler)
+        # Bringing up the resources is one trace, whatever the handlers go on to do asynchronously
+        with self.tracer.span("engine start"):
+            self.resourceManager.start()
+        if "repositoryPath" in self.config and self.config.get("watchRepository", False):
+            mode = self.config["watchRepository"] if self.config["watchRepository"] is not True else "auto"
+            self.repository.watch(mode, self.config.get("watchPeriod", 2))
+        if self.config.get("snapshotPath") is not None:
+            # Saved as it goes too, so a crash loses at most one period of activations
+            self.scheduler.schedule("snapshot", self.saveSnapshot, self.config.get("snapshotPeriod", 60), executor="io", traced=False)
         self.LOG.info("Started")
         self.resourceManager.dump()
 
+    # Registers a callback to release a long-running resource (threads, connections) when the engine stops
+    def onStop(self, callback):
+        self._stopCallbacks.append(callback)
+
+    # Engine-wide singleton created by factory() on first request. Services with stop() are stopped with the engine
+    def getService(self, name, factory):
+        with self._servicesLock:
+            if name not in self._services:
+                service = factory()
+                self._services[name] = service
+                if hasattr(service, "stop"):
+                    self.onStop(service.stop)
+            return self._services[name]
+
+    # Metrics read from the engine's state whenever engine.metrics.REGISTRY is rendered
+    def collectMetrics(self):
+        return self.resourceManager.collectMetrics() + self.scheduler.collectMetrics() + self.eventBus.collectMetrics()
+
+    def saveSnapshot(self):
+        if self.config.get("snapshotPath") is None: return
+        try:
+            with self._snapshotLock:
+                Snapshot.capture(self).save(self.config["snapshotPath"])
+        except:
+            self.LOG.exception("-> error saving snapshot")
+
     def stop(self):
+        self.saveSnapshot()
+        for callback in reversed(self._stopCallbacks):
+            try:
+                callback()
+            except:
+                self.LOG.exception("-> error stopping")
         self.scheduler.stop()
+        self.eventBus.stop()
+        self.tracer.stop()
 
 class HandlerManager(object):
     LOG = logging.getLogger("gears.HandlerManager")
-    handlers = dict()
 
     def __init__(self, engine):
         self._engine = engine
+        self.handlers = DispatchIndex()
+        self._lock = threading.RLock()
+        self._behaviors = dict()        # class path -> the one handler created for it
+        self._registered = dict()       # id(handler) -> (handler, event names it is registered for)
         self._eventBus = engine.eventBus
         self._resourceManager = engine.resourceManager
-        self._eventBus.subscribe(lambda eventName, resource, payload: True, self.handleEvent)
+        self._eventBus.subscribe(lambda eventName, resource, payload: True, self.handleEvent, allEvents=True)
         self.LOG.info("Created")
 
     def registerSubscribe(self, handler, condition):
@@ -96,12 +186,17 @@ class HandlerManager(object):
         self._addHandler(condition.eventName, {"handler": handler, "condition": condition})
         self._eventBus.publish("subscribe", condition, payload={"eventName": condition.eventName})
 
+    # A handler is registered for each of its events once, however many times it is passed in. Class paths
+    # (resource behaviors) all resolve to one handler per class, so they add to the table once per distinct class
     def registerHandler(self, handler):
         if handler is None: return
         if type(handler) == str:
-            handler = self.createHandler(handler)
-        eventNames = handler.getEventNames()
-        for eventName in eventNames:
+            handler = self.getBehavior(handler)
+        with self._lock:
+            (registered, eventNames) = self._registered.setdefault(id(handler), (handler, set()))
+            newEventNames = [eventName for eventName in handler.getEventNames() if eventName not in eventNames]
+            eventNames.update(newEventNames)
+        for eventName in newEventNames:
             condition = handler.getEventCondition(eventName)
             if eventName == "subscribe":
                 self.registerSubscribe(handler, condition)
@@ -113,15 +208,16 @@ class HandlerManager(object):
                 self.registerOn(handler, condition)
 
     def _addHandler(self, event, bundle):
-        if event not in self.handlers:
-            self.handlers[event] = [bundle]
-        else:
-            self.handlers[event].append(bundle)
+        return self.handlers.add(bundle["condition"], bundle["handler"])
+
+    def unregisterHandler(self, handler):
+        self.LOG.info("unregisterHandler: " + str(handler))
+        with self._lock:
+            self._registered.pop(id(handler), None)
+        return self.handlers.removeValue(handler) > 0
 
     def getHandlers(self, eventName, resource):
-        if eventName not in self.handlers:
-            return list()
-        return [bundle["handler"] for bundle in self.handlers[eventName] if bundle["condition"].matchesEvent(eventName, resource)]
+        return self.handlers.lookup(eventName, resource)
 
     def handleEvent(self, eventName, resource, payload):
         self.LOG.info("handleEvent(eventName=%s, resource=%s, payload=%s)" % (eventName, resource, payload))
@@ -129,29 +225,78 @@ class HandlerManager(object):
         if len(handlers) == 0:
             self.LOG.info("-> No handlers for this event")
             return True
-        result = True
+        results = list()
         for handler in handlers:
+            started = time()
+            name = self.handlerName(handler)
+            span = self._engine.tracer.startSpan("handler", {"handler": name})
             try:
-                if type(handler) == type(str.lower) or str(type(handler)) == "<type 'function'>": # Function
-                    handlerResult = handler(eventName, resource, payload)
-                else:
-                    handlerResult = handler.handleEvent(eventName, resource, payload)
-                result = result and (True if handlerResult is None else handlerResult)
+                with activate(span):
+                    if type(handler) == type(str.lower) or str(type(handler)) == "<type 'function'>": # Function
+                        handlerResult = handler(eventName, resource, payload)
+                    else:
+                        handlerResult = handler.handleEvent(eventName, resource, payload)
+                handlerResult = True if handlerResult is None else handlerResult
+                self._measure(eventName, name, started, handlerResult, span)
+                results.append(handlerResult)
             except:
                 self.LOG.exception("-> error invoking handler")
-                result = False
-        return result
+                HANDLER_CALLS.labels(eventName, name, "error").inc()
+                HANDLER_SECONDS.labels(eventName, name).observe(time() - started)
+                if span is not None:
+                    span.finish(False, error=True)
+                results.append(False)
+        # Handlers may return a ResultObj to complete later; the event then completes when they all do
+        return ResultObj.combine(results)
 
     def createHandler(self, handlerClass):
         return get_class(handlerClass)(self._engine)
 
+    # The class is imported and instantiated when a resource first declares it as its behavior
+    def getBehavior(self, handlerClass):
+        with self._lock:
+            handler = self._behaviors.get(handlerClass)
+            if handler is None:
+                self.LOG.info("Loading behavior %s" % handlerClass)
+                handler = self.createHandler(handlerClass)
+                self._behaviors[handlerClass] = handler
+            return handler
+
+    @staticmethod
+    def handlerName(handler):
+        if hasattr(handler, "fullPath"):
+            return handler.fullPath
+        if hasattr(handler, "__name__"):
+            return "%s.%s" % (getattr(handler, "__module__", None), handler.__name__)
+        return "%s.%s" % (type(handler).__module__, type(handler).__name__)
+
+    # Handlers that return a ResultObj are measured (and their span finished) when it completes
+    @staticmethod
+    def _measure(eventName, name, started, result, span=None):
+        def completed(success):
+            HANDLER_CALLS.labels(eventName, name, "success" if success else "failure").inc()
+            HANDLER_SECONDS.labels(eventName, name).observe(time() - started)
+            if span is not None:
+                span.finish(success)
+        if isinstance(result, ResultObj):
+            result.onComplete(completed)
+        else:
+            completed(result)
+
 class ResourceManager(object):
     LOG = logging.getLogger("gears.ResourceManager")
-    _resources = dict()
     # add, update, remove - raise events
     def __init__(self, engine):
         self._engine = engine
+        self._resources = dict()
+        self._restored = set()
+        # Secondary indexes of name -> resource, kept in registration order
+        self._byType = dict()           # type -> resources of the type
+        self._byParent = dict()         # parent name -> children
+        self._byAncestorType = dict()   # type -> resources that have an ancestor of the type
         self._eventBus = engine.eventBus
+        config = engine.config["activation"] if "activation" in engine.config else {}
+        self.planner = ActivationPlanner(engine, config.get("concurrency", ActivationPlanner.CONCURRENCY))
         self.root = Resource("root", "root", None)
         self.LOG.info("Created")
 
@@ -159,14 +304,16 @@ class ResourceManager(object):
         def onRegistered():
             def onActivated():
                 if resource.isState("REGISTERED"):
-                    resource.toState("ACTIVATED")()
-            resource.toState("REGISTERED")()
+                    resource.setState("ACTIVATED")
+            resource.setState("REGISTERED")
             if resource.isState("REGISTERED") and resource.parentResource is not None and resource.parentResource.isActive():
                 self._engine.eventBus.publish("activate", resource) \
                     .success(onActivated) \
                     .failure(resource.toState("FAILED"))
 
         self.LOG.info("addResource(%s)" % resource)
+        if self._restoreResource(resource):
+            return
         if self.registerResource(resource):
             self.raiseEvent("register", resource) \
                 .success(onRegistered) \
@@ -193,18 +340,147 @@ class ResourceManager(object):
                         parentResource.addChild(resource)
                         resource.parentResource = parentResource
                     else:
-                        resource.toState("FAILED")()
+                        resource.setState("FAILED")
                 else:
                     resource.parentResource.addChild(resource)
             else:
                 if resource.parentResource is not None:
                     resource.parentResource.addChild(resource)
+            self._index(resource)
+            self._adoptOrphans(resource)
             return True
         return False
 
-    # condition is resource condition (the "matches" contract)
+    def _adoptOrphans(self, resource):
+        for name in set([resource.name, resource.altName]):
+            for orphan in [child for child in self._byParent.get(name, {}).values() if child.parentResource is None]:
+                subtree = [orphan] + self._descendants(orphan)
+                for member in subtree:
+                    self._unindex(member)
+                orphan.parentResource = resource
+                resource.addChild(orphan)
+                for member in subtree:
+                    self._index(member)
+
+    def _descendants(self, resource):
+        descendants = list()
+        pending = list(resource.children)
+        while len(pending) > 0:
+            child = pending.pop()
+            descendants.append(child)
+            pending.extend(child.children)
+        return descendants
+
+    def _index(self, resource):
+        def add(index, key):
+            if key not in index:
+                index[key] = OrderedDict()
+            index[key][resource.name] = resource
+        add(self._byType, resource.type)
+        if resource.parent is not None:
+            add(self._byParent, self._parentKey(resource))
+        for ancestorType in self._ancestorTypes(resource):
+            add(self._byAncestorType, ancestorType)
+
+    def _unindex(self, resource):
+        def discard(index, key):
+            entries = index.get(key)
+            if entries is not None and entries.get(resource.name) is resource:
+                del entries[resource.name]
+                if len(entries) == 0:
+                    del index[key]
+        discard(self._byType, resource.type)
+        discard(self._byParent, self._parentKey(resource))
+        for ancestorType in self._ancestorTypes(resource):
+            discard(self._byAncestorType, ancestorType)
+
+    # parent may name the parent by its altName, so children are indexed under the name it was resolved to
+    @staticmethod
+    def _parentKey(resource):
+        return resource.parentResource.name if resource.parentResource is not None else resource.parent
+
+    @staticmethod
+    def _ancestorTypes(resource):
+        types = set()
+        ancestor = resource.parentResource
+        while ancestor is not None:
+            types.add(ancestor.type)
+            ancestor = ancestor.parentResource
+        return types
+
+    # Unchanged resources that were ACTIVATED in the engine snapshot get their state back without running
+    # register/activate again - as long as their parent was restored too, or is the root
+    def _restoreResource(self, resource):
+        snapshot = self._engine.snapshot
+        if snapshot is None or resource.name not in snapshot.resources: return False
+        if resource.parent is not None:
+            parent = resource.parentResource if resource.parentResource is not None else self.getResource(resource.parent)
+            if parent is None or not (parent is self.root or parent.name in self._restored):
+                return False
+            resource.parentResource = parent
+        restored = snapshot.restorableState(resource)
+        if restored is None: return False
+        if not self.registerResource(resource): return False
+        resource.restoreState(*restored)
+        self._restored.add(resource.name)
+        self.LOG.info("Restored %s from snapshot" % resource)
+        return True
+
+    def getResources(self):
+        return OrderedDict((id(resource), resource) for resource in self._resources.values()).values()
+
+    def removeResource(self, resource):
+        self.LOG.info("removeResource(%s)" % resource)
+        for name in [resource.name, resource.altName]:
+            if name is not None and self._resources.get(name) is resource:
+                del self._resources[name]
+        # Descendants stay, but lose the ancestor types they were indexed under. The children are kept as
+        # orphans under the parent name, so a resource registered under that name again adopts them
+        descendants = self._descendants(resource)
+        for descendant in descendants:
+            self._unindex(descendant)
+        self._unindex(resource)
+        if resource.parentResource is not None and resource in resource.parentResource.children:
+            resource.parentResource.children.remove(resource)
+        for child in resource.children:
+            child.parentResource = None
+        resource.children = list()
+        for descendant in descendants:
+            self._index(descendant)
+
+    # condition is resource condition (the "matches" contract). Resource conditions are answered from the indexes,
+    # anything else is checked against every resource
     def getMatchingResources(self, condition):
-        return [resource for resource in self._resources.values() if condition.matches(resource)]
+        if not isinstance(condition, ResourceCondition):
+            return [resource for resource in self.getResources() if condition.matches(resource)]
+        if condition.resourceType is None:
+            return list(self.getResources())
+        candidates = self._byType.get(condition.resourceType, {})
+        if condition.resourceName is not None:
+            candidates = [candidates[condition.resourceName]] if condition.resourceName in candidates else []
+        elif condition.ancestor is not None:
+            descendants = self._byAncestorType.get(condition.ancestor, {})
+            if len(descendants) < len(candidates):
+                candidates = [resource for resource in descendants.values() if resource.type == condition.resourceType]
+            else:
+                candidates = [resource for resource in candidates.values() if resource.name in descendants]
+        else:
+            candidates = candidates.values()
+        if condition.parent is not None or (condition.resourceName is not None and condition.ancestor is not None):
+            return [resource for resource in candidates if condition.matches(resource)]
+        return list(candidates)
+
+    def collectMetrics(self):
+        resources = Gauge("gears_resources", "Resources by state", ["state"])
+        counts = dict()
+        for resource in self.getResources():
+            counts[resource.state] = counts.get(resource.state, 0) + 1
+        for state in sorted(Resource.STATES.values(), key=lambda state: state.order):
+            resources.labels(state.name).set(counts.get(state, 0))
+        return [resources]
+
+    def getChildren(self, resource):
+        return list(self._byParent.get(resource.name, {}).values())
 
     def raiseEvent(self, eventName, resource):
         return self._eventBus.publish(eventName, resource)
@@ -217,27 +493,15 @@ class ResourceManager(object):
     def start(self):
         self.installHandlers()
         self.registerResource(self.root)
-        self.root.toState("REGISTERED")()
-        self.root.toState("ACTIVATED")()
+        self.root.setState("REGISTERED")
+        self.root.setState("ACTIVATED")
 
     def installHandlers(self):
+        # Children of resources activated by a plan are taken care of by that plan
         def activateHandler(eventName, resource, payload):
-            def onActivated(subResource):
-                def transition():
-                    if subResource.isState("REGISTERED"):
-                        subResource.toState("ACTIVATED")()
-                return transition
-            self.LOG.info("Activate handler on " + str(resource))
-            for child in resource.children:
-                if child.isState("REGISTERED"):
-                    try:
-                        self._engine.eventBus.publish("activate", child) \
-                            .success(onActivated(child)) \
-                            .failure(child.toState("FAILED"))
-                    except:
-                        self.LOG.exception("Exception activating " + child)
-                        # Continue with other children
-
+            if not self.planner.isActivating(resource):
+                self.LOG.info("Activating under " + str(resource))
+                self.planner.activate(resource)
             return True
 
         self._engine.handlerManager.registerOn(activateHandler, EventCondition("activated"))
@@ -245,43 +509,159 @@ class ResourceManager(object):
     def getResource(self, path):
         return self._resources[path] if path in self._resources else None
 
+    # Waits until every resource reaches the state, or the timeout (in seconds, for the whole call) expires
+    def waitForStates(self, resources, targetState, timeout=None):
+        deadline = time() + timeout if timeout is not None else None
+        for resource in resources:
+            remaining = max(0, deadline - time()) if deadline is not None else None
+            if not resource.waitForState(targetState, remaining):
+                return False
+        return True
+
 
 class Scheduler(object):
+    """
+    Runs periodic jobs on named executor pools (config "scheduler": {"executors": {name: threads}}), so that slow
+    AWS calls do not hold up queue polls or scripts. Each run is delayed by a random jitter of up to
+    "jitter" * period so that jobs with the same period do not fire together. stats() reports runs, misses and lag per job.
+    """
     LOG = logging.getLogger("gears.Scheduler")
+    EXECUTORS = {"default": 2, "io": 4, "aws": 4, "scripts": 4}
+    DEFAULT_JITTER = 0.1
+
     def __init__(self, engine):
         self.engine = engine
+        config = engine.config["scheduler"] if "scheduler" in engine.config else {}
+        self._jitter = config.get("jitter", self.DEFAULT_JITTER)
         jobstores = {
             'default': MemoryJobStore()
         }
-        executors = {
-            'default': ThreadPoolExecutor(1),
-        }
+        executors = dict((name, ThreadPoolExecutor(threads)) for (name, threads) in self.EXECUTORS.items())
+        for (name, threads) in config.get("executors", {}).items():
+            executors[name] = ThreadPoolExecutor(threads)
         job_defaults = {
             'coalesce': False,
             'max_instances': 1
         }
+        self._executorNames = set(executors.keys())
+        self._lock = threading.Lock()
+        self._stats = dict()    # job id -> stats of the job
         self.scheduler = BackgroundScheduler(jobstores=jobstores, executors=executors, job_defaults=job_defaults, timezone=utc)
+        self.scheduler.add_listener(self._onJobEvent, EVENT_JOB_EXECUTED | EVENT_JOB_ERROR | EVENT_JOB_MISSED | EVENT_JOB_MAX_INSTANCES)
         self.scheduler.start()
 
-    def schedule(self, name, callback, periodInSeconds):
-        self.LOG.info("schedule(%s,%s)" % (name, str(periodInSeconds)))
-        return self.scheduler.add_job(callback, IntervalTrigger(seconds=periodInSeconds))
+    # jitter is in seconds and defaults to the configured fraction of the period. Every run of a traced job starts a trace
+    def schedule(self, name, callback, periodInSeconds, executor="default", jitter=None, traced=True):
+        self.LOG.info("schedule(%s,%s,%s)" % (name, str(periodInSeconds), executor))
+        if executor not in self._executorNames:
+            self.LOG.warn("Unknown executor %s for %s - using default" % (executor, name))
+            executor = "default"
+        if jitter is None:
+            jitter = periodInSeconds * self._jitter
+        stats = {"name": name, "executor": executor, "period": periodInSeconds, "jitter": jitter, "runs": 0, "errors": 0, "missed": 0,
+                 "skipped": 0, "lastLag": None, "maxLag": 0, "lastDuration": None, "started": None}
+        tracer = self.engine.tracer
+        def run():
+            stats["started"] = datetime.datetime.now(utc)
+            span = tracer.startTrace("job", {"job": name, "executor": executor}) if traced else None
+            try:
+                with activate(span):
+                    callback()
+            finally:
+                stats["lastDuration"] = (datetime.datetime.now(utc) - stats["started"]).total_seconds()
+                if span is not None:
+                    span.finish()
+        job = self.scheduler.add_job(run, self._trigger(periodInSeconds, jitter), name=name, executor=executor)
+        with self._lock:
+            self._stats[job.id] = stats
+        return job
+
+    def reschedule(self, job, periodInSeconds):
+        self.LOG.info("reschedule(%s,%s)" % (job.id, str(periodInSeconds)))
+        with self._lock:
+            stats = self._stats.get(job.id)
+            if stats is None: return
+            # The jitter keeps its proportion to the period
+            jitter = stats["jitter"] * periodInSeconds / float(stats["period"]) if stats["period"] > 0 else 0
+            stats.update(period=periodInSeconds, jitter=jitter)
+        job.reschedule(self._trigger(periodInSeconds, jitter))
 
     def unschedule(self, job):
         self.scheduler.remove_job(job.id)
+        with self._lock:
+            self._stats.pop(job.id, None)
+
+    # job id -> {name, runs, errors, missed, skipped, lastLag, maxLag, lastDuration, executor, period, jitter}; times
+    # are in seconds. Keyed by id because jobs may share a name (e.g. monitors of several regions)
+    def stats(self):
+        with self._lock:
+            return dict((jobId, dict((key, value) for (key, value) in stats.items() if key != "started"))
+                        for (jobId, stats) in self._stats.items())
+
+    def collectMetrics(self):
+        labels = ["job", "executor"]
+        counters = [("runs", Counter("gears_scheduler_runs_total", "Runs of scheduled jobs", labels)),
+                    ("errors", Counter("gears_scheduler_errors_total", "Runs of scheduled jobs that raised an error", labels)),
+                    ("missed", Counter("gears_scheduler_missed_total", "Runs of scheduled jobs missed altogether", labels)),
+                    ("skipped", Counter("gears_scheduler_skipped_total", "Runs skipped while the previous run was still going", labels))]
+        gauges = [("lastLag", Gauge("gears_scheduler_last_lag_seconds", "Delay of the last run of scheduled jobs", labels)),
+                  ("lastDuration", Gauge("gears_scheduler_last_duration_seconds", "Duration of the last run of scheduled jobs", labels))]
+        # Jobs that share a name are added up, and their gauges show the largest value
+        largest = dict()
+        for stats in self.stats().values():
+            labels = (stats["name"], stats["executor"])
+            for (key, metric) in counters:
+                metric.labels(*labels).inc(stats[key])
+            for (key, metric) in gauges:
+                if stats[key] is not None:
+                    largest[(key,) + labels] = max(largest.get((key,) + labels, stats[key]), stats[key])
+        for (key, metric) in gauges:
+            for ((gaugeKey, name, executor), value) in largest.items():
+                if gaugeKey == key:
+                    metric.labels(name, executor).set(value)
+        return [metric for (key, metric) in counters + gauges]
 
     def stop(self):
         self.scheduler.shutdown()
 
+    @staticmethod
+    def _trigger(periodInSeconds, jitter):
+        return IntervalTrigger(seconds=periodInSeconds, jitter=jitter if jitter > 0 else None)
+
+    def _onJobEvent(self, event):
+        with self._lock:
+            stats = self._stats.get(event.job_id)
+            if stats is None: return
+            if event.code == EVENT_JOB_MISSED:
+                stats["missed"] += 1
+                self.LOG.warn("Missed run of %s scheduled at %s" % (stats["name"], event.scheduled_run_time))
+            elif event.code == EVENT_JOB_MAX_INSTANCES:
+                stats["skipped"] += 1
+            else:
+                stats["runs"] += 1
+                if event.code == EVENT_JOB_ERROR:
+                    stats["errors"] += 1
+                if stats["started"] is not None:
+                    # Time spent waiting for a free thread in the executor
+                    stats["lastLag"] = max(0, (stats["started"] - event.scheduled_run_time).total_seconds())
+                    stats["maxLag"] = max(stats["maxLag"], stats["lastLag"])
+                    SCHEDULER_LAG.labels(stats["executor"]).observe(stats["lastLag"])
 
 class Condition(object):
+    __slots__ = ()
+
     def matches(self, obj):
         return False
 
 class ResourceCondition(Condition):
-    def __init__(self, resourceType=None, resourceName=None):
+    # parent and ancestor are resource types; None means the condition does not check them
+    __slots__ = ("resourceType", "resourceName", "parent", "ancestor")
+
+    def __init__(self, resourceType=None, resourceName=None, parent=None, ancestor=None):
         self.resourceType = resourceType
         self.resourceName = resourceName
+        self.parent = parent
+        self.ancestor = ancestor
 
     def matches(self, resource):
         if self.resourceType is not None:
@@ -291,19 +671,27 @@ class ResourceCondition(Condition):
             if self.resourceName is not None:
                 res = self.resourceName == resource.name
             if not res: return False
-            if hasattr(self, "parent"):
-                res = self.parent == (resource.parent.type if resource.parent is not None else None)
+            if self.parent is not None:
+                res = self.parent == (resource.parentResource.type if resource.parentResource is not None else None)
             if not res: return False
-            if hasattr(self, "ancestor"):
+            if self.ancestor is not None:
                 res = resource.getAncestorByType(self.ancestor) is not None
             if not res: return False
             # Fallthrough
         return True
 
+    # (resourceType, resourceName, exact) - exact is False when matches() checks more than type and name
+    def resourceKey(self):
+        if self.resourceType is None:
+            return (None, None, True)
+        return (self.resourceType, self.resourceName, self.parent is None and self.ancestor is None)
+
     def __str__(self):
         return "ResourceCondition(type=%s, name=%s)" % (self.resourceType, self.resourceName)
 
 class DelegatedEventCondition(Condition):
+    __slots__ = ("_resourceCondition", "_eventName")
+
     def __init__(self, eventName=None, resourceCondition=None):
         self._resourceCondition = resourceCondition
         self._eventName = eventName
@@ -316,12 +704,19 @@ class DelegatedEventCondition(Condition):
     def matches(self, resource):
         return self._resourceCondition.matches(resource) if self._resourceCondition is not None else False
 
+    def indexKey(self):
+        if self._resourceCondition is None or not hasattr(self._resourceCondition, "resourceKey"):
+            return None
+        return (self._eventName,) + self._resourceCondition.resourceKey()
+
     def __str__(self):
         return "DelegatedEventCondition(event=%s, type=%s, name=%s)" % (self._eventName, self._resourceCondition.resourceType, self._resourceCondition.resourceName)
 
 class EventCondition(ResourceCondition):
-    def __init__(self, eventName=None, resourceType=None, resourceName=None):
-        ResourceCondition.__init__(self, resourceType, resourceName)
+    __slots__ = ("eventName",)
+
+    def __init__(self, eventName=None, resourceType=None, resourceName=None, parent=None, ancestor=None):
+        ResourceCondition.__init__(self, resourceType, resourceName, parent, ancestor)
         self.eventName = eventName
 
     def matchesEvent(self, eventName, resource):
@@ -329,56 +724,164 @@ class EventCondition(ResourceCondition):
         if not res: return False
         return self.matches(resource)
 
+    def indexKey(self):
+        return (self.eventName,) + self.resourceKey()
+
     def __str__(self):
         return "EventCondition(event=%s, type=%s, name=%s)" % (self.eventName, self.resourceType, self.resourceName)
 
+class State(object):
+    """A resource lifecycle state. There is one instance per state, so states compare by identity"""
+    __slots__ = ("name", "order")
+
+    def __init__(self, name, order):
+        self.name = name
+        self.order = order
+
+    # States used to be {"name", "order"} dicts
+    def __getitem__(self, key):
+        if key not in State.__slots__: raise KeyError(key)
+        return getattr(self, key)
+
+    def __repr__(self):
+        return self.name
+
+class Packed(object):
+    """A value kept marshalled until it is needed, which is far smaller than the dicts and lists it holds"""
+    __slots__ = ("data",)
+
+    def __init__(self, data):
+        self.data = data
+
+    # Values marshal cannot represent are returned as they are. Dicts are rebuilt in key order first, so equal
+    # values pack to the same bytes whatever order they were built in
+    @staticmethod
+    def pack(value):
+        if type(value) not in (dict, list):
+            return value
+        try:
+            return Packed(marshal.dumps(Packed._canonical(value)))
+        except ValueError:
+            return value
+
+    @staticmethod
+    def _canonical(value):
+        if type(value) is dict:
+            canonical = dict()
+            for key in sorted(value):
+                canonical[key] = Packed._canonical(value[key])
+            return canonical
+        if type(value) is list:
+            return [Packed._canonical(item) for item in value]
+        return value
+
+    @staticmethod
+    def unpack(value):
+        return marshal.loads(value.data) if type(value) is Packed else value
+
+_stateConditionLock = threading.Lock()
+
+def intern_str(value):
+    return intern(value) if type(value) is str else value
+
 class Resource(object):
-    STATES = {"INVALID": {"name":"INVALID", "order":-2},
-              "FAILED":{"name":"FAILED", "order": -1},
-              "ADDED": {"name":"ADDED", "order": 0},
-              "REGISTERED": {"name":"REGISTERED", "order":1},
-              "PENDING_ACTIVATION":{"name":"PENDING_ACTIVATION", "order":2},
-              "ACTIVATED":{"name":"ACTIVATED", "order":3} }
-
-    type = ""
-    name = "" # Unique name of the resource (essentially - ID)
-    parentResource = None
-    parent = None
-    children = list()
-    engine = None
+    STATES = dict((name, State(name, order)) for (name, order) in
+                  [("INVALID", -2), ("FAILED", -1), ("ADDED", 0), ("REGISTERED", 1), ("PENDING_ACTIVATION", 2), ("ACTIVATED", 3)])
+
+    # Slots rather than a __dict__ - large repositories hold a lot of resources
+    __slots__ = ("name", "type", "parent", "parentResource", "engine", "_desc", "behavior", "raisesEvents", "altName",
+                 "children", "state", "_dynamicState", "_stateCondition")
+
     def __init__(self, name, resourceType, parent, desc=None, raisesEvents=list(), altName=None, behavior=None):
-        self.name = name
-        self.type = resourceType
-        if type(parent) == str:
-            self.parent = parent
+        self.name = name # Unique name of the resource (essentially - ID)
+        self.type = intern_str(resourceType)
+        self.parentResource = None
+        self.parent = None
+        if isinstance(parent, str):
+            self.parent = intern_str(parent)
         elif parent is not None:
             self.parentResource = parent
             self.parent = parent.name
+        self.engine = None
         self.desc = desc
         self.behavior = behavior
         self.raisesEvents = raisesEvents
         self.altName = altName
+        self.children = list()
         self.state = self.STATES["INVALID"]
-        self.dynamicState = {}
-
+        self._dynamicState = None
+        self._stateCondition = None
+
+    # desc is kept packed until first used
+    @property
+    def desc(self):
+        desc = self._desc
+        if type(desc) is Packed:
+            desc = self._desc = Packed.unpack(desc)
+        return desc
+
+    @desc.setter
+    def desc(self, desc):
+        self._desc = Packed.pack(desc)
+
+    # desc as marshalled bytes, without unpacking it, so descriptors can be compared cheaply
+    @property
+    def packedDesc(self):
+        desc = self._desc if type(self._desc) is Packed else Packed.pack(self._desc)
+        return desc.data if type(desc) is Packed else desc
+
+    @property
+    def dynamicState(self):
+        if self._dynamicState is None:
+            self._dynamicState = {}
+        return self._dynamicState
+
+    @dynamicState.setter
+    def dynamicState(self, dynamicState):
+        self._dynamicState = dynamicState
+
+    # Only resources somebody waits on get a condition variable
+    def _getStateCondition(self):
+        if self._stateCondition is None:
+            with _stateConditionLock:
+                if self._stateCondition is None:
+                    self._stateCondition = threading.Condition()
+        return self._stateCondition
+
+    def _notifyState(self):
+        condition = self._stateCondition
+        if condition is not None:
+            with condition:
+                condition.notify_all()
+
+    # Returns True if the state was reached, False if the timeout (in seconds) expired first
     def waitForState(self, targetState, timeout=None):
-        count = 0
-        while not self.state["name"] == targetState:
-            sleep(1)
-            count += 1
-            if timeout is not None and count > timeout:
-                break
+        deadline = time() + timeout if timeout is not None else None
+        condition = self._getStateCondition()
+        with condition:
+            while not self.state.name == targetState:
+                remaining = deadline - time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                condition.wait(remaining)
+            return True
 
+    # Sets the state without raising events, for resources restored from a snapshot
+    def restoreState(self, stateName, dynamicState):
+        self.dynamicState = dict(dynamicState)
+        self.state = self.STATES[stateName]
+        self._notifyState()
 
-    def toState(self, newState):
-        def empty():
-            pass
+    def setState(self, newState):
         if not newState in self.STATES:
-            return empty
-        def transition():
-            self.state = self.STATES[newState]
-            self.raiseEvent(newState.lower())
-        return transition
+            return
+        self.state = self.STATES[newState]
+        self._notifyState()
+        self.raiseEvent(newState.lower())
+
+    # Returns the transition as a callable, for use as a callback
+    def toState(self, newState):
+        return partial(self.setState, newState)
 
     def raiseEvent(self, eventName):
         self.engine.eventBus.publish(eventName, self)
@@ -387,81 +890,170 @@ class Resource(object):
         self.children.append(child)
 
     def isActive(self):
-        return self.state["order"] >= self.STATES["ACTIVATED"]["order"]
+        return self.state.order >= self.STATES["ACTIVATED"].order
 
     def isState(self, stateName):
-        return self.state == self.STATES[stateName]
+        return self.state is self.STATES[stateName]
 
     def getAncestorByType(self, type):
-        parent = self.parent
+        parent = self.parentResource
         while parent is not None:
             if parent.type == type:
                 return parent
-            parent = parent.parent
+            parent = parent.parentResource
         return None
 
     def __str__(self):
-        return "Resource(type=%s, name=%s, parent=%s, state=%s, dynamicState=%s)" % (self.type, self.name, self.parent, self.state, self.dynamicState)
+        return "Resource(type=%s, name=%s, parent=%s, state=%s, dynamicState=%s)" % (self.type, self.name, self.parent, self.state, self._dynamicState or {})
 
 class EventBus(object):
     LOG = logging.getLogger("gears.EventBus")
-    _listeners = OrderedDict()
     _eventsSuspended = False
-    _recordedEvents = list()
 
     def __init__(self, engine):
         self._engine = engine
+        self._listeners = DispatchIndex()
+        self._allEventListeners = OrderedDict()
+        self._pipeline = None
+        config = engine.config.get("eventBus", {})
+        self._suspendLock = threading.Lock()
+        # Repeated state changes are folded, as are exact repeats of the events in "fold"
+        folded = [stateName.lower() for stateName in Resource.STATES] + config.get("fold", [])
+        self._recordedEvents = CoalescingBuffer(config.get("coalesce", ["update"]), config.get("supersedes", None), folded)
+        # eventName -> seconds to wait for repeats of the event on a resource before delivering the last one
+        self._debouncer = Debouncer(config["debounce"], self._deliver) if config.get("debounce") else None
+        if config.get("async", False):
+            # Events for one resource stay serialized, different resources are dispatched in parallel
+            self._pipeline = EventPipeline(config.get("workers", 4), config.get("maxQueueSize", 10000))
+            self._submitTimeout = config.get("submitTimeout", None)
         self.LOG.info("Created")
-        pass
 
     def publish(self, eventName, resource, payload = None, resultObject = None):
         if self._eventsSuspended:
-            self.LOG.info("publish suspended(event=%s, resource=%s, payload=%s)" % (eventName, resource, payload))
-            delayed = ResultObj()
-            self._recordedEvents.append((eventName, resource, payload, delayed))
-            return delayed
+            with self._suspendLock:
+                if self._eventsSuspended:
+                    self.LOG.info("publish suspended(event=%s, resource=%s, payload=%s)" % (eventName, resource, payload))
+                    recorded = self._recordedEvents.record(eventName, resource, payload)
+                    return resultObject.trigger(recorded) if resultObject is not None else recorded
 
         self.LOG.info("publish(event=%s, resource=%s, payload=%s)" % (eventName, resource, payload))
         if issubclass(type(resource), Condition):
             resource = self._engine.resourceManager.getMatchingResources(resource)
 
         if type(resource) == list:
-            chained = ResultObj(True)
-            for res in resource:
-                chained = chained.append(self.publish(eventName, res, payload))
-            return resultObject.append(chained).trigger() if resultObject is not None else chained.trigger()
+            combined = ResultObj.all_of([self.publish(eventName, res, payload) for res in resource])
+            return resultObject.trigger(combined) if resultObject is not None else combined
+
+        if self._debouncer is not None and self._debouncer.handles(eventName):
+            debounced = self._debouncer.submit(eventName, resource, payload)
+            return resultObject.trigger(debounced) if resultObject is not None else debounced
+
+        return self._deliver(eventName, resource, payload, resultObject)
+
+    # Every delivery is traced as a span that lasts until the event's result completes
+    def _deliver(self, eventName, resource, payload, resultObject):
+        span = self._engine.tracer.startSpan(eventName, {"resource": getattr(resource, "name", None), "type": getattr(resource, "type", None)})
+        if self._pipeline is not None:
+            delayed = resultObject
+            if delayed is None:
+                with activate(span):
+                    delayed = ResultObj()
+            def dispatch():
+                with activate(span):
+                    delayed.trigger(self._dispatch(eventName, resource, payload))
+            self._pipeline.submit(getattr(resource, "name", None), dispatch, timeout=self._submitTimeout)
+            return self._traced(delayed, span)
+
+        with activate(span):
+            result = self._dispatch(eventName, resource, payload)
+            if resultObject is not None:
+                result = resultObject.trigger(result)
+            elif not isinstance(result, ResultObj):
+                result = ResultObj(result)
+        return self._traced(result, span)
+
+    # Results the bus creates inside the span run their callbacks in it; the publisher's and the handlers' own
+    # results keep the context they were created in
+    @staticmethod
+    def _traced(result, span):
+        if span is not None:
+            result.onComplete(span.finish)
+        return result
 
+    # Returns a plain result, or a ResultObj if any of the callbacks completes asynchronously
+    def _dispatch(self, eventName, resource, payload):
+        started = time()
+        EVENTS_DISPATCHED.labels(eventName).inc()
         result = True
-        for obj in self._listeners.values():
-            if obj["condition"](eventName, resource, payload):
-                try:
-                    result = result and obj["callback"](eventName, resource, payload)
-                except:
-                    self.LOG.exception("-> error calling callback")
-                    pass
-        if resultObject is not None:
-            return resultObject.trigger(result)
-        else:
-            return ResultObj(result)
+        pending = list()
+        for callback in self._allEventListeners.values() + self._listeners.lookup(eventName, resource, payload):
+            try:
+                if result:
+                    callbackResult = callback(eventName, resource, payload)
+                    if isinstance(callbackResult, ResultObj):
+                        pending.append(callbackResult)
+                    else:
+                        result = result and callbackResult
+            except:
+                self.LOG.exception("-> error calling callback")
+                pass
+        if len(pending) > 0:
+            combined = ResultObj.combine(pending + [result])
+            combined.onComplete(lambda success: EVENT_SECONDS.labels(eventName).observe(time() - started))
+            return combined
+        EVENT_SECONDS.labels(eventName).observe(time() - started)
+        return result
+
+    def isAsync(self):
+        return self._pipeline is not None
+
+    def stats(self):
+        stats = self._pipeline.stats() if self._pipeline is not None else {}
+        stats["coalesced"] = self._recordedEvents.coalesced
+        stats["debounced"] = self._debouncer.debounced if self._debouncer is not None else 0
+        return stats
 
-    def subscribe(self, condition, callback):
+    def collectMetrics(self):
+        metrics = list()
+        for (key, value) in sorted(self.stats().items()):
+            metric = Gauge("gears_eventbus_%s" % re.sub("([A-Z])", r"_\1", key).lower(), "Event bus %s (see EventBus.stats)" % key)
+            metric.set(value)
+            metrics.append(metric)
+        return metrics
+
+    def stop(self):
+        if self._debouncer is not None:
+            self._debouncer.stop()
+        if self._pipeline is not None:
+            self._pipeline.stop()
+
+    # condition is either an EventCondition (indexed) or a callable(eventName, resource, payload) checked on every publish.
+    # allEvents=True skips the condition entirely and delivers every event
+    def subscribe(self, condition, callback, allEvents=False):
         self.LOG.info("subscribe(condition=%s)" % str(condition))
         if condition is None or callback is None:
             return
-        subscriptionId = uuid.uuid4()
-        self._listeners[subscriptionId] = {"condition": condition, "callback": callback, "id": subscriptionId}
-        return subscriptionId
+        if allEvents:
+            subscriptionId = uuid.uuid4()
+            self._allEventListeners[subscriptionId] = callback
+            return subscriptionId
+        return self._listeners.add(condition, callback)
 
     def unsubscribe(self, subscriptionId):
-        del self._listeners[subscriptionId]
+        if subscriptionId in self._allEventListeners:
+            del self._allEventListeners[subscriptionId]
+        else:
+            self._listeners.remove(subscriptionId)
 
     def suspendEvents(self):
         self._eventsSuspended = True
 
+    # Replays what was recorded while suspended, in publish order, with repeats coalesced
     def resumeEvents(self):
-        self._eventsSuspended = False
-        while len(self._recordedEvents) > 0:
-            (eventName, resource, payload, delayed) = self._recordedEvents.pop()
+        with self._suspendLock:
+            self._eventsSuspended = False
+            recorded = self._recordedEvents.drain()
+        for (eventName, resource, payload, delayed) in recorded:
             self.publish(eventName, resource, payload, delayed)
 
 class Handler(object):
@@ -493,25 +1085,165 @@ class Handler(object):
 
 class Repository(object):
     LOG = logging.getLogger("gears.Repository")
+    REREGISTERED_FIELDS = ["name", "type", "altName", "behavior", "raisesEvents"]
     def __init__(self, engine, repositoryPath):
         self._repositoryPath = repositoryPath
         self._engine = engine
+        self._resources = dict()    # file path -> FileResource
+        self._handlers = dict()     # file path -> FileHandler
+        self._watcher = None
+        self._parser = None
+        self._read = None           # what read() found, until scan() uses it
+        self.stats = dict()
+
+    def getParser(self):
+        from engine.resources import DescriptorParser
+        if self._parser is None:
+            config = self._engine.config
+            self._parser = DescriptorParser(config.get("parseCache"), config.get("parseProcesses"), config.get("parallelParseThreshold", 64))
+            if self._engine.snapshot is not None:
+                self._parser.seed(self._engine.snapshot.descriptors)
+        return self._parser
+
+    # path -> ((mtime, size), descriptor) for every resource file, as last parsed
+    def getDescriptors(self):
+        return self.getParser().entries(self._resources.keys())
+
+    # path -> (mtime, size) of the handler files, by default the ones added so far
+    def getHandlerSignatures(self, handlerPaths=None):
+        signatures = dict()
+        for fullPath in (handlerPaths if handlerPaths is not None else self._handlers):
+            try:
+                stat = os.stat(fullPath)
+                signatures[fullPath] = (stat.st_mtime, stat.st_size)
+            except OSError:
+                pass
+        return signatures
+
+    # Walks the repository and parses the resource descriptors, for scan(). parallel lets the parser fork worker
+    # processes, which is only safe while the process has no other threads - so the engine reads the repository
+    # before it starts any
+    def read(self, parallel=False):
+        from engine.handlers import FileHandler
+        self.LOG.info("Reading %s" % self._repositoryPath)
+        started = time()
+
+        resourcePaths = list()
+        handlerPaths = list()
+        for fullPath in listFiles(self._repositoryPath):
+            if not FileHandler.isHandler(os.path.basename(fullPath)):
+                resourcePaths.append(fullPath)
+            else:
+                handlerPaths.append(fullPath)
+        walked = time()
+
+        descriptors = self.getParser().parseAll(resourcePaths, prune=True, parallel=parallel)
+        self._read = (resourcePaths, handlerPaths, descriptors, walked - started, time() - started)
 
     def scan(self):
         from engine.handlers import FileHandler
-        from engine.resources import FileResource
+        if self._read is None:
+            self.read()
+        (resourcePaths, handlerPaths, descriptors, walkSeconds, readSeconds) = self._read
+        self._read = None
         self.LOG.info("Scanning %s" % self._repositoryPath)
+        started = time()
+        # Resources are added before handlers, so what the snapshot can restore is decided from the files
+        if self._engine.snapshot is not None:
+            self._engine.snapshot.reconcileHandlers(self.getHandlerSignatures(handlerPaths), FileHandler.parseName)
 
         self._engine.eventBus.suspendEvents()
-
         try:
-            for dirName, subdirList, fileList in os.walk(self._repositoryPath):
-                for fileName in fileList:
-                    fullPath = os.path.join(dirName, fileName)
-                    if not FileHandler.isHandler(fileName):
-                        self._engine.resourceManager.addResource(FileResource(fullPath))
-                    else:
-                        self._engine.handlerManager.registerHandler(FileHandler(self._engine, fullPath))
+            for fullPath in resourcePaths:
+                self._addResource(fullPath, descriptors)
+            for fullPath in handlerPaths:
+                self._addHandler(fullPath)
         finally:
             self.LOG.info("Finished scanning - resuming events")
             self._engine.eventBus.resumeEvents()
+
+        self.stats = dict(self.getParser().stats, resources=len(resourcePaths), handlers=len(handlerPaths),
+                          walkSeconds=walkSeconds, scanSeconds=readSeconds + time() - started)
+        self.LOG.info("Scan statistics: %s" % self.stats)
+
+    # Starts monitoring the repository for changes (config: watchRepository = auto|inotify|polling, watchPeriod)
+    def watch(self, mode="auto", period=2):
+        if self._watcher is not None: return
+        self._watcher = createWatcher(self._repositoryPath, self.applyChanges, self._engine.scheduler, mode, period)
+        self._watcher.start()
+        self._engine.onStop(self._watcher.stop)
+
+    # changes is a list of (kind, path) with kind one of watcher.ADDED, CHANGED, DELETED
+    def applyChanges(self, changes):
+        from engine.handlers import FileHandler
+        for (kind, fullPath) in changes:
+            self.LOG.info("Repository change: %s %s" % (kind, fullPath))
+            try:
+                with self._engine.tracer.span("repository change", {"kind": kind, "path": fullPath}):
+                    isHandler = FileHandler.isHandler(os.path.basename(fullPath))
+                    if kind == DELETED:
+                        self._removePath(fullPath)
+                    elif isHandler and fullPath in self._handlers:
+                        # The name, and so the condition, is unchanged - only the content needs re-reading
+                        self._handlers[fullPath].invalidate()
+                    elif isHandler:
+                        self._addHandler(fullPath)
+                    elif fullPath in self._resources:
+                        self._updateResource(fullPath)
+                    else:
+                        self._addResource(fullPath)
+            except:
+                self.LOG.exception("-> error applying change to %s" % fullPath)
+
+    def getFileResource(self, fullPath):
+        return self._resources.get(fullPath)
+
+    def getFileHandler(self, fullPath):
+        return self._handlers.get(fullPath)
+
+    # descriptors maps paths to already parsed descriptors (None for files that are not descriptors)
+    def _addResource(self, fullPath, descriptors=None):
+        from engine.resources import FileResource
+        if descriptors is None:
+            descriptors = self.getParser().parseAll([fullPath])
+        resource = FileResource(fullPath, descriptors[fullPath])
+        self._resources[fullPath] = resource
+        self._engine.resourceManager.addResource(resource)
+
+    def _updateResource(self, fullPath):
+        from engine.resources import FileResource
+        resource = self._resources[fullPath]
+        updated = FileResource(fullPath, self.getParser().parseAll([fullPath])[fullPath])
+        # Only desc can change in place - anything else goes through registration again
+        if any(getattr(updated, field) != getattr(resource, field) for field in self.REREGISTERED_FIELDS):
+            self._removeResource(fullPath)
+            self._resources[fullPath] = updated
+            self._engine.resourceManager.addResource(updated)
+            return
+        resource.desc = updated.desc
+        self._engine.eventBus.publish("update", resource, {"path": fullPath})
+
+    def _removeResource(self, fullPath):
+        resource = self._resources.pop(fullPath, None)
+        if resource is None: return
+        self._engine.eventBus.publish("delete", resource, {"path": fullPath})
+        self._engine.resourceManager.removeResource(resource)
+
+    # fullPath may be a directory that was deleted or moved away, which takes everything under it along.
+    # Children go before their parents
+    def _removePath(self, fullPath):
+        prefix = fullPath + os.sep
+        paths = [path for path in list(self._resources) + list(self._handlers) if path == fullPath or path.startswith(prefix)]
+        for path in sorted(paths, reverse=True):
+            self._removeHandler(path) if path in self._handlers else self._removeResource(path)
+
+    def _addHandler(self, fullPath):
+        from engine.handlers import FileHandler
+        handler = FileHandler(self._engine, fullPath)
+        self._handlers[fullPath] = handler
+        self._engine.handlerManager.registerHandler(handler)
+
+    def _removeHandler(self, fullPath):
+        handler = self._handlers.pop(fullPath, None)
+        if handler is not None:
+            self._engine.handlerManager.unregisterHandler(handler)
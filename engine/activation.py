@@ -0,0 +1,143 @@
+import logging
+import threading
+from collections import deque
+from time import time
+from engine.async import ResultObj
+
+__author__ = 'Denis Mikhalkin'
+
+class ActivationPlan(object):
+    """
+    Activates the REGISTERED descendants of one ACTIVATED resource wave by wave: first its children, then the
+    children of those that got ACTIVATED, and so on. Resources of a wave are activated concurrently, at most
+    `concurrency` at a time, so bringing up a tree takes time proportional to its depth.
+    Progress is driven by the activation results' callbacks and never blocks a thread waiting for a wave.
+    """
+    LOG = logging.getLogger("gears.ActivationPlan")
+
+    def __init__(self, planner, root, concurrency):
+        self.root = root
+        self.waves = list()     # {"size", "activated", "pending", "failed", "seconds"} per wave
+        self.result = ResultObj()
+        self._planner = planner
+        self._concurrency = concurrency
+        self._queue = deque()
+        self._nextWave = list()
+        self._running = 0
+        self._waveStarted = None
+        self._actions = deque()
+        self._draining = False
+        self._lock = threading.Lock()
+
+    def start(self):
+        self._run(lambda: self._startWave(self._planner.claimChildren(self.root)))
+        return self.result
+
+    # Actions run one at a time, on whichever thread is already running them. Results that complete right
+    # away therefore queue their follow-up instead of recursing, however wide or deep the tree.
+    def _run(self, action):
+        with self._lock:
+            self._actions.append(action)
+            if self._draining: return
+            self._draining = True
+        while True:
+            with self._lock:
+                if len(self._actions) == 0:
+                    self._draining = False
+                    return
+                action = self._actions.popleft()
+            try:
+                action()
+            except:
+                self.LOG.exception("-> error activating under %s" % self.root.name)
+
+    def _startWave(self, resources):
+        if len(resources) == 0:
+            if len(self.waves) > 0:
+                self.LOG.info("Activated under %s in %d wave(s)" % (self.root.name, len(self.waves)))
+            self.result.trigger(all(wave["failed"] == 0 for wave in self.waves))
+            return
+        self.waves.append({"size": len(resources), "activated": 0, "pending": 0, "failed": 0, "seconds": None})
+        self._queue.extend(resources)
+        self._nextWave = list()
+        self._waveStarted = time()
+        self._fill()
+
+    def _fill(self):
+        while len(self._queue) > 0 and self._running < self._concurrency:
+            resource = self._queue.popleft()
+            self._running += 1
+            try:
+                result = self._planner.publishActivate(resource)
+            except:
+                self.LOG.exception("-> error activating %s" % resource.name)
+                result = ResultObj(False)
+            result.onComplete(lambda success, resource=resource: self._run(lambda: self._completed(resource, success)))
+        if len(self._queue) == 0 and self._running == 0:
+            wave = self.waves[-1]
+            wave["seconds"] = time() - self._waveStarted
+            self.LOG.info("Wave %d under %s: %d resource(s) in %.3fs (%d activated, %d pending, %d failed)" %
+                          (len(self.waves), self.root.name, wave["size"], wave["seconds"], wave["activated"], wave["pending"], wave["failed"]))
+            self._startWave(self._nextWave)
+
+    def _completed(self, resource, success):
+        wave = self.waves[-1]
+        if success:
+            if resource.isState("REGISTERED"):
+                resource.setState("ACTIVATED")
+        else:
+            resource.setState("FAILED")
+        self._planner.release(resource)
+        if resource.isState("ACTIVATED"):
+            wave["activated"] += 1
+            self._nextWave.extend(self._planner.claimChildren(resource))
+        elif resource.isState("FAILED"):
+            wave["failed"] += 1
+        else:
+            # Still activating (e.g. PENDING_ACTIVATION) - its "activated" event starts a plan for its children
+            wave["pending"] += 1
+        self._running -= 1
+        self._fill()
+
+class ActivationPlanner(object):
+    """
+    Starts an ActivationPlan for every resource that gets ACTIVATED outside of a plan. A resource is claimed
+    by one plan at a time, so overlapping plans never activate it twice.
+    """
+    LOG = logging.getLogger("gears.ActivationPlanner")
+    HISTORY = 20
+    CONCURRENCY = 64
+
+    def __init__(self, engine, concurrency=CONCURRENCY):
+        self._engine = engine
+        self._concurrency = concurrency
+        self._activating = set()
+        self._lock = threading.Lock()
+        self.history = deque(maxlen=self.HISTORY)
+
+    def activate(self, resource):
+        plan = ActivationPlan(self, resource, self._concurrency)
+        result = plan.start()
+        if len(plan.waves) > 0:
+            self.history.append(plan)
+        return result
+
+    def isActivating(self, resource):
+        with self._lock:
+            return resource.name in self._activating
+
+    def claimChildren(self, resource):
+        claimed = list()
+        with self._lock:
+            for child in self._engine.resourceManager.getChildren(resource):
+                if child.isState("REGISTERED") and child.name not in self._activating:
+                    self._activating.add(child.name)
+                    claimed.append(child)
+        return claimed
+
+    def release(self, resource):
+        with self._lock:
+            self._activating.discard(resource.name)
+
+    def publishActivate(self, resource):
+        return self._engine.eventBus.publish("activate", resource)
@@ -1,36 +1,135 @@
+import logging
+import threading
+from concurrent.futures import Future, TimeoutError
+from engine.tracing import current, activate
+
 __author__ = 'Denis Mikhalkin'
 
 class ResultObj(object):
-    def __init__(self, result = None):
-        self._result = result
-        self._failureCallback = None
-        self._successCallback = None
-
-    def success(self, callback):
-        if self._result == True:
-            callback()
-        elif self._result is None:
-            self._successCallback = callback
-        return self
+    """
+    Boolean outcome of an asynchronous operation, backed by a future.
+    Callbacks registered before or after completion run exactly once, either on the completing thread
+    or on the given executor. trigger() may be passed another ResultObj to complete with its outcome.
+    value optionally carries details of the outcome, such as a process exit code.
+    Callbacks run in the trace span the result was created in (context), or else the one they were registered in.
+    """
+    LOG = logging.getLogger("gears.ResultObj")
+
+    def __init__(self, result = None, executor = None):
+        self._future = Future()
+        self._executor = executor
+        self._lock = threading.Lock()
+        self._triggered = False
+        self.value = None
+        self.context = current()
+        if result is not None:
+            self.trigger(result)
 
-    def failure(self, callback):
-        if self._result == False:
-            callback()
-        elif self._result is None:
-            self._failureCallback = callback
+    def success(self, callback, executor = None):
+        return self.onComplete(lambda result: callback() if result else None, executor)
+
+    def failure(self, callback, executor = None):
+        return self.onComplete(lambda result: None if result else callback(), executor)
+
+    def onComplete(self, callback, executor = None):
+        executor = executor if executor is not None else self._executor
+        registered = current()
+        def invoke(future):
+            context = self.context if self.context is not None else registered
+            if executor is not None:
+                executor.submit(self._invoke, callback, future.result(), context)
+            else:
+                self._invoke(callback, future.result(), context)
+        self._future.add_done_callback(invoke)
         return self
 
-    def trigger(self, result=None):
-        self._result = result if result is not None else self._result
-        if self._result:
-            if self._successCallback is not None: self._successCallback()
-        elif self._failureCallback is not None:
-            self._failureCallback()
+    def trigger(self, result=None, value=None):
+        if isinstance(result, ResultObj):
+            source = result
+            source.onComplete(lambda completed: self.trigger(completed, source.value))
+            return self
+        with self._lock:
+            if self._triggered:
+                return self
+            self._triggered = True
+            self.value = value
+        # Nothing to complete with means the operation produced no outcome, which counts as failure.
+        # Callbacks run from set_result, outside the lock, so they are free to trigger other results
+        self._future.set_result(result if result is not None else False)
         return self
 
+    def done(self):
+        return self._future.done()
+
+    def wait(self, timeout=None):
+        try:
+            return self._future.result(timeout)
+        except TimeoutError:
+            return None
+
     def append(self, obj):
-        if self._result is not None:
-            self._result = self._result and obj._result
-        else:
-            self._result = obj._result
-        return self
\ No newline at end of file
+        return ResultObj.all_of([self, obj])
+
+    @staticmethod
+    def all_of(results, executor = None):
+        """Succeeds when every result has completed successfully, fails once all have completed and any failed"""
+        combined = ResultObj(executor=executor)
+        results = list(results)
+        if len(results) == 0:
+            return combined.trigger(True)
+        lock = threading.Lock()
+        state = {"remaining": len(results), "result": True}
+        def completed(result):
+            with lock:
+                state["result"] = state["result"] and bool(result)
+                state["remaining"] -= 1
+                finished = state["remaining"] == 0
+            if finished:
+                combined.trigger(state["result"])
+        for result in results:
+            result.onComplete(completed)
+        return combined
+
+    @staticmethod
+    def any_of(results, executor = None):
+        """Succeeds as soon as one result succeeds, fails once all have failed"""
+        combined = ResultObj(executor=executor)
+        results = list(results)
+        if len(results) == 0:
+            return combined.trigger(False)
+        lock = threading.Lock()
+        state = {"remaining": len(results)}
+        def completed(result):
+            with lock:
+                state["remaining"] -= 1
+                failed = state["remaining"] == 0
+            if result:
+                combined.trigger(True)
+            elif failed:
+                combined.trigger(False)
+        for result in results:
+            result.onComplete(completed)
+        return combined
+
+    @staticmethod
+    def combine(results):
+        """Folds plain boolean results and ResultObj together - stays a plain boolean when nothing is pending"""
+        pending = [result for result in results if isinstance(result, ResultObj)]
+        plain = all(result for result in results if not isinstance(result, ResultObj))
+        if len(pending) == 0:
+            return plain
+        if not plain:
+            pending.append(ResultObj(False))
+        elif len(pending) == 1:
+            return pending[0]
+        return ResultObj.all_of(pending)
+
+    def _invoke(self, callback, result, context=None):
+        try:
+            if context is None:
+                callback(result)
+            else:
+                with activate(context):
+                    callback(result)
+        except:
+            self.LOG.exception("-> error calling result callback")
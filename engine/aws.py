@@ -0,0 +1,308 @@
+import logging
+import threading
+from time import time, sleep
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from boto import sqs
+from boto import ec2
+from engine.async import ResultObj
+from engine.metrics import REGISTRY
+from engine.tracing import startChild
+
+__author__ = 'Denis Mikhalkin'
+
+AWS_CALLS = REGISTRY.counter("gears_aws_calls_total", "AWS API calls by outcome (success, error, throttled)", ["service", "call", "outcome"])
+AWS_SECONDS = REGISTRY.histogram("gears_aws_call_seconds", "Latency of AWS API calls", ["service", "call"])
+
+class ConnectionRegistry(object):
+    """
+    Shared AWS connections keyed by (service, region, profile). Connections are created on first use and then
+    reused by every handler, so polling does not pay for connection setup and credential resolution each time.
+    """
+    LOG = logging.getLogger("gears.ConnectionRegistry")
+    FACTORIES = {"sqs": sqs.connect_to_region, "ec2": ec2.connect_to_region}
+
+    def __init__(self, engine):
+        awsConfig = engine.config["aws_config"] if "aws_config" in engine.config else {}
+        self._profile = awsConfig.get("profile_name")
+        self._factories = dict(self.FACTORIES)
+        self._connections = dict()
+        self._lock = threading.Lock()
+
+    # factory(region, **kwargs) - used to plug in other backends such as engine.fakeaws
+    def setFactory(self, service, factory):
+        with self._lock:
+            self._factories[service] = factory
+            for key in [key for key in self._connections if key[0] == service]:
+                del self._connections[key]
+
+    def get(self, service, region):
+        key = (service, region, self._profile)
+        connection = self._connections.get(key)
+        if connection is None:
+            with self._lock:
+                connection = self._connections.get(key)
+                if connection is None:
+                    connection = self._connect(service, region)
+                    self._connections[key] = connection
+        return connection
+
+    # Drops a cached connection, for example after an authentication error, so the next get() reconnects
+    def invalidate(self, service, region):
+        with self._lock:
+            self._connections.pop((service, region, self._profile), None)
+
+    def close(self):
+        with self._lock:
+            connections = self._connections.values()
+            self._connections = dict()
+        for connection in connections:
+            if hasattr(connection, "close"):
+                try:
+                    connection.close()
+                except:
+                    self.LOG.exception("-> error closing connection")
+
+    def _connect(self, service, region):
+        if service not in self._factories:
+            raise Exception("Unknown AWS service %s" % service)
+        self.LOG.info("Connecting to %s in %s (profile=%s)" % (service, region, self._profile))
+        if self._profile is not None:
+            return InstrumentedConnection(service, self._factories[service](region, profile_name=self._profile))
+        return InstrumentedConnection(service, self._factories[service](region))
+
+class InstrumentedConnection(object):
+    """
+    Counts and times the calls made on an AWS connection. Objects that make calls of their own, such as the SQS
+    queues returned by lookup(), are wrapped as well. Everything else is passed through to the connection.
+    """
+    WRAPPED_RESULTS = ["lookup", "get_queue", "create_queue"]
+    LOCAL_CALLS = ["close", "new_message", "set_message_class"]
+
+    def __init__(self, service, target):
+        self._service = service
+        self._target = target
+
+    def __getattr__(self, name):
+        attribute = getattr(self._target, name)
+        if not callable(attribute) or name.startswith("_") or name in self.LOCAL_CALLS:
+            return attribute
+        def call(*args, **kwargs):
+            started = time()
+            span = startChild("aws", {"call": "%s.%s" % (self._service, name)})
+            outcome = "error"
+            try:
+                result = attribute(*args, **kwargs)
+                outcome = "success"
+            except Exception as e:
+                if getattr(e, "error_code", None) in EC2Monitor.THROTTLING_ERRORS:
+                    outcome = "throttled"
+                raise
+            finally:
+                AWS_CALLS.labels(self._service, name, outcome).inc()
+                AWS_SECONDS.labels(self._service, name).observe(time() - started)
+                if span is not None:
+                    span.finish(outcome == "success", outcome=outcome)
+            if name in self.WRAPPED_RESULTS and result is not None:
+                return InstrumentedConnection(self._service, result)
+            return result
+        return call
+
+class EC2Monitor(object):
+    """
+    Watches pending instances of one region with a single periodic DescribeInstances call for all of them
+    (tag:Name filter with many values). Backs off when throttled and recovers gradually afterwards.
+    """
+    LOG = logging.getLogger("gears.EC2Monitor")
+    MAX_FILTER_VALUES = 200
+    THROTTLING_ERRORS = ["RequestLimitExceeded", "Throttling"]
+
+    def __init__(self, engine, region, period=10, maxPeriod=120):
+        self._engine = engine
+        self._region = region
+        self._basePeriod = period
+        self._maxPeriod = maxPeriod
+        self.period = period
+        self._watched = dict()
+        self._job = None
+        self._lock = threading.RLock()
+        self.polls = 0
+        self.throttled = 0
+
+    # callback(resource, instance) is called once, when the instance named after the resource is running
+    def watch(self, resource, callback):
+        with self._lock:
+            self._watched[resource.name] = (resource, callback)
+            if self._job is None:
+                self._job = self._engine.scheduler.schedule("EC2 monitor %s" % self._region, self.poll, self.period, executor="aws")
+
+    def unwatch(self, resource):
+        with self._lock:
+            self._watched.pop(resource.name, None)
+            self._stopIfIdle()
+
+    def isWatching(self, resource):
+        return resource.name in self._watched
+
+    def poll(self):
+        with self._lock:
+            names = list(self._watched.keys())
+        if len(names) == 0:
+            with self._lock:
+                self._stopIfIdle()
+            return
+        self.polls += 1
+        try:
+            running = self.describeRunning(names)
+        except Exception as e:
+            if getattr(e, "error_code", None) in self.THROTTLING_ERRORS:
+                self.throttled += 1
+                self._setPeriod(min(self.period * 2, self._maxPeriod))
+                self.LOG.warn("Throttled describing %d instances in %s - polling every %ss" % (len(names), self._region, self.period))
+            else:
+                self.LOG.exception("-> error describing instances in %s" % self._region)
+            return
+        if self.period > self._basePeriod:
+            self._setPeriod(max(self.period // 2, self._basePeriod))
+
+        for instance in running:
+            with self._lock:
+                watched = self._watched.pop(instance.tags.get("Name"), None)
+            if watched is None: continue
+            (resource, callback) = watched
+            self.LOG.info("Instance %s of %s is running" % (instance.id, resource))
+            try:
+                callback(resource, instance)
+            except:
+                self.LOG.exception("-> error handling running instance for %s" % resource)
+        with self._lock:
+            self._stopIfIdle()
+
+    def describeRunning(self, names):
+        conn = self._engine.connections.get("ec2", self._region)
+        running = list()
+        for start in range(0, len(names), self.MAX_FILTER_VALUES):
+            chunk = names[start:start + self.MAX_FILTER_VALUES]
+            running.extend(conn.get_only_instances(filters={"tag:Name": chunk, "instance-state-name": "running"}))
+        return running
+
+    def stop(self):
+        with self._lock:
+            self._watched.clear()
+            self._stopIfIdle()
+
+    def _setPeriod(self, period):
+        with self._lock:
+            if period == self.period: return
+            self.period = period
+            if self._job is not None:
+                self._engine.scheduler.reschedule(self._job, period)
+
+    def _stopIfIdle(self):
+        if len(self._watched) == 0 and self._job is not None:
+            try:
+                self._engine.scheduler.unschedule(self._job)
+            except:
+                self.LOG.debug("Monitor job for %s already removed" % self._region)
+            self._job = None
+
+class EC2Launcher(object):
+    """
+    Collects instance launch requests of one region for a short window, then launches every group of requests
+    with identical launch parameters in a single run_instances call. Groups are launched in parallel and each
+    request's ResultObj reports whether an instance was created for its resource.
+    """
+    LOG = logging.getLogger("gears.EC2Launcher")
+    LAUNCH_PARAMETERS = ["image-id", "instance-type", "key-name", "security-groups"]
+    TAG_ATTEMPTS = 3
+    TAG_RETRY_DELAY = 0.5
+
+    def __init__(self, engine, region, batchWindow=0.5, parallelism=4):
+        self._engine = engine
+        self._region = region
+        self._batchWindow = batchWindow
+        self._pending = list()
+        self._timer = None
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(parallelism) if parallelism > 1 else None
+
+    def launch(self, resource):
+        result = ResultObj()
+        with self._lock:
+            self._pending.append((resource, result))
+            flushNow = self._batchWindow <= 0
+            if not flushNow and self._timer is None:
+                self._timer = threading.Timer(self._batchWindow, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if flushNow:
+            self.flush()
+        return result
+
+    def flush(self):
+        with self._lock:
+            pending = self._pending
+            self._pending = list()
+            self._timer = None
+        groups = OrderedDict()
+        for (resource, result) in pending:
+            groups.setdefault(self.launchKey(resource.desc), list()).append((resource, result))
+        for requests in groups.values():
+            if self._executor is not None and len(groups) > 1:
+                self._executor.submit(self._launchGroup, requests)
+            else:
+                self._launchGroup(requests)
+
+    @classmethod
+    def launchKey(cls, desc):
+        return tuple(tuple(desc[name]) if type(desc[name]) is list else desc[name] for name in cls.LAUNCH_PARAMETERS)
+
+    def _launchGroup(self, requests):
+        desc = requests[0][0].desc
+        self.LOG.info("Launching %d instance(s) of %s in %s" % (len(requests), desc["image-id"], self._region))
+        conn = self._engine.connections.get("ec2", self._region)
+        try:
+            reservation = conn.run_instances(image_id=desc["image-id"], min_count=1, max_count=len(requests),
+                                             key_name=desc["key-name"], security_groups=desc["security-groups"],
+                                             instance_type=desc["instance-type"])
+            instances = reservation.instances if reservation.instances is not None else []
+        except:
+            self.LOG.exception("-> error launching instances")
+            instances = []
+
+        # Every instance needs its own Name tag, which CreateTags cannot express in a single call - so each gets
+        # one call with all its tags
+        for ((resource, result), instance) in zip(requests, instances):
+            result.trigger(self._tag(conn, instance, resource))
+        for (resource, result) in requests[len(instances):]:
+            self.LOG.error("No instance launched for %s" % resource)
+            result.trigger(False)
+
+    # An instance that cannot be named would never be found for its resource again, so it is terminated instead
+    def _tag(self, conn, instance, resource):
+        for attempt in range(self.TAG_ATTEMPTS):
+            try:
+                conn.create_tags([instance.id], {"Name": resource.name, "CreatedBy": "DevOpsGears"})
+                return True
+            except:
+                self.LOG.exception("-> error tagging instance %s for %s" % (instance.id, resource))
+                if attempt + 1 < self.TAG_ATTEMPTS:
+                    sleep(self.TAG_RETRY_DELAY * (attempt + 1))
+        self.LOG.error("Terminating untagged instance %s launched for %s" % (instance.id, resource))
+        try:
+            conn.terminate_instances([instance.id])
+        except:
+            self.LOG.exception("-> error terminating instance %s - it is running without a Name tag" % instance.id)
+        return False
+
+    def stop(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            pending = self._pending
+            self._pending = list()
+        for (resource, result) in pending:
+            result.trigger(False)
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
@@ -0,0 +1,163 @@
+import heapq
+import json
+import logging
+import threading
+from collections import OrderedDict
+from itertools import count
+from time import time
+from engine.async import ResultObj
+
+__author__ = 'Denis Mikhalkin'
+
+def resourceKey(resource):
+    name = getattr(resource, "name", None)
+    return name if name is not None else id(resource)
+
+# Equal payloads have equal keys whatever their type; None for payloads that cannot be compared this way
+def payloadKey(payload):
+    try:
+        return json.dumps(payload, sort_keys=True)
+    except (TypeError, ValueError):
+        return None
+
+class CoalescingBuffer(object):
+    """
+    Events recorded while the bus is suspended, kept in the order they were published. Only events that are
+    idempotent by nature are folded: a repeat of an event named in `merged` is folded into the recorded one for
+    the resource and the latest payload wins, and an exact repeat (same resource and payload) of an event named
+    in `folded` is dropped. Anything else, like a "received" message, is always delivered. An event listed in
+    `supersedes` drops recorded events it makes pointless (e.g. "delete" drops pending "update"s). A folded
+    event's publisher gets the result of the event it was folded into.
+    """
+    def __init__(self, merged=("update",), supersedes=None, folded=()):
+        self._merged = set(merged)
+        self._folded = set(folded)
+        self._supersedes = supersedes if supersedes is not None else {"delete": ["update"]}
+        self._entries = OrderedDict()   # key -> [eventName, resource, payload, result]
+        self._sequence = count()
+        self.coalesced = 0
+
+    def key(self, eventName, resource, payload):
+        if eventName in self._merged:
+            return (eventName, resourceKey(resource))
+        if eventName in self._folded:
+            payloadId = payloadKey(payload)
+            if payloadId is not None:
+                return (eventName, resourceKey(resource), payloadId)
+        # Never equal to the key of another event
+        return (eventName, resourceKey(resource), None, next(self._sequence))
+
+    def record(self, eventName, resource, payload):
+        for superseded in self._supersedes.get(eventName, []):
+            entry = self._entries.pop(self.key(superseded, resource, None), None)
+            if entry is not None:
+                self.coalesced += 1
+                entry[3].trigger(True)
+        key = self.key(eventName, resource, payload)
+        entry = self._entries.get(key)
+        if entry is not None:
+            entry[2] = payload
+            self.coalesced += 1
+            return entry[3]
+        result = ResultObj()
+        self._entries[key] = [eventName, resource, payload, result]
+        return result
+
+    # Returns the recorded (eventName, resource, payload, result) in publish order and forgets them
+    def drain(self):
+        entries = [tuple(entry) for entry in self._entries.values()]
+        self._entries.clear()
+        return entries
+
+    def __len__(self):
+        return len(self._entries)
+
+class Debouncer(object):
+    """
+    Holds back events whose name is in `windows` (eventName -> seconds) until the resource has had no repeat of
+    the event for that long, then delivers only the last one. A steady stream is still delivered at least every
+    MAX_WINDOWS windows. Every publisher of a debounced burst gets the same result.
+    """
+    LOG = logging.getLogger("gears.Debouncer")
+    MAX_WINDOWS = 4
+
+    def __init__(self, windows, deliver):
+        self._windows = windows
+        self._deliver = deliver         # callable(eventName, resource, payload, resultObject)
+        self._pending = dict()          # (eventName, resource key) -> [deadline, latest, eventName, resource, payload, result]
+        self._heap = list()             # (deadline, key) - stale entries are skipped
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopped = False
+        self.debounced = 0
+
+    def handles(self, eventName):
+        return eventName in self._windows
+
+    def submit(self, eventName, resource, payload):
+        now = time()
+        window = self._windows[eventName]
+        key = (eventName, resourceKey(resource))
+        with self._condition:
+            entry = self._pending.get(key)
+            if entry is None:
+                entry = [now + window, now + window * self.MAX_WINDOWS, eventName, resource, payload, ResultObj()]
+                self._pending[key] = entry
+            else:
+                entry[0] = min(now + window, entry[1])
+                entry[3] = resource
+                entry[4] = payload
+                self.debounced += 1
+            heapq.heappush(self._heap, (entry[0], key))
+            self._ensureThread()
+            self._condition.notify()
+            return entry[5]
+
+    # Delivers everything still held back
+    def flush(self):
+        with self._condition:
+            entries = self._pending.values()
+            self._pending = dict()
+            self._heap = list()
+        for entry in entries:
+            self._deliverEntry(entry)
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        self.flush()
+
+    def _ensureThread(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="debouncer")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                due = list()
+                while not self._stopped:
+                    now = time()
+                    while len(self._heap) > 0 and self._heap[0][0] <= now:
+                        (deadline, key) = heapq.heappop(self._heap)
+                        entry = self._pending.get(key)
+                        if entry is not None and entry[0] == deadline:
+                            due.append(self._pending.pop(key))
+                    if len(due) > 0:
+                        break
+                    self._condition.wait(self._heap[0][0] - now if len(self._heap) > 0 else None)
+                stopped = self._stopped
+            for entry in due:
+                self._deliverEntry(entry)
+            if stopped:
+                return
+
+    def _deliverEntry(self, entry):
+        (deadline, latest, eventName, resource, payload, result) = entry
+        try:
+            self._deliver(eventName, resource, payload, result)
+        except:
+            self.LOG.exception("-> error delivering %s on %s" % (eventName, resource))
+            result.trigger(False)
@@ -0,0 +1,94 @@
+import itertools
+import threading
+
+__author__ = 'Denis Mikhalkin'
+
+class DispatchIndex(object):
+    """
+    Registry of (condition, value) pairs looked up by event.
+    Conditions exposing indexKey() are bucketed by (eventName, resourceType, resourceName), with None acting
+    as the wildcard bucket. Everything else (plain callables, custom conditions) is checked linearly.
+    """
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._sequence = itertools.count()
+        self._buckets = dict()
+        self._linear = list()
+        self._entries = dict()
+
+    def add(self, condition, value):
+        key = condition.indexKey() if hasattr(condition, "indexKey") else None
+        with self._lock:
+            entryId = next(self._sequence)
+            if key is not None:
+                (eventName, resourceType, resourceName, exact) = key
+                bucketKey = (eventName, resourceType, resourceName)
+                entry = (entryId, condition, value, None if exact else self._predicate(condition))
+                self._buckets.setdefault(bucketKey, list()).append(entry)
+            else:
+                bucketKey = None
+                entry = (entryId, condition, value, self._predicate(condition))
+                self._linear.append(entry)
+            self._entries[entryId] = bucketKey
+        return entryId
+
+    def remove(self, entryId):
+        with self._lock:
+            if entryId not in self._entries:
+                return False
+            bucketKey = self._entries.pop(entryId)
+            if bucketKey is None:
+                self._linear = [entry for entry in self._linear if entry[0] != entryId]
+            else:
+                bucket = [entry for entry in self._buckets[bucketKey] if entry[0] != entryId]
+                if len(bucket) > 0:
+                    self._buckets[bucketKey] = bucket
+                else:
+                    del self._buckets[bucketKey]
+            return True
+
+    def removeValue(self, value):
+        with self._lock:
+            entryIds = [entry[0] for entry in self._allEntries() if entry[2] is value]
+            for entryId in entryIds:
+                self.remove(entryId)
+        return len(entryIds)
+
+    def lookup(self, eventName, resource, payload=None):
+        resourceType = getattr(resource, "type", None)
+        resourceName = getattr(resource, "name", None)
+        keys = [(eventName, None, None)]
+        if resource is not None and resourceType is not None:
+            keys.append((eventName, resourceType, None))
+            if resourceName is not None:
+                keys.append((eventName, resourceType, resourceName))
+
+        # Buckets are only ever appended to or replaced, so reading them without the lock is safe
+        candidates = list()
+        for key in keys:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                candidates.extend(bucket)
+        candidates.extend(self._linear)
+        if len(candidates) > 1:
+            candidates.sort(key=lambda entry: entry[0])
+        return [entry[2] for entry in candidates if entry[3] is None or entry[3](eventName, resource, payload)]
+
+    def values(self):
+        with self._lock:
+            return [entry[2] for entry in sorted(self._allEntries(), key=lambda entry: entry[0])]
+
+    def _allEntries(self):
+        entries = list(self._linear)
+        for bucket in self._buckets.values():
+            entries.extend(bucket)
+        return entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _predicate(condition):
+        if hasattr(condition, "matchesEvent"):
+            return lambda eventName, resource, payload: condition.matchesEvent(eventName, resource)
+        return condition
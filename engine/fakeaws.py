@@ -0,0 +1,250 @@
+import itertools
+import threading
+from collections import deque, OrderedDict
+from time import time
+
+__author__ = 'Denis Mikhalkin'
+
+# In-memory stand-ins for the parts of the boto connections the engine uses. They let handlers be exercised
+# and benchmarked offline, and count API requests so batching can be verified.
+
+class FakeMessage(object):
+    def __init__(self, body=None):
+        self.id = None
+        self.receipt_handle = None
+        self._body = body
+        self.message_attributes = dict()
+
+    def get_body(self):
+        return self._body
+
+    def set_body(self, body):
+        self._body = body
+
+class FakeBatchResults(object):
+    def __init__(self, results, errors):
+        self.results = results
+        self.errors = errors
+
+class FakeQueue(object):
+    def __init__(self, connection, name, visibility_timeout=30):
+        self.connection = connection
+        self.name = name
+        self.visibility_timeout = visibility_timeout
+        self._messages = deque()
+        self._inFlight = OrderedDict()
+        self._ids = itertools.count()
+        self._condition = threading.Condition()
+
+    def new_message(self, body=""):
+        return FakeMessage(body)
+
+    def write(self, message):
+        self.connection.countRequest()
+        self._put([message])
+        return message
+
+    def write_batch(self, messages):
+        self.connection.countRequest()
+        self._put([self.new_message(body) for body in messages])
+
+    def _put(self, messages):
+        with self._condition:
+            for message in messages:
+                message.id = str(next(self._ids))
+                self._messages.append(message)
+            self._condition.notify_all()
+
+    def count(self):
+        with self._condition:
+            return len(self._messages)
+
+    def countInFlight(self):
+        with self._condition:
+            return len(self._inFlight)
+
+    def read(self, visibility_timeout=None, wait_time_seconds=None, message_attributes=None):
+        messages = self.get_messages(1, visibility_timeout, wait_time_seconds=wait_time_seconds)
+        return messages[0] if len(messages) > 0 else None
+
+    def get_messages(self, num_messages=1, visibility_timeout=None, attributes=None, wait_time_seconds=None, message_attributes=None):
+        self.connection.countRequest()
+        deadline = time() + (wait_time_seconds or 0)
+        visibility = visibility_timeout if visibility_timeout is not None else self.visibility_timeout
+        with self._condition:
+            while True:
+                self._expireInFlight()
+                if len(self._messages) > 0:
+                    break
+                remaining = deadline - time()
+                if remaining <= 0:
+                    return []
+                self._condition.wait(remaining)
+            received = list()
+            while len(self._messages) > 0 and len(received) < min(num_messages, 10):
+                message = self._messages.popleft()
+                message.receipt_handle = "%s-%s" % (message.id, time())
+                self._inFlight[message.receipt_handle] = (message, time() + visibility)
+                received.append(message)
+            return received
+
+    def delete_message(self, message):
+        self.connection.countRequest()
+        with self._condition:
+            return self._inFlight.pop(message.receipt_handle, None) is not None
+
+    def delete_message_batch(self, messages):
+        self.connection.countRequest()
+        results = list()
+        errors = list()
+        with self._condition:
+            for message in messages[:10]:
+                if self._inFlight.pop(message.receipt_handle, None) is not None:
+                    results.append({"id": message.id})
+                else:
+                    errors.append({"id": message.id, "code": "ReceiptHandleIsInvalid"})
+        return FakeBatchResults(results, errors)
+
+    def _expireInFlight(self):
+        now = time()
+        for (handle, (message, deadline)) in list(self._inFlight.items()):
+            if deadline <= now:
+                del self._inFlight[handle]
+                self._messages.appendleft(message)
+
+class FakeSQSConnection(object):
+    def __init__(self, region="local"):
+        self.region = region
+        self.requests = 0
+        self._queues = dict()
+        self._lock = threading.Lock()
+
+    def countRequest(self):
+        with self._lock:
+            self.requests += 1
+
+    def create_queue(self, queue_name, visibility_timeout=30):
+        if queue_name not in self._queues:
+            self._queues[queue_name] = FakeQueue(self, queue_name, visibility_timeout)
+        return self._queues[queue_name]
+
+    def lookup(self, queue_name):
+        self.countRequest()
+        return self._queues.get(queue_name)
+
+    def get_queue(self, queue_name):
+        return self.lookup(queue_name)
+
+class FakeThrottlingError(Exception):
+    def __init__(self, error_code="RequestLimitExceeded"):
+        Exception.__init__(self, error_code)
+        self.error_code = error_code
+
+class FakeInstance(object):
+    def __init__(self, connection, instanceId, image_id, instance_type, key_name, security_groups, pendingDescribes):
+        self.connection = connection
+        self.id = instanceId
+        self.image_id = image_id
+        self.instance_type = instance_type
+        self.key_name = key_name
+        self.security_groups = security_groups
+        self.state = "pending"
+        self.tags = dict()
+        self.private_ip_address = None
+        self.ip_address = None
+        self._pendingDescribes = pendingDescribes
+
+    def add_tags(self, tags):
+        self.connection.create_tags([self.id], tags)
+
+    def add_tag(self, key, value=''):
+        self.add_tags({key: value})
+
+    def _tick(self):
+        if self.state == "pending":
+            self._pendingDescribes -= 1
+            if self._pendingDescribes <= 0:
+                number = int(self.id.split("-")[1], 16)
+                self.state = "running"
+                self.private_ip_address = "10.0.%d.%d" % (number // 250, number % 250 + 1)
+                self.ip_address = "54.0.%d.%d" % (number // 250, number % 250 + 1)
+
+class FakeReservation(object):
+    def __init__(self, instances):
+        self.instances = instances
+
+class FakeEC2Connection(object):
+    """
+    Instances start "pending" and turn "running" after being described pendingDescribes times.
+    capacity limits how many instances a single run_instances call can start.
+    """
+    def __init__(self, region="local", pendingDescribes=1, capacity=None):
+        self.region = region
+        self.pendingDescribes = pendingDescribes
+        self.capacity = capacity
+        self.requests = 0
+        self.requestsByAction = dict()
+        self._instances = OrderedDict()
+        self._ids = itertools.count(1)
+        self._throttled = 0
+        self._lock = threading.RLock()
+
+    def countRequest(self, action="other"):
+        with self._lock:
+            self.requests += 1
+            self.requestsByAction[action] = self.requestsByAction.get(action, 0) + 1
+            if self._throttled > 0:
+                self._throttled -= 1
+                raise FakeThrottlingError()
+
+    # The next `count` requests fail with RequestLimitExceeded
+    def throttle(self, count):
+        with self._lock:
+            self._throttled = count
+
+    def run_instances(self, image_id, min_count=1, max_count=1, key_name=None, security_groups=None, instance_type=None, **kwargs):
+        self.countRequest("RunInstances")
+        with self._lock:
+            count = max_count if self.capacity is None else min(max_count, self.capacity)
+            if count < min_count:
+                raise Exception("InsufficientInstanceCapacity")
+            instances = list()
+            for i in range(count):
+                instance = FakeInstance(self, "i-%08x" % next(self._ids), image_id, instance_type, key_name, security_groups, self.pendingDescribes)
+                self._instances[instance.id] = instance
+                instances.append(instance)
+            return FakeReservation(instances)
+
+    def create_tags(self, resource_ids, tags):
+        self.countRequest("CreateTags")
+        with self._lock:
+            for resourceId in resource_ids:
+                self._instances[resourceId].tags.update(tags)
+        return True
+
+    def terminate_instances(self, instance_ids=None):
+        self.countRequest("TerminateInstances")
+        with self._lock:
+            for instanceId in instance_ids or []:
+                self._instances[instanceId].state = "terminated"
+
+    def get_only_instances(self, instance_ids=None, filters=None):
+        self.countRequest("DescribeInstances")
+        with self._lock:
+            for instance in self._instances.values():
+                instance._tick()
+            return [instance for instance in self._instances.values()
+                    if (instance_ids is None or instance.id in instance_ids) and self._matches(instance, filters or {})]
+
+    def _matches(self, instance, filters):
+        for (name, values) in filters.items():
+            values = values if isinstance(values, (list, tuple, set)) else [values]
+            if name == "instance-state-name":
+                actual = instance.state
+            elif name.startswith("tag:"):
+                actual = instance.tags.get(name[4:])
+            else:
+                raise Exception("Unsupported filter %s" % name)
+            if actual not in values:
+                return False
+        return True
@@ -1,12 +1,23 @@
 import os
-import subprocess
-from boto import sqs
+import sys
+import threading
 from engine import EventCondition, DEFAULT_SUBSCRIBE_PERIOD, Handler, ResourceCondition, is_integer
-from boto import ec2
+from engine.aws import EC2Monitor, EC2Launcher
+from engine.process import ProcessPool
+from engine.query import CLIENT
+from engine.remote import RemoteExecutor
+from engine import tracing
 import logging
 
 __author__ = 'Denis Mikhalkin'
 
+# Message attribute that senders put their W3C traceparent in, so handling a message continues their trace
+TRACE_ATTRIBUTE = "traceparent"
+
+def messageTraceParent(tracer, message):
+    attribute = (getattr(message, "message_attributes", None) or {}).get(TRACE_ATTRIBUTE)
+    return tracer.remoteParent(attribute.get("string_value") if attribute is not None else None)
+
 class SQSHandler(Handler):
     LOG = logging.getLogger("gears.handlers.SQSHandler")
     _scheduler = None
@@ -14,28 +25,51 @@ class SQSHandler(Handler):
     _eventBus = None
     """:type EventBus"""
 
+    CONSUMER_DEFAULTS = {"consumer": False, "concurrency": 1, "batchSize": 10, "waitTimeSeconds": 20}
+
     def __init__(self, engine):
+        self._engine = engine
         self._eventBus = engine.eventBus
         self._scheduler = engine.scheduler
-        self._aws_config = engine.config["aws_config"] if "aws_config" in engine.config else None
+        self._sqs_config = engine.config["sqs"] if "sqs" in engine.config else {}
+
+    # Resource desc overrides the engine-wide "sqs" config, which overrides the defaults
+    def getOption(self, resource, name):
+        if resource.desc is not None and name in resource.desc:
+            return resource.desc[name]
+        return self._sqs_config.get(name, self.CONSUMER_DEFAULTS[name])
 
     def handleSubscribe(self, resource, payload):
         self.LOG.info("handleSubscribe(resource=%s, payload=%s)" % (resource, payload))
         if not resource.type == "sqs": return False
+        # Subscriptions to conditions that are not limited to a type reach every resource; a queue only raises "received"
+        if payload["eventName"] not in (resource.raisesEvents or ["received"]): return True
+
+        conn = self._engine.connections.get("sqs", resource.desc["region"])
 
-        # if self._aws_config is not None and "profile_name" in self._aws_config:
-        #     conn = sqs.connect_to_region(resource.desc["region"], profile_name=self._aws_config["profile_name"])
-        # else:
-        conn = sqs.connect_to_region(resource.desc["region"])
+        if self.getOption(resource, "consumer"):
+            consumer = SQSConsumer(self._eventBus, resource, payload["eventName"], conn, tracer=self._engine.tracer,
+                                   concurrency=self.getOption(resource, "concurrency"),
+                                   batchSize=self.getOption(resource, "batchSize"),
+                                   waitTimeSeconds=self.getOption(resource, "waitTimeSeconds"))
+            consumer.start()
+            self._engine.onStop(consumer.stop)
+            return True
 
+        cached = []
         def poll():
-            queue = conn.lookup(resource.desc["queueName"])
-            msg = queue.read()
+            if len(cached) == 0:
+                queue = conn.lookup(resource.desc["queueName"])
+                if queue is None: return
+                cached.append(queue)
+            queue = cached[0]
+            msg = queue.read(message_attributes=[TRACE_ATTRIBUTE])
             if msg is not None:
                 queue.delete_message(msg)
-                self._eventBus.publish(payload["eventName"], resource, msg.get_body())
+                with tracing.activate(messageTraceParent(self._engine.tracer, msg)):
+                    self._eventBus.publish(payload["eventName"], resource, msg.get_body())
 
-        self._scheduler.schedule("sqs %s poll" % (resource.desc["queueName"]), poll, DEFAULT_SUBSCRIBE_PERIOD)
+        self._scheduler.schedule("sqs %s poll" % (resource.desc["queueName"]), poll, DEFAULT_SUBSCRIBE_PERIOD, executor="aws")
         return True
 
     def getEventNames(self):
@@ -45,6 +79,128 @@ class SQSHandler(Handler):
         if not eventName == "subscribe": return None
         return EventCondition(eventName, "sqs")
 
+class SQSConsumer(object):
+    """
+    Continuously receives from one queue using long polling and batches of up to 10 messages, publishing an event
+    per message and deleting each processed batch in one call. Runs `concurrency` receive loops in parallel.
+    Messages with a "traceparent" attribute are published as part of the sender's trace.
+    """
+    LOG = logging.getLogger("gears.handlers.SQSConsumer")
+    ERROR_DELAY = 5
+    DELETE_ATTEMPTS = 2
+
+    def __init__(self, eventBus, resource, eventName, connection, concurrency=1, batchSize=10, waitTimeSeconds=20, tracer=None):
+        self._eventBus = eventBus
+        self._tracer = tracer
+        self._resource = resource
+        self._eventName = eventName
+        self._connection = connection
+        self._queueName = resource.desc["queueName"]
+        self._queue = None
+        self._concurrency = concurrency
+        self._batchSize = min(batchSize, 10)
+        self._waitTimeSeconds = waitTimeSeconds
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._threads = list()
+        self.received = 0
+        self.deleted = 0
+
+    def start(self):
+        self.LOG.info("Starting %d consumer(s) for %s" % (self._concurrency, self._queueName))
+        for i in range(self._concurrency):
+            thread = threading.Thread(target=self._run, name="sqs-%s-%d" % (self._queueName, i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        for thread in self._threads:
+            thread.join(timeout if timeout is not None else self._waitTimeSeconds + 1)
+
+    def getQueue(self):
+        with self._lock:
+            if self._queue is None:
+                self._queue = self._connection.lookup(self._queueName)
+            return self._queue
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                queue = self.getQueue()
+                if queue is None:
+                    self.LOG.error("Queue %s does not exist" % self._queueName)
+                    self._stopped.wait(self.ERROR_DELAY)
+                    continue
+                messages = queue.get_messages(num_messages=self._batchSize, wait_time_seconds=self._waitTimeSeconds,
+                                              message_attributes=[TRACE_ATTRIBUTE])
+            except:
+                self.LOG.exception("-> error receiving from %s" % self._queueName)
+                with self._lock:
+                    self._queue = None
+                self._stopped.wait(self.ERROR_DELAY)
+                continue
+            if len(messages) > 0:
+                self._process(queue, messages)
+
+    def _process(self, queue, messages):
+        processed = list()
+        for msg in messages:
+            try:
+                parent = messageTraceParent(self._tracer, msg) if self._tracer is not None else None
+                with tracing.activate(parent):
+                    self._eventBus.publish(self._eventName, self._resource, msg.get_body())
+                processed.append(msg)
+            except:
+                self.LOG.exception("-> error publishing message from %s" % self._queueName)
+        deleted = self._delete(queue, processed) if len(processed) > 0 else 0
+        with self._lock:
+            self.received += len(messages)
+            self.deleted += deleted
+
+    # Returns how many of the messages were deleted. The entries that failed are tried again - those that still
+    # fail are received again once their visibility timeout expires
+    def _delete(self, queue, messages):
+        deleted = 0
+        for attempt in range(self.DELETE_ATTEMPTS):
+            try:
+                result = queue.delete_message_batch(messages)
+            except:
+                self.LOG.exception("-> error deleting %d message(s) from %s" % (len(messages), self._queueName))
+                continue
+            deleted += len(result.results)
+            failed = dict((error["id"], error.get("code")) for error in result.errors)
+            if len(failed) == 0:
+                break
+            self.LOG.warn("Unable to delete %d message(s) from %s: %s" % (len(failed), self._queueName, ", ".join(sorted(set(failed.values())))))
+            messages = [message for message in messages if message.id in failed]
+        return deleted
+
+class HandlerMetadata(object):
+    """What is read from a handler file's content, kept until the file's mtime changes"""
+    HEADER_LINES = 5
+    PERSISTENT_MARKER = "gears: persistent"
+    REMOTE_MARKER = "gears: remote"
+
+    def __init__(self, fullPath, mtime):
+        self.mtime = mtime
+        self.shebang = None
+        self.persistent = False
+        self.remote = False
+        try:
+            with open(fullPath) as opened:
+                header = [opened.readline().strip() for i in range(self.HEADER_LINES)]
+            if header[0].startswith("#!"):
+                self.shebang = header[0][2:].strip()
+            # Opt-in to a long running worker with a "# gears: persistent" comment near the top of the file
+            self.persistent = any(line.startswith("#") and self.PERSISTENT_MARKER in line for line in header[1:])
+            # Or to running on the EC2 instance the resource is under with "# gears: remote"
+            self.remote = any(line.startswith("#") and self.REMOTE_MARKER in line for line in header[1:])
+        except IOError:
+            pass
+        self.runnable = self.shebang is not None
+
 class FileHandler(Handler):
     LOG = logging.getLogger("gears.handlers.FileHandler")
     _eventBus = None
@@ -54,26 +210,50 @@ class FileHandler(Handler):
         self._engine = engine
         self._eventBus = engine.eventBus
         self.fullPath = fileFullPath
+        self._metadata = None
         self.createCondition()
-
+        # Everything but the resource fields is known up front, so dispatch only copies these
+        self._argv = [self.fullPath, self.condition.eventName if hasattr(self, "condition") else None]
+        self._env = {"HANDLER_PATH": self.fullPath,
+                     "HANDLER_NAME": os.path.splitext(os.path.basename(self.fullPath))[0],
+                     "HANDLER_TYPE": getattr(self, "type", "")}
+        if getattr(engine, "querySocket", None) is not None:
+            # Handlers run with nothing but this environment, so the client is started with this interpreter
+            self._env["DEVOPSGEARS"] = "%s %s" % (sys.executable, CLIENT)
+            self._env["GEARS_SOCKET"] = engine.querySocket
+
+    # The name is parsed once per handler - a renamed file is a different handler
     def createCondition(self):
+        (condition, order, handlerType) = self.parseName(os.path.basename(self.fullPath))
+        if condition is not None:
+            self.condition = condition
+        if order is not None:
+            self.order = order
+        if handlerType is not None:
+            self.type = handlerType
+
+    @staticmethod
+    def parseName(fileName):
         # TODO Other types of conditions (default actions like "register")
-        fileName = os.path.basename(self.fullPath)
+        condition = None
+        order = None
+        handlerType = None
         orderPartition = fileName.partition(".")
         if is_integer(orderPartition[0]):
             fileName = orderPartition[2]
-            self.order = int(orderPartition[0])
+            order = int(orderPartition[0])
         if fileName.startswith("on."):
             parts = fileName.split(".")
-            self.condition = EventCondition()
+            condition = EventCondition()
 
             state = "eventname"
-            for part in parts[1:]:
+            # The last part is the handler type (extension), not part of the condition
+            for part in (parts[1:-1] if len(parts) > 2 else parts[1:]):
                 if state == "eventname":
-                    self.condition.eventName = part
+                    condition.eventName = part
                     state = "resource-type"
                 elif state == "resource-type":
-                    self.condition.resourceType = part
+                    condition.resourceType = part
                     state = "resource-name"
                 elif state == "resource-name":
                     if part == "in":
@@ -81,19 +261,20 @@ class FileHandler(Handler):
                     elif part == "under":
                         state = "under"
                     else:
-                        self.condition.resourceName = part
+                        condition.resourceName = part
                         state = "done"
                 elif state == "in":
-                    self.condition.parent = part
+                    condition.parent = part
                     state = "done"
                 elif state == "under":
-                    self.condition.ancestor = part
+                    condition.ancestor = part
                     state = "done"
                 elif state == "done":
                     break
 
             if len(parts) > 1:
-                self.type = parts[-1]
+                handlerType = parts[-1]
+        return (condition, order, handlerType)
 
     def getEventCondition(self, eventName):
         if not eventName == self.condition.eventName: return None
@@ -102,13 +283,23 @@ class FileHandler(Handler):
     def getEventNames(self):
         return [self.condition.eventName]
 
-    def isRunnable(self):
-        opened = file(self.fullPath)
+    # Content is only re-read when the file's mtime has changed since it was last read
+    def getMetadata(self):
         try:
-            firstLine = opened.readline().strip()
-            return firstLine is not None and firstLine.startswith("#!")
-        finally:
-            opened.close()
+            mtime = os.stat(self.fullPath).st_mtime
+        except OSError:
+            mtime = None
+        metadata = self._metadata
+        if metadata is None or metadata.mtime != mtime:
+            metadata = HandlerMetadata(self.fullPath, mtime)
+            self._metadata = metadata
+        return metadata
+
+    def invalidate(self):
+        self._metadata = None
+
+    def isRunnable(self):
+        return self.getMetadata().runnable
 
     @staticmethod
     def isHandler(fileName):
@@ -117,22 +308,59 @@ class FileHandler(Handler):
 
     def handleEvent(self, eventName, resource, payload):
         if eventName == self.condition.eventName:
-            self.runHandler(resource, payload)
+            return self.runHandler(resource, payload)
 
+    # Returns a ResultObj that succeeds when the handler process exits with 0 (its value holds the exit code)
     def runHandler(self, resource, payload):
         self.LOG.info("Running file handler %s on %s with %s" % (self.fullPath, resource, payload))
         if self.isRunnable():
-            try:
-                self.systemExecute(resource, payload)
-                # TODO Handle return code
-                return
-            except OSError:
-                self.LOG.exception("-> error invoking system process")
+            return self.systemExecute(resource, payload)
 
         # self._eventBus.publish("run", self, {"resource": resource, "payload": payload})
 
+    def createEnv(self, resource, payload):
+        env = dict(self._env)
+        env["RESOURCE"] = str(resource)
+        env["RESOURCE_NAME"] = resource.name
+        env["RESOURCE_TYPE"] = resource.type
+        env["PAYLOAD"] = str(payload)
+        span = tracing.current()
+        if span is not None:
+            env["TRACEPARENT"] = span.traceparent()
+        if self.condition.ancestor is not None:
+            ancestor = resource.getAncestorByType(self.condition.ancestor)
+            if ancestor is not None:
+                env["RESOURCE_ANCESTOR_NAME"] = ancestor.name
+        return env
+
+    def createMessage(self, resource, payload):
+        message = {"eventName": self.condition.eventName, "payload": payload,
+                   "resource": {"name": resource.name, "type": resource.type, "parent": resource.parent,
+                                "desc": resource.desc, "dynamicState": resource.dynamicState}}
+        span = tracing.current()
+        if span is not None:
+            message["traceparent"] = span.traceparent()
+        if self.condition.ancestor is not None:
+            ancestor = resource.getAncestorByType(self.condition.ancestor)
+            message["ancestor"] = ancestor.name if ancestor is not None else None
+        return message
+
     def systemExecute(self, resource, payload):
-        return subprocess.call([self.fullPath, self.condition.eventName], env={"RESOURCE": str(resource), "RESOURCE_NAME": resource.name, "RESOURCE_TYPE": resource.type, "PAYLOAD": str(payload)})
+        config = self._engine.config["processes"] if "processes" in self._engine.config else {}
+        pool = self._engine.getService("processPool", lambda: ProcessPool(config.get("workers", 4)))
+        metadata = self.getMetadata()
+        if metadata.remote:
+            remote = self._engine.getService("remoteExecutor", lambda: RemoteExecutor(self._engine))
+            env = self.createEnv(resource, payload)
+            # The engine's socket is not reachable from the instance
+            for name in ["DEVOPSGEARS", "GEARS_SOCKET", "HANDLER_PATH"]:
+                env.pop(name, None)
+            return remote.execute(resource, self.fullPath, env)
+        if metadata.persistent:
+            return pool.submitPersistent(self._argv, self._env, self.createMessage(resource, payload), metadata.mtime,
+                                         timeout=config.get("timeout"))
+        return pool.submit(self._argv, env=self.createEnv(resource, payload),
+                           timeout=config.get("timeout"), key=self.fullPath, limit=config.get("concurrencyPerHandler"))
 
 class EC2InstanceHandler(Handler):
     LOG = logging.getLogger("engine.handlers.EC2InstanceHandler")
@@ -153,17 +381,14 @@ class EC2InstanceHandler(Handler):
                 return True
             elif attachRes == "starting":
                 self.LOG.info("Instance is starting")
-                resource.toState("PENDING_ACTIVATION")()
+                resource.setState("PENDING_ACTIVATION")
                 self.watchInstance(resource)
                 return True
             elif attachRes == "nonexisting":
                 self.LOG.info("Instance is non-existant - creating")
-                if self._tryCreate(resource):
-                    resource.toState("PENDING_ACTIVATION")()
-                    self.watchInstance(resource)
-                    return True
-                else:
-                    return False
+                resource.setState("PENDING_ACTIVATION")
+                # Completes once the batched launch has created (or failed to create) the instance
+                return self._tryCreate(resource).success(lambda: self.watchInstance(resource))
             else:
                 return False
 
@@ -181,17 +406,10 @@ class EC2InstanceHandler(Handler):
             "region" in resource.desc
 
     def _tryCreate(self, resource):
-        conn = ec2.connect_to_region(resource.desc["region"])
-        reservation = conn.run_instances(image_id = resource.desc["image-id"], min_count= 1, max_count=1,
-                           key_name=resource.desc["key-name"], security_groups=resource.desc["security-groups"],
-                           instance_type=resource.desc["instance-type"])
-        res = reservation.instances is not None and len(reservation.instances) > 0
-        if res:
-            reservation.instances[0].add_tags({"Name":resource.name, "CreatedBy":"DevOpsGears"})
-        return res
+        return self.getLauncher(resource.desc["region"]).launch(resource)
 
     def getInstanceState(self, resource):
-        conn = ec2.connect_to_region(resource.desc["region"])
+        conn = self._engine.connections.get("ec2", resource.desc["region"])
         instances = conn.get_only_instances(filters={"tag:Name":resource.name})
         if instances is not None:
             instances = [instance for instance in instances if instance.state in ["running", "pending", "stopped", "stopping"]]
@@ -211,16 +429,21 @@ class EC2InstanceHandler(Handler):
         else:
             return "nonexisting"
 
+    def getLauncher(self, region):
+        config = self._engine.config["ec2"] if "ec2" in self._engine.config else {}
+        return self._engine.getService("ec2launcher:" + region, lambda: EC2Launcher(self._engine, region,
+                                        config.get("launchBatchWindow", 0.5), config.get("launchParallelism", 4)))
+
+    def getMonitor(self, region):
+        config = self._engine.config["ec2"] if "ec2" in self._engine.config else {}
+        return self._engine.getService("ec2monitor:" + region, lambda: EC2Monitor(self._engine, region,
+                                        config.get("monitorPeriod", 10), config.get("maxMonitorPeriod", 120)))
+
     def watchInstance(self, resource):
-        handle = []
-        def monitor():
-            (instance, state) = self.getInstanceState(resource)
-            self.LOG.info("Instance %s state is %s" % (resource, state))
-            if state == "running":
-                self.readInstance(resource, instance)
-                self._engine.scheduler.unschedule(handle[0])
-                self._engine.eventBus.publish("activated", resource)
-        handle.append(self._engine.scheduler.schedule("EC2 monitor", monitor, 10))
+        def onRunning(resource, instance):
+            self.readInstance(resource, instance)
+            resource.setState("ACTIVATED")
+        self.getMonitor(resource.desc["region"]).watch(resource, onRunning)
 
     def readInstance(self, resource, instance):
         if not hasattr(resource, "dynamicState"):
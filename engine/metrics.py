@@ -0,0 +1,254 @@
+import logging
+import threading
+import SocketServer
+import BaseHTTPServer
+from bisect import bisect_left
+from collections import OrderedDict
+
+__author__ = 'Denis Mikhalkin'
+
+# Metrics of the running engine, rendered in the Prometheus text format by the engine's MetricsServer.
+# Modules define their metrics once at import time on REGISTRY and update them with
+# metric.labels(value, ...).inc() / .set() / .observe(). Values that already live elsewhere (resource states,
+# scheduler stats) are read by collectors when the metrics are rendered instead of being copied on every change.
+
+def formatValue(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+def escapeLabel(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def formatLabels(names, values):
+    if len(names) == 0:
+        return ""
+    return "{%s}" % ",".join("%s=\"%s\"" % (name, escapeLabel(value)) for (name, value) in zip(names, values))
+
+class Metric(object):
+    """A metric family: one value per combination of label values"""
+    TYPE = None
+
+    def __init__(self, name, help, labelNames=()):
+        self.name = name
+        self.help = help
+        self.labelNames = tuple(labelNames)
+        self._values = OrderedDict()    # label values -> value
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        if len(values) != len(self.labelNames):
+            raise ValueError("%s expects labels %s, got %s" % (self.name, self.labelNames, values))
+        return MetricChild(self, tuple(str(value) for value in values))
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, self.labelNames, key, value) for (key, value) in self._values.items()]
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s %s" % (self.name, self.TYPE)]
+        for (name, labelNames, labelValues, value) in self.samples():
+            lines.append("%s%s %s" % (name, formatLabels(labelNames, labelValues), formatValue(value)))
+        return lines
+
+class MetricChild(object):
+    __slots__ = ("_metric", "_key")
+
+    def __init__(self, metric, key):
+        self._metric = metric
+        self._key = key
+
+    def inc(self, amount=1):
+        self._metric._inc(self._key, amount)
+
+    def set(self, value):
+        self._metric._set(self._key, value)
+
+    def observe(self, value):
+        self._metric._observe(self._key, value)
+
+class Counter(Metric):
+    TYPE = "counter"
+
+    def _inc(self, key, amount):
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def inc(self, amount=1):
+        self._inc((), amount)
+
+    def get(self, *values):
+        with self._lock:
+            return self._values.get(tuple(str(value) for value in values), 0)
+
+class Gauge(Counter):
+    TYPE = "gauge"
+
+    def _set(self, key, value):
+        with self._lock:
+            self._values[key] = value
+
+    def set(self, value):
+        self._set((), value)
+
+class Histogram(Metric):
+    """Counts observations into cumulative buckets of upper bounds, as well as their count and sum"""
+    TYPE = "histogram"
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name, help, labelNames=(), buckets=BUCKETS):
+        Metric.__init__(self, name, help, labelNames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def _observe(self, key, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = [[0] * len(self.buckets), 0, 0.0]     # counts per bucket, count, sum
+                self._values[key] = entry
+            entry[0][index] += 1
+            entry[1] += 1
+            entry[2] += value
+
+    def observe(self, value):
+        self._observe((), value)
+
+    # (count, sum) of the observations with the label values
+    def get(self, *values):
+        with self._lock:
+            entry = self._values.get(tuple(str(value) for value in values))
+            return (entry[1], entry[2]) if entry is not None else (0, 0.0)
+
+    def samples(self):
+        labelNames = self.labelNames + ("le",)
+        samples = list()
+        with self._lock:
+            for (key, (counts, count, total)) in self._values.items():
+                cumulative = 0
+                for (bound, bucketCount) in zip(self.buckets, counts):
+                    cumulative += bucketCount
+                    samples.append((self.name + "_bucket", labelNames, key + (formatValue(float(bound)),), cumulative))
+                samples.append((self.name + "_count", self.labelNames, key, count))
+                samples.append((self.name + "_sum", self.labelNames, key, total))
+        return samples
+
+class MetricsRegistry(object):
+    """
+    Metrics by name, plus collectors: callables returning freshly filled metrics when the registry is rendered.
+    Asking for an existing name returns the metric already registered.
+    """
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self):
+        self._metrics = OrderedDict()
+        self._collectors = list()
+        self._lock = threading.Lock()
+
+    def counter(self, name, help, labelNames=()):
+        return self.register(Counter(name, help, labelNames))
+
+    def gauge(self, name, help, labelNames=()):
+        return self.register(Gauge(name, help, labelNames))
+
+    def histogram(self, name, help, labelNames=(), buckets=Histogram.BUCKETS):
+        return self.register(Histogram(name, help, labelNames, buckets))
+
+    def register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric):
+                    raise ValueError("%s is already registered as a %s" % (metric.name, existing.TYPE))
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def addCollector(self, collector):
+        with self._lock:
+            self._collectors.append(collector)
+
+    def removeCollector(self, collector):
+        with self._lock:
+            if collector in self._collectors:
+                self._collectors.remove(collector)
+
+    def collect(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors)
+        for collector in collectors:
+            metrics.extend(collector())
+        return metrics
+
+    # Families of the same name (e.g. collected from several engines) are rendered under one header
+    def render(self):
+        families = OrderedDict()
+        for metric in self.collect():
+            families.setdefault(metric.name, list()).append(metric)
+        lines = list()
+        for metrics in families.values():
+            rendered = metrics[0].render()
+            lines.extend(rendered)
+            for metric in metrics[1:]:
+                lines.extend(metric.render()[2:])
+        return "\n".join(lines) + "\n"
+
+REGISTRY = MetricsRegistry()
+
+class MetricsServer(object):
+    """
+    Serves the registry at /metrics over HTTP from the engine's own process, which is where the metrics are.
+    Started by the engine when its config has "metrics": {"port": port, "host": address} - port 0 picks a free one.
+    """
+    LOG = logging.getLogger("gears.MetricsServer")
+    POLL_INTERVAL = 0.05    # how soon stop() is noticed
+
+    def __init__(self, registry, port, host=""):
+        self._registry = registry
+        self.port = port
+        self.host = host
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        registry = self._registry
+        class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render()
+                self.send_response(200)
+                self.send_header("Content-Type", registry.CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                MetricsServer.LOG.debug(format % args)
+
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+        self._server = Server((self.host, self.port), RequestHandler)
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, args=(self.POLL_INTERVAL,), name="metrics-server")
+        self._thread.daemon = True
+        self._thread.start()
+        self.LOG.info("Serving metrics on port %d" % self.port)
+        return self
+
+    def stop(self):
+        if self._server is None: return
+        self._server.shutdown()
+        self._server.server_close()
+        self._server = None
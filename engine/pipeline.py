@@ -0,0 +1,117 @@
+import threading
+import logging
+from time import time
+from collections import deque
+
+__author__ = 'Denis Mikhalkin'
+
+class PipelineFull(Exception):
+    pass
+
+class EventPipeline(object):
+    """
+    Bounded worker pool that runs tasks in parallel while keeping tasks with the same key in submission order.
+    Each key is processed by at most one worker at a time; different keys are spread over the workers.
+    """
+    LOG = logging.getLogger("gears.EventPipeline")
+
+    def __init__(self, workers=4, maxQueueSize=10000, name="events"):
+        self._name = name
+        self._maxQueueSize = maxQueueSize
+        self._condition = threading.Condition()
+        self._pending = dict()      # key -> deque of tasks waiting for that key
+        self._ready = deque()       # keys with pending tasks and no worker on them
+        self._active = set()        # keys currently held by a worker
+        self._depth = 0
+        self._stopped = False
+        self._local = threading.local()
+        self.submitted = 0
+        self.completed = 0
+        self.rejected = 0
+        self.maxDepth = 0
+        self._workers = list()
+        for i in range(workers):
+            worker = threading.Thread(target=self._run, name="%s-%d" % (name, i))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, key, task, block=True, timeout=None):
+        with self._condition:
+            if self._stopped:
+                raise PipelineFull("Pipeline %s is stopped" % self._name)
+            # Workers never block on their own queue - a handler publishing from inside the pipeline would deadlock it
+            if self._depth >= self._maxQueueSize and not self.isWorkerThread():
+                deadline = time() + timeout if block and timeout is not None else None
+                while self._depth >= self._maxQueueSize and not self._stopped:
+                    remaining = deadline - time() if deadline is not None else None
+                    if not block or (remaining is not None and remaining <= 0):
+                        self.rejected += 1
+                        raise PipelineFull("Pipeline %s is full (%d events)" % (self._name, self._depth))
+                    self._condition.wait(remaining)
+            if key not in self._pending:
+                self._pending[key] = deque()
+                if key not in self._active:
+                    self._ready.append(key)
+            self._pending[key].append(task)
+            self._depth += 1
+            self.submitted += 1
+            self.maxDepth = max(self.maxDepth, self._depth)
+            self._condition.notify_all()
+
+    def isWorkerThread(self):
+        return getattr(self._local, "worker", False)
+
+    def depth(self):
+        return self._depth
+
+    def stats(self):
+        with self._condition:
+            return {"depth": self._depth, "maxDepth": self.maxDepth, "submitted": self.submitted,
+                    "completed": self.completed, "rejected": self.rejected, "activeKeys": len(self._active),
+                    "workers": len(self._workers)}
+
+    def stop(self, wait=True):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        if wait:
+            for worker in self._workers:
+                if worker is not threading.current_thread():
+                    worker.join()
+
+    def _next(self):
+        with self._condition:
+            while len(self._ready) == 0:
+                if self._stopped:
+                    return (None, None)
+                self._condition.wait()
+            key = self._ready.popleft()
+            tasks = self._pending[key]
+            task = tasks.popleft()
+            if len(tasks) == 0:
+                del self._pending[key]
+            self._active.add(key)
+            return (key, task)
+
+    def _done(self, key):
+        with self._condition:
+            self._active.discard(key)
+            if key in self._pending:
+                self._ready.append(key)
+            self._depth -= 1
+            self.completed += 1
+            self._condition.notify_all()
+
+    def _run(self):
+        self._local.worker = True
+        while True:
+            (key, task) = self._next()
+            if task is None:
+                return
+            try:
+                task()
+            except:
+                self.LOG.exception("-> error running task for %s" % str(key))
+            finally:
+                self._done(key)
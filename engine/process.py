@@ -0,0 +1,260 @@
+import os
+import json
+import signal
+import logging
+import threading
+import subprocess
+from collections import deque
+from time import time, sleep
+from concurrent.futures import ThreadPoolExecutor
+from engine.async import ResultObj
+from engine.metrics import REGISTRY
+
+__author__ = 'Denis Mikhalkin'
+
+PROCESS_SECONDS = REGISTRY.histogram("gears_process_seconds", "Duration of handler processes and of requests to persistent workers",
+                                     ["handler", "mode"])
+PROCESS_EXITS = REGISTRY.counter("gears_process_exits_total", "Handler process exits by exit code (timeout when killed, error when it did not run)",
+                                 ["handler", "code"])
+PERSISTENT_REQUESTS = REGISTRY.counter("gears_persistent_requests_total", "Requests to persistent workers by outcome (success, failure, timeout)",
+                                       ["handler", "outcome"])
+PERSISTENT_STARTS = REGISTRY.counter("gears_persistent_workers_started_total", "Persistent workers started", ["handler"])
+
+class ProcessPool(object):
+    """
+    Runs handler processes on a bounded number of worker threads. Processes sharing a key (the handler file)
+    can be limited to fewer concurrent runs, are killed together with their children on timeout, and have
+    their output streamed line by line to the log (and to onOutput, if given). submit() returns a ResultObj that
+    succeeds on exit code 0; its value holds the exit code, duration and whether the process timed out.
+    """
+    LOG = logging.getLogger("gears.ProcessPool")
+    OUTPUT_LOG = logging.getLogger("gears.handlers.output")
+    # How long output is still read after the process exited. Children it left running in the background (daemons)
+    # keep the pipes open; their output goes on being logged, but the run is over
+    OUTPUT_GRACE = 0.5
+
+    def __init__(self, workers=4):
+        self._executor = ThreadPoolExecutor(workers)
+        self._lock = threading.Lock()
+        self._running = dict()      # key -> number of running jobs
+        self._waiting = dict()      # key -> deque of jobs over the key's limit
+        self._workers = dict()      # handler path -> PersistentWorker
+
+    def submit(self, argv, env=None, timeout=None, key=None, limit=None, stdin=None, onOutput=None):
+        result = ResultObj()
+        self._schedule(key, limit, lambda: self._runProcess(argv, env, timeout, stdin, result, onOutput))
+        return result
+
+    # Sends message to the handler's persistent worker, starting it first or replacing it when version has changed.
+    # Requests to one worker are sent one at a time.
+    def submitPersistent(self, argv, env, message, version, timeout=None):
+        result = ResultObj()
+        self._schedule(("persistent", argv[0]), 1, lambda: self._runPersistent(argv, env, message, version, timeout, result))
+        return result
+
+    def stop(self):
+        self._executor.shutdown(wait=False)
+        with self._lock:
+            workers = list(self._workers.values())
+            self._workers.clear()
+        for worker in workers:
+            worker.stop()
+
+    def _schedule(self, key, limit, job):
+        with self._lock:
+            if key is not None and limit is not None and self._running.get(key, 0) >= limit:
+                self._waiting.setdefault(key, deque()).append(job)
+                return
+            self._running[key] = self._running.get(key, 0) + 1
+        self._executor.submit(self._run, key, job)
+
+    def _run(self, key, job):
+        try:
+            job()
+        finally:
+            self._release(key)
+
+    def _runProcess(self, argv, env, timeout, stdin, result, onOutput):
+        try:
+            (exitCode, duration, timedOut) = self.execute(argv, env, timeout, stdin, onOutput)
+            PROCESS_SECONDS.labels(argv[0], "process").observe(duration)
+            PROCESS_EXITS.labels(argv[0], "timeout" if timedOut else exitCode).inc()
+            result.trigger(exitCode == 0, {"exitCode": exitCode, "duration": duration, "timedOut": timedOut})
+        except:
+            self.LOG.exception("-> error running %s" % argv[0])
+            PROCESS_EXITS.labels(argv[0], "error").inc()
+            result.trigger(False, {"exitCode": None, "duration": 0, "timedOut": False})
+
+    def _runPersistent(self, argv, env, message, version, timeout, result):
+        try:
+            worker = self._workers.get(argv[0])
+            if worker is not None and (worker.version != version or not worker.isAlive()):
+                self.LOG.info("Recycling persistent worker for %s" % argv[0])
+                worker.stop()
+                worker = None
+            if worker is None:
+                worker = PersistentWorker(argv, env, version)
+                PERSISTENT_STARTS.labels(argv[0]).inc()
+                self._stream(worker.process.stderr, os.path.basename(argv[0]), logging.WARN)
+                with self._lock:
+                    self._workers[argv[0]] = worker
+            (reply, duration, timedOut) = worker.request(message, timeout)
+            success = reply is not None and reply.get("success", False) == True
+            PROCESS_SECONDS.labels(argv[0], "persistent").observe(duration)
+            PERSISTENT_REQUESTS.labels(argv[0], "timeout" if timedOut else ("success" if success else "failure")).inc()
+            result.trigger(success, {"exitCode": None, "duration": duration, "timedOut": timedOut, "reply": reply})
+        except:
+            self.LOG.exception("-> error running persistent %s" % argv[0])
+            PERSISTENT_REQUESTS.labels(argv[0], "failure").inc()
+            result.trigger(False, {"exitCode": None, "duration": 0, "timedOut": False, "reply": None})
+
+    def _release(self, key):
+        with self._lock:
+            waiting = self._waiting.get(key)
+            if waiting:
+                nextJob = waiting.popleft()
+                if len(waiting) == 0:
+                    del self._waiting[key]
+            else:
+                nextJob = None
+                self._running[key] -= 1
+                if self._running[key] == 0:
+                    del self._running[key]
+        if nextJob is not None:
+            self._executor.submit(self._run, key, nextJob)
+
+    # onOutput(line) is called with every line the process writes to stdout
+    def execute(self, argv, env=None, timeout=None, stdin=None, onOutput=None):
+        started = time()
+        name = os.path.basename(argv[0])
+        # Own process group, so that a timeout kills whatever the handler started too
+        process = subprocess.Popen(argv, env=env, stdin=subprocess.PIPE if stdin is not None else None,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True, preexec_fn=os.setsid)
+        readers = [self._stream(process.stdout, name, logging.INFO, onOutput), self._stream(process.stderr, name, logging.WARN)]
+        timedOut = []
+        timer = None
+        if timeout is not None:
+            def kill():
+                timedOut.append(True)
+                self.LOG.warn("%s timed out after %ss - killing it" % (name, timeout))
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+            timer = threading.Timer(timeout, kill)
+            timer.daemon = True
+            timer.start()
+        if stdin is not None:
+            try:
+                process.stdin.write(stdin)
+            except IOError:
+                self.LOG.warn("%s did not read its input" % name)
+            finally:
+                process.stdin.close()
+        exitCode = process.wait()
+        duration = time() - started
+        if timer is not None:
+            timer.cancel()
+        deadline = time() + self.OUTPUT_GRACE
+        for reader in readers:
+            reader.join(max(0, deadline - time()))
+        if any(reader.is_alive() for reader in readers):
+            self.LOG.info("%s left processes running that hold its output - not waiting for them" % name)
+        self.LOG.info("%s exited with %s after %.3fs" % (name, exitCode, duration))
+        return (exitCode, duration, len(timedOut) > 0)
+
+    def _stream(self, pipe, name, level, onOutput=None):
+        def read():
+            for line in iter(pipe.readline, b""):
+                self.OUTPUT_LOG.log(level, "[%s] %s" % (name, line.rstrip()))
+                if onOutput is not None:
+                    try:
+                        onOutput(line.rstrip("\n"))
+                    except:
+                        self.LOG.exception("-> error handling output of %s" % name)
+            pipe.close()
+        reader = threading.Thread(target=read, name="output-" + name)
+        reader.daemon = True
+        reader.start()
+        return reader
+
+class PersistentWorker(object):
+    """
+    A long running handler process. Each request is written to its stdin as one line of JSON and answered by one
+    line of JSON on its stdout, such as {"success": true}. Other lines it prints before the answer (stray echos)
+    are logged and skipped, as is whatever it writes to stderr.
+    """
+    LOG = logging.getLogger("gears.PersistentWorker")
+    STOP_TIMEOUT = 1
+
+    def __init__(self, argv, env, version):
+        self.version = version
+        self.name = os.path.basename(argv[0])
+        env = dict(env or {})
+        env["GEARS_PERSISTENT"] = "1"
+        self.process = subprocess.Popen(argv, env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE, close_fds=True, preexec_fn=os.setsid)
+        self.LOG.info("Started persistent worker %s (pid %s)" % (self.name, self.process.pid))
+
+    def isAlive(self):
+        return self.process.poll() is None
+
+    # Returns (reply, duration, timedOut); reply is None when the worker died or timed out before answering
+    def request(self, message, timeout=None):
+        started = time()
+        timedOut = []
+        timer = None
+        if timeout is not None:
+            def kill():
+                timedOut.append(True)
+                self.LOG.warn("%s timed out after %ss - killing it" % (self.name, timeout))
+                self.kill()
+            timer = threading.Timer(timeout, kill)
+            timer.daemon = True
+            timer.start()
+        reply = None
+        try:
+            self.process.stdin.write(json.dumps(message, default=str) + "\n")
+            self.process.stdin.flush()
+            while reply is None:
+                line = self.process.stdout.readline()
+                if not line:
+                    self.LOG.warn("%s exited without answering" % self.name)
+                    break
+                reply = self._parseReply(line)
+        except IOError:
+            self.LOG.warn("%s exited without answering" % self.name)
+        finally:
+            if timer is not None:
+                timer.cancel()
+        return (reply, time() - started, len(timedOut) > 0)
+
+    # The reply is the first line that is a JSON object - anything else is output that is not part of the protocol
+    def _parseReply(self, line):
+        try:
+            reply = json.loads(line)
+        except ValueError:
+            reply = None
+        if type(reply) is not dict:
+            self.LOG.warn("%s printed a line that is not a JSON reply - skipping it: %s" % (self.name, line.rstrip()))
+            return None
+        return reply
+
+    def kill(self):
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    # Closing stdin asks the worker to exit; it is killed if it does not
+    def stop(self):
+        try:
+            self.process.stdin.close()
+        except IOError:
+            pass
+        deadline = time() + self.STOP_TIMEOUT
+        while self.process.poll() is None and time() < deadline:
+            sleep(0.01)
+        if self.process.poll() is None:
+            self.kill()
+            self.process.wait()
@@ -0,0 +1,136 @@
+import os
+import json
+import logging
+import tempfile
+import threading
+import SocketServer
+from engine.metrics import REGISTRY
+
+__author__ = 'Denis Mikhalkin'
+
+QUERIES = REGISTRY.counter("gears_queries_total", "Resource lookups served over the query socket by outcome (found, missing, error)", ["outcome"])
+
+# Path of the thin client handed to handler scripts as $DEVOPSGEARS
+CLIENT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bin", "devopsgears")
+
+class AttributePath(object):
+    """
+    A resource attribute path such as "desc/key-name" or "dynamicState/privateIP", split once: the first part
+    is a resource field, the rest are keys (or list indexes) into its value.
+    """
+    FIELDS = ["name", "type", "parent", "state", "desc", "dynamicState", "altName", "raisesEvents"]
+    MAX_COMPILED = 1024
+    _compiled = dict()
+
+    def __init__(self, path):
+        parts = [part for part in path.split("/") if part != ""]
+        if len(parts) == 0 or parts[0] not in self.FIELDS:
+            raise ValueError("Unknown resource attribute %s - paths start with one of %s" % (path, ", ".join(self.FIELDS)))
+        self.path = path
+        self.field = parts[0]
+        self.keys = [int(part) if part.isdigit() else part for part in parts[1:]]
+
+    @classmethod
+    def compile(cls, path):
+        compiled = cls._compiled.get(path)
+        if compiled is None:
+            compiled = AttributePath(path)
+            if len(cls._compiled) >= cls.MAX_COMPILED:
+                cls._compiled.clear()
+            cls._compiled[path] = compiled
+        return compiled
+
+    def get(self, resource):
+        value = getattr(resource, self.field, None)
+        if self.field == "state" and value is not None:
+            value = value.name
+        for key in self.keys:
+            if isinstance(value, dict):
+                value = value.get(key if key in value else str(key))
+            elif isinstance(value, list) and isinstance(key, int):
+                value = value[key] if key < len(value) else None
+            else:
+                return None
+        return value
+
+class QueryServer(object):
+    """
+    Answers resource lookups of handler scripts over a Unix socket, so they need not load the engine. Each line
+    sent is a JSON request {"resources": [names], "attributes": [paths]} answered by one line
+    {"values": {name: {path: value}}, "missing": [names]}. A line holding a list of requests is answered with the
+    list of their replies. A connection can be kept open for any number of requests.
+    """
+    LOG = logging.getLogger("gears.QueryServer")
+    POLL_INTERVAL = 0.05    # how soon stop() is noticed
+
+    def __init__(self, engine, path):
+        self._engine = engine
+        self.path = path
+        self._server = None
+        self._thread = None
+
+    @staticmethod
+    def socketPath(engine):
+        config = engine.config["query"] if "query" in engine.config else {}
+        if not config.get("enabled", True):
+            return None
+        return config.get("socket", os.path.join(tempfile.gettempdir(), "devopsgears-%d-%x.sock" % (os.getpid(), id(engine))))
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = self
+        class RequestHandler(SocketServer.StreamRequestHandler):
+            def handle(self):
+                for line in iter(self.rfile.readline, b""):
+                    if line.strip() == "": continue
+                    self.wfile.write(json.dumps(server.answer(line), default=str) + "\n")
+                    self.wfile.flush()
+        self._server = SocketServer.ThreadingUnixStreamServer(self.path, RequestHandler)
+        self._server.daemon_threads = True
+        os.chmod(self.path, 0o600)
+        self._thread = threading.Thread(target=self._server.serve_forever, args=(self.POLL_INTERVAL,), name="query-server")
+        self._thread.daemon = True
+        self._thread.start()
+        self.LOG.info("Serving resource queries on %s" % self.path)
+        return self
+
+    def stop(self):
+        if self._server is None: return
+        self._server.shutdown()
+        self._server.server_close()
+        self._server = None
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def answer(self, line):
+        try:
+            request = json.loads(line)
+        except ValueError:
+            QUERIES.labels("error").inc()
+            return {"error": "Request is not JSON"}
+        if isinstance(request, list):
+            return [self.query(item) for item in request]
+        return self.query(request)
+
+    def query(self, request):
+        try:
+            names = request["resources"]
+            paths = [AttributePath.compile(path) for path in request["attributes"]]
+        except (KeyError, TypeError, ValueError) as e:
+            QUERIES.labels("error").inc()
+            return {"error": str(e) if isinstance(e, ValueError) else "Requests need \"resources\" and \"attributes\""}
+        values = dict()
+        missing = list()
+        for name in names:
+            resource = self._engine.resourceManager.getResource(name)
+            if resource is None:
+                QUERIES.labels("missing").inc()
+                missing.append(name)
+                values[name] = dict((path.path, None) for path in paths)
+            else:
+                QUERIES.labels("found").inc()
+                values[name] = dict((path.path, path.get(resource)) for path in paths)
+        return {"values": values, "missing": missing}
@@ -0,0 +1,148 @@
+import os
+import logging
+import tempfile
+import threading
+import subprocess
+from pipes import quote
+from engine.async import ResultObj
+from engine.process import ProcessPool
+from engine.metrics import REGISTRY
+
+__author__ = 'Denis Mikhalkin'
+
+REMOTE_RUNS = REGISTRY.counter("gears_remote_runs_total", "Scripts run on instances over SSH by outcome (success, failure, unreachable)", ["outcome"])
+REMOTE_SECONDS = REGISTRY.histogram("gears_remote_seconds", "Duration of scripts run on instances over SSH, including the round trip")
+
+class RemoteExecutor(object):
+    """
+    Runs scripts on the EC2 instances that resources live under. Each instance (by dynamicState["privateIP"]) gets
+    one OpenSSH master connection that later runs multiplex over and that outlives them for ControlPersist seconds.
+    The script is sent on stdin, then saved and run by the same remote command, so a run is a single round trip.
+    Runs on different instances go in parallel, at most `concurrency` at a time and `perHost` per instance.
+    The output is published as "output" events on the resource, each with up to `outputLines` lines, and the exit
+    as an "executed" event.
+
+    Config "remote": {"ssh": command prefix, "keysPath": directory of the instances' "key-name" files, "login",
+    "controlPath", "controlPersist", "options": extra -o options, "concurrency", "perHost", "timeout",
+    "outputEvents", "outputLines"}
+    """
+    LOG = logging.getLogger("gears.RemoteExecutor")
+    INSTANCE_TYPE = "ec2instance"
+    OUTPUT_EVENT = "output"
+    EXECUTED_EVENT = "executed"
+    DEFAULTS = {"ssh": ["ssh"], "keysPath": None, "login": "ec2-user", "controlPersist": 600, "options": [],
+                "concurrency": 16, "perHost": 10, "timeout": None, "outputEvents": True, "outputLines": 100,
+                "controlPath": os.path.join(tempfile.gettempdir(), "gears-ssh-%r@%h:%p")}
+    # Saves the script sent on stdin to a temporary file, runs it and cleans up, keeping its exit code
+    REMOTE_COMMAND = 'f=$(mktemp) && cat > "$f" && chmod +x "$f" && %s"$f"; code=$?; rm -f "$f"; exit $code'
+
+    def __init__(self, engine):
+        self._engine = engine
+        config = engine.config["remote"] if "remote" in engine.config else {}
+        self._config = dict(self.DEFAULTS)
+        self._config.update(config)
+        self._pool = ProcessPool(self._config["concurrency"])
+        self._lock = threading.Lock()
+        self._masters = dict()      # private IP -> instance a master connection was opened to
+
+    def getInstance(self, resource):
+        if resource.type == self.INSTANCE_TYPE:
+            return resource
+        return resource.getAncestorByType(self.INSTANCE_TYPE)
+
+    def destination(self, instance):
+        login = instance.desc.get("login", self._config["login"]) if instance.desc is not None else self._config["login"]
+        return "%s@%s" % (login, instance.dynamicState["privateIP"])
+
+    def sshCommand(self, instance, *extra):
+        command = list(self._config["ssh"])
+        options = ["BatchMode=yes", "ControlMaster=auto", "ControlPath=%s" % self._config["controlPath"],
+                   "ControlPersist=%s" % self._config["controlPersist"]] + list(self._config["options"])
+        for option in options:
+            command.extend(["-o", option])
+        keyName = instance.desc.get("key-name") if instance.desc is not None else None
+        if self._config["keysPath"] is not None and keyName is not None:
+            command.extend(["-i", os.path.join(self._config["keysPath"], keyName)])
+        return command + list(extra) + [self.destination(instance)]
+
+    # Runs the script (a file path) on the instance of the resource with env exported, returning a ResultObj that
+    # succeeds when the script exits with 0 (its value holds the exit code, duration, host and whether it timed out)
+    def execute(self, resource, scriptPath, env=None):
+        instance = self.getInstance(resource)
+        host = (instance.dynamicState or {}).get("privateIP") if instance is not None else None
+        if host is None:
+            self.LOG.error("No instance with a private IP to run %s for %s" % (scriptPath, resource))
+            REMOTE_RUNS.labels("unreachable").inc()
+            return ResultObj(False)
+        with open(scriptPath) as opened:
+            script = opened.read()
+        exports = "".join("%s=%s " % (name, quote(str(value))) for (name, value) in sorted((env or {}).items()))
+        argv = self.sshCommand(instance) + [self.REMOTE_COMMAND % exports]
+        with self._lock:
+            self._masters[host] = instance
+        name = os.path.basename(scriptPath)
+        output = None
+        if self._config["outputEvents"]:
+            publish = lambda lines: self._engine.eventBus.publish(self.OUTPUT_EVENT, resource, {"lines": lines, "host": host, "script": name})
+            output = OutputBatch(publish, self._config["outputLines"])
+        self.LOG.info("Running %s for %s on %s" % (name, resource.name, host))
+        result = self._pool.submit(argv, timeout=self._config["timeout"], key=host, limit=self._config["perHost"],
+                                   stdin=script, onOutput=output.add if output is not None else None)
+        executed = ResultObj()
+        def completed(success):
+            if output is not None:
+                output.close()
+            value = dict(result.value or {}, host=host, script=name)
+            REMOTE_RUNS.labels("success" if success else "failure").inc()
+            REMOTE_SECONDS.observe(value.get("duration") or 0)
+            self._engine.eventBus.publish(self.EXECUTED_EVENT, resource, value)
+            executed.trigger(success, value)
+        result.onComplete(completed)
+        return executed
+
+    # Runs the script for every resource in parallel - succeeds when it succeeded everywhere
+    def executeAll(self, resources, scriptPath, env=None):
+        return ResultObj.all_of([self.execute(resource, scriptPath, env) for resource in resources])
+
+    # Closes the master connections
+    def stop(self):
+        self._pool.stop()
+        with self._lock:
+            instances = self._masters.values()
+            self._masters = dict()
+        with open(os.devnull, "w") as devnull:
+            for instance in instances:
+                try:
+                    subprocess.call(self.sshCommand(instance, "-O", "exit"), stdout=devnull, stderr=devnull, close_fds=True)
+                except OSError:
+                    self.LOG.exception("-> error closing the connection to %s" % self.destination(instance))
+
+class OutputBatch(object):
+    """
+    Collects the lines a run prints and publishes them `size` at a time, and the rest when closed at the end of
+    the run - so a chatty script makes a few events rather than one per line. Lines after close() are dropped.
+    """
+    def __init__(self, publish, size):
+        self._publish = publish
+        self._size = size
+        self._lines = list()
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def add(self, line):
+        with self._lock:
+            if self._closed: return
+            self._lines.append(line)
+            if len(self._lines) >= self._size:
+                self._flush()
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._flush()
+
+    def _flush(self):
+        if len(self._lines) > 0:
+            lines = self._lines
+            self._lines = list()
+            self._publish(lines)
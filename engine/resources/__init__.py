@@ -1,34 +1,152 @@
 import os
+import logging
+import cPickle as pickle
+from multiprocessing import Pool, cpu_count
+from time import time
 import yaml
-from engine import Resource
+from engine import Resource, Packed
+
+try:
+    from yaml import CLoader as Loader
+except ImportError:
+    from yaml import Loader
 
 __author__ = 'Denis Mikhalkin'
 
+NOT_PARSED = object()
+
+# Module level so that it can be run in worker processes
+def parseDescriptor(filename):
+    try:
+        with open(filename) as opened:
+            info = yaml.load(opened, Loader=Loader)
+        return info if type(info) is dict else None
+    except:
+        return None
+
 class FileResource(Resource):
-    def __init__(self, filename):
+    __slots__ = ("filename",)
+
+    def __init__(self, filename, info=NOT_PARSED):
         Resource.__init__(self, os.path.splitext(filename)[0], os.path.splitext(filename)[1][1:], os.path.dirname(filename))
         self.filename = filename
-        self.readProperties()
+        if info is NOT_PARSED:
+            self.readProperties()
+        else:
+            self.applyProperties(info)
 
     def readProperties(self):
         self.state = Resource.STATES["INVALID"]
         if not os.path.exists(self.filename):
             return
+        self.applyProperties(parseDescriptor(self.filename))
+
+    def applyProperties(self, info):
+        self.state = Resource.STATES["INVALID"]
+        if type(info) is not dict:
+            return
+        if "type" in info:
+            self.type = info["type"]
+        if "name" in info:
+            self.altName = self.name
+            self.name = info["name"]
+        if "desc" in info:
+            self.desc = info["desc"]
+        if "behavior" in info:
+            self.behavior = info["behavior"]
+        if "raises" in info:
+            self.raisesEvents = info["raises"] if type(info["raises"]) is list else [info["raises"]]
+        self.state = Resource.STATES["ADDED"]
+
+class DescriptorParser(object):
+    """
+    Parses many resource descriptors at once. Unchanged files are served from a persistent cache keyed by
+    path, mtime and size; the rest are parsed across a process pool when there are enough of them and the
+    caller allows it. The pool is forked, so parallel parsing is only safe while the process has no other threads.
+    """
+    LOG = logging.getLogger("gears.DescriptorParser")
 
+    def __init__(self, cachePath=None, processes=None, parallelThreshold=64):
+        self._cachePath = cachePath
+        self._processes = processes if processes is not None else cpu_count()
+        self._parallelThreshold = parallelThreshold
+        self._cache = self._loadCache()
+        self.stats = dict()
+
+    # prune drops cache entries for files not in paths, which is right when paths is the whole repository.
+    # parallel allows forking a process pool
+    def parseAll(self, paths, prune=False, parallel=False):
+        started = time()
+        results = dict()
+        misses = list()
+        signatures = dict()
+        hits = 0
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                results[path] = None
+                continue
+            signatures[path] = (stat.st_mtime, stat.st_size)
+            cached = self._cache.get(path)
+            if cached is not None and cached[0] == signatures[path]:
+                results[path] = Packed.unpack(cached[1])
+                hits += 1
+            else:
+                misses.append(path)
+
+        parsedInProcesses = parallel and self._processes > 1 and len(misses) >= self._parallelThreshold
+        if parsedInProcesses:
+            pool = Pool(self._processes)
+            try:
+                parsed = pool.map(parseDescriptor, misses, max(1, len(misses) // (self._processes * 4)))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            parsed = [parseDescriptor(path) for path in misses]
+        for (path, info) in zip(misses, parsed):
+            results[path] = info
+            # Cached descriptors stay packed - once resources are built from them they are rarely read again
+            self._cache[path] = (signatures[path], Packed.pack(info))
+
+        dirty = len(misses) > 0
+        if prune:
+            for path in [path for path in self._cache if path not in signatures]:
+                del self._cache[path]
+                dirty = True
+        if dirty:
+            self._saveCache()
+        self.stats = {"files": len(paths), "cacheHits": hits, "parsed": len(parsed), "missing": len(paths) - len(signatures),
+                      "processes": self._processes if parsedInProcesses else 1, "parseSeconds": time() - started,
+                      "cLoader": Loader.__name__ == "CLoader"}
+        return results
+
+    # entries maps path -> ((mtime, size), descriptor), as returned by entries(); existing cache entries win
+    def seed(self, entries):
+        for (path, entry) in entries.items():
+            if path not in self._cache:
+                self._cache[path] = entry
+
+    def entries(self, paths):
+        return dict((path, self._cache[path]) for path in paths if path in self._cache)
+
+    def _loadCache(self):
+        if self._cachePath is None or not os.path.exists(self._cachePath):
+            return dict()
         try:
-            info = yaml.load(file(self.filename))
-            if type(info) is not dict:
-                return
-            if "type" in info:
-                self.type = info["type"]
-            if "name" in info:
-                self.altName = self.name
-                self.name = info["name"]
-            if "desc" in info:
-                self.desc = info["desc"]
-            if "behavior" in info:
-                self.behavior = info["behavior"]
-            self.state = Resource.STATES["DEFINED"]
+            with open(self._cachePath, "rb") as opened:
+                return pickle.load(opened)
         except:
-            pass
+            self.LOG.exception("-> unable to read parse cache %s - ignoring it" % self._cachePath)
+            return dict()
 
+    def _saveCache(self):
+        if self._cachePath is None: return
+        try:
+            temporary = self._cachePath + ".tmp"
+            with open(temporary, "wb") as opened:
+                pickle.dump(self._cache, opened, pickle.HIGHEST_PROTOCOL)
+            os.rename(temporary, self._cachePath)
+        except:
+            self.LOG.exception("-> unable to write parse cache %s" % self._cachePath)
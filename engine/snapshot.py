@@ -0,0 +1,98 @@
+import os
+import zlib
+import logging
+import cPickle as pickle
+from time import time
+
+__author__ = 'Denis Mikhalkin'
+
+class Snapshot(object):
+    """
+    Compact persisted copy of the resource graph: resource definitions with their state and dynamicState,
+    and the parsed repository descriptors with the (mtime, size) they were parsed at. On restart unchanged
+    ACTIVATED resources are restored as-is instead of being registered and activated again - unless a handler
+    of their registration or activation was added or changed since.
+    """
+    LOG = logging.getLogger("gears.Snapshot")
+    VERSION = 2
+    RESTORED_STATES = ["ACTIVATED"]
+    # Events a restored resource skips, so new handlers of these have to run for it
+    LIFECYCLE_EVENTS = ["register", "registered", "activate", "activated"]
+
+    def __init__(self, resources=None, descriptors=None, handlers=None, savedAt=None):
+        self.resources = resources if resources is not None else dict()       # name -> entry
+        self.descriptors = descriptors if descriptors is not None else dict()   # path -> ((mtime, size), descriptor)
+        self.handlers = handlers if handlers is not None else dict()            # path -> (mtime, size)
+        self.savedAt = savedAt
+        self._handlerConditions = list()    # conditions of lifecycle handlers added or changed since the snapshot
+
+    @classmethod
+    def load(cls, path):
+        if path is None or not os.path.exists(path):
+            return None
+        try:
+            with open(path, "rb") as opened:
+                data = pickle.loads(zlib.decompress(opened.read()))
+            if data.get("version") != cls.VERSION:
+                cls.LOG.warn("Ignoring snapshot %s with version %s" % (path, data.get("version")))
+                return None
+            snapshot = Snapshot(data["resources"], data["descriptors"], data["handlers"], data["savedAt"])
+            cls.LOG.info("Loaded snapshot of %d resources saved at %s" % (len(snapshot.resources), snapshot.savedAt))
+            return snapshot
+        except:
+            cls.LOG.exception("-> unable to read snapshot %s - ignoring it" % path)
+            return None
+
+    @classmethod
+    def capture(cls, engine):
+        resources = dict()
+        for resource in engine.resourceManager.getResources():
+            if resource is engine.resourceManager.root: continue
+            resources[resource.name] = cls.describe(resource)
+            resources[resource.name].update(state=resource.state["name"], dynamicState=dict(resource.dynamicState))
+        descriptors = dict()
+        handlers = dict()
+        repository = getattr(engine, "repository", None)
+        if repository is not None:
+            descriptors = repository.getDescriptors()
+            handlers = repository.getHandlerSignatures()
+        return Snapshot(resources, descriptors, handlers, time())
+
+    @staticmethod
+    def describe(resource):
+        return {"type": resource.type, "parent": resource.parent, "altName": resource.altName, "desc": resource.packedDesc,
+                "behavior": resource.behavior}
+
+    def save(self, path):
+        data = {"version": self.VERSION, "resources": self.resources, "descriptors": self.descriptors,
+                "handlers": self.handlers, "savedAt": self.savedAt}
+        temporary = path + ".tmp"
+        with open(temporary, "wb") as opened:
+            opened.write(zlib.compress(pickle.dumps(data, pickle.HIGHEST_PROTOCOL)))
+        os.rename(temporary, path)
+        self.LOG.info("Saved snapshot of %d resources to %s" % (len(self.resources), path))
+
+    # Compares the handler files now in the repository (path -> (mtime, size)) with the snapshot. Resources that
+    # the new and changed ones handle the lifecycle of will not be restored. parseName maps a file name to its
+    # (condition, order, type)
+    def reconcileHandlers(self, signatures, parseName):
+        changed = [fullPath for (fullPath, signature) in signatures.items() if self.handlers.get(fullPath) != signature]
+        removed = [fullPath for fullPath in self.handlers if fullPath not in signatures]
+        conditions = [parseName(os.path.basename(fullPath))[0] for fullPath in changed]
+        self._handlerConditions = [condition for condition in conditions
+                                   if condition is not None and condition.eventName in self.LIFECYCLE_EVENTS]
+        if len(changed) > 0 or len(removed) > 0:
+            self.LOG.info("Handlers changed since the snapshot: %d added or changed, %d removed" % (len(changed), len(removed)))
+
+    # Returns (stateName, dynamicState) if the resource is unchanged since the snapshot and can skip activation.
+    # The resource's parentResource has to be set, as handler conditions may check it
+    def restorableState(self, resource):
+        entry = self.resources.get(resource.name)
+        if entry is None or entry["state"] not in self.RESTORED_STATES:
+            return None
+        if not all(entry[key] == value for (key, value) in self.describe(resource).items()):
+            return None
+        if any(condition.matches(resource) for condition in self._handlerConditions):
+            self.LOG.info("Not restoring %s - a handler of its activation changed" % resource)
+            return None
+        return (entry["state"], entry["dynamicState"])
@@ -0,0 +1,174 @@
+import os
+import json
+import random
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from time import time
+
+__author__ = 'Denis Mikhalkin'
+
+# The span a thread is working on behalf of. EventBus.publish starts a child of it for every event, ResultObj
+# callbacks run in the span their result was created in, scheduler jobs start their own trace, handler
+# processes get it as TRACEPARENT and SQS messages received with a "traceparent" attribute continue theirs.
+# Nothing is started unless the engine's Tracer is enabled.
+_local = threading.local()
+
+def current():
+    return getattr(_local, "span", None)
+
+class activate(object):
+    """Makes span the current one for a with block; None leaves the current span as it is (and costs next to nothing)"""
+    __slots__ = ("_span", "_previous")
+
+    def __init__(self, span):
+        self._span = span
+        self._previous = None
+
+    def __enter__(self):
+        if self._span is not None:
+            self._previous = current()
+            _local.span = self._span
+        return self._span
+
+    def __exit__(self, excType, excValue, traceback):
+        if self._span is not None:
+            _local.span = self._previous
+        return False
+
+# A child of the current span, for code that has no tracer at hand - None when there is no current span
+def startChild(name, tags=None):
+    parent = current()
+    return parent.tracer.startSpan(name, tags) if parent is not None else None
+
+class Span(object):
+    __slots__ = ("tracer", "traceId", "spanId", "parentId", "name", "kind", "started", "duration", "tags")
+
+    def __init__(self, tracer, name, parent=None, kind=None, tags=None):
+        self.tracer = tracer
+        self.traceId = parent.traceId if parent is not None else "%032x" % random.getrandbits(128)
+        self.spanId = "%016x" % random.getrandbits(64)
+        self.parentId = parent.spanId if parent is not None else None
+        self.name = name
+        self.kind = kind
+        self.started = time()
+        self.duration = None
+        self.tags = dict(tags) if tags is not None else dict()
+
+    # success is the outcome of the traced operation (a ResultObj outcome) - only the first finish counts
+    def finish(self, success=None, **tags):
+        if self.duration is not None: return
+        self.duration = time() - self.started
+        if success is not None:
+            self.tags["success"] = bool(success)
+        self.tags.update(tags)
+        self.tracer.record(self)
+
+    # W3C trace context, as handed to handler processes
+    def traceparent(self):
+        return "00-%s-%s-01" % (self.traceId, self.spanId)
+
+    def toZipkin(self, serviceName):
+        span = {"traceId": self.traceId, "id": self.spanId, "name": self.name, "timestamp": int(self.started * 1e6),
+                "duration": max(1, int(self.duration * 1e6)), "localEndpoint": {"serviceName": serviceName},
+                "tags": dict((key, str(value).lower() if isinstance(value, bool) else str(value)) for (key, value) in self.tags.items())}
+        if self.parentId is not None:
+            span["parentId"] = self.parentId
+        if self.kind is not None:
+            span["kind"] = self.kind
+        return span
+
+class RemoteParent(object):
+    """The span of another process that a trace continues from, as given by its W3C traceparent"""
+    __slots__ = ("tracer", "traceId", "spanId")
+
+    def __init__(self, tracer, traceId, spanId):
+        self.tracer = tracer
+        self.traceId = traceId
+        self.spanId = spanId
+
+    def traceparent(self):
+        return "00-%s-%s-01" % (self.traceId, self.spanId)
+
+class Tracer(object):
+    """
+    Collects the finished spans of an engine and writes them to config "tracing": {"path"} as a Zipkin v2 JSON
+    array, which Zipkin, Jaeger and most trace viewers load. The file is rewritten every "exportPeriod" seconds
+    and when the engine stops, with the last "maxSpans" spans. Without a path, tracing is off.
+    """
+    LOG = logging.getLogger("gears.Tracer")
+    MAX_SPANS = 100000
+
+    def __init__(self, config):
+        self.path = config.get("path")
+        self.enabled = self.path is not None
+        self._serviceName = config.get("serviceName", "devopsgears")
+        self._exportPeriod = config.get("exportPeriod", 10)
+        self._spans = deque(maxlen=config.get("maxSpans", self.MAX_SPANS))
+        self._lock = threading.Lock()
+        self._changed = False
+        self._job = None
+
+    # A child of the current span, or the root of a new trace; None when tracing is off
+    def startSpan(self, name, tags=None, kind=None):
+        if not self.enabled: return None
+        return Span(self, name, current(), kind, tags)
+
+    def startTrace(self, name, tags=None, kind=None):
+        if not self.enabled: return None
+        return Span(self, name, None, kind, tags)
+
+    # A parent to activate for work another process traced, e.g. SQS messages sent with a traceparent attribute.
+    # None when tracing is off or traceparent is missing or malformed
+    def remoteParent(self, traceparent):
+        if not self.enabled or not isinstance(traceparent, basestring): return None
+        parts = traceparent.strip().split("-")
+        if len(parts) < 4 or len(parts[1]) != 32 or len(parts[2]) != 16: return None
+        try:
+            int(parts[1], 16)
+            int(parts[2], 16)
+        except ValueError:
+            return None
+        return RemoteParent(self, parts[1].lower(), parts[2].lower())
+
+    # Traces the block as a child of the current span
+    @contextmanager
+    def span(self, name, tags=None):
+        span = self.startSpan(name, tags)
+        with activate(span):
+            try:
+                yield span
+            finally:
+                if span is not None:
+                    span.finish()
+
+    def record(self, span):
+        with self._lock:
+            self._spans.append(span)
+            self._changed = True
+
+    def spans(self):
+        with self._lock:
+            return list(self._spans)
+
+    def start(self, scheduler):
+        if self.enabled and self._job is None:
+            self._job = scheduler.schedule("trace export", self.export, self._exportPeriod, executor="io", traced=False)
+
+    def export(self):
+        if not self.enabled: return
+        with self._lock:
+            if not self._changed: return
+            spans = list(self._spans)
+            self._changed = False
+        temporary = self.path + ".tmp"
+        try:
+            with open(temporary, "w") as opened:
+                json.dump([span.toZipkin(self._serviceName) for span in spans], opened)
+            os.rename(temporary, self.path)
+        except (IOError, OSError):
+            self.LOG.exception("-> error writing traces to %s" % self.path)
+
+    def stop(self):
+        self.export()
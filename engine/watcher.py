@@ -0,0 +1,164 @@
+import os
+import logging
+import threading
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+__author__ = 'Denis Mikhalkin'
+
+ADDED = "added"
+CHANGED = "changed"
+DELETED = "deleted"
+
+def isIgnored(name):
+    return name.startswith(".")
+
+def listFiles(rootPath):
+    for (dirName, subdirNames, fileNames) in os.walk(rootPath):
+        subdirNames[:] = [name for name in subdirNames if not isIgnored(name)]
+        for fileName in fileNames:
+            if not isIgnored(fileName):
+                yield os.path.join(dirName, fileName)
+
+class PollingWatcher(object):
+    """
+    Detects added, changed and deleted files by comparing (mtime, size) snapshots on a schedule.
+    Directory listings are only re-read when the directory's own mtime changes.
+    callback receives a list of (kind, path) tuples.
+    """
+    LOG = logging.getLogger("gears.PollingWatcher")
+
+    def __init__(self, rootPath, callback, scheduler, period=2):
+        self._rootPath = rootPath
+        self._callback = callback
+        self._scheduler = scheduler
+        self._period = period
+        self._directories = dict()   # path -> (mtime, files, subdirectories)
+        self._files = dict()         # path -> (mtime, size)
+        self._job = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            self._files = self.snapshot()
+        self._job = self._scheduler.schedule("repository watcher", self.check, self._period, executor="io")
+        self.LOG.info("Watching %s by polling every %ss" % (self._rootPath, self._period))
+
+    def stop(self):
+        if self._job is not None:
+            self._scheduler.unschedule(self._job)
+            self._job = None
+
+    def check(self):
+        with self._lock:
+            current = self.snapshot()
+            changes = [(DELETED, path) for path in self._files if path not in current]
+            for (path, signature) in current.items():
+                if path not in self._files:
+                    changes.append((ADDED, path))
+                elif self._files[path] != signature:
+                    changes.append((CHANGED, path))
+            self._files = current
+        if len(changes) > 0:
+            self._callback(sorted(changes, key=lambda change: change[1]))
+        return changes
+
+    def snapshot(self):
+        files = dict()
+        directories = dict()
+        pending = [self._rootPath]
+        while len(pending) > 0:
+            dirName = pending.pop()
+            try:
+                mtime = os.stat(dirName).st_mtime
+            except OSError:
+                continue
+            cached = self._directories.get(dirName)
+            if cached is not None and cached[0] == mtime:
+                (_, fileNames, subdirNames) = cached
+            else:
+                fileNames = list()
+                subdirNames = list()
+                try:
+                    for name in os.listdir(dirName):
+                        if isIgnored(name): continue
+                        if os.path.isdir(os.path.join(dirName, name)):
+                            subdirNames.append(name)
+                        else:
+                            fileNames.append(name)
+                except OSError:
+                    continue
+            directories[dirName] = (mtime, fileNames, subdirNames)
+            for fileName in fileNames:
+                fullPath = os.path.join(dirName, fileName)
+                try:
+                    stat = os.stat(fullPath)
+                except OSError:
+                    continue
+                files[fullPath] = (stat.st_mtime, stat.st_size)
+            pending.extend(os.path.join(dirName, name) for name in subdirNames)
+        self._directories = directories
+        return files
+
+class InotifyWatcher(object):
+    """Delivers file changes as they happen using inotify (requires pyinotify)"""
+    LOG = logging.getLogger("gears.InotifyWatcher")
+
+    def __init__(self, rootPath, callback):
+        self._rootPath = rootPath
+        self._callback = callback
+        self._notifier = None
+
+    @staticmethod
+    def isAvailable():
+        return pyinotify is not None
+
+    def start(self):
+        watcher = self
+        class Handler(pyinotify.ProcessEvent):
+            def process_default(self, event):
+                watcher._onEvent(event)
+        manager = pyinotify.WatchManager()
+        # New files are reported on IN_CLOSE_WRITE rather than IN_CREATE, once their content has been written
+        mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO
+        manager.add_watch(self._rootPath, mask, rec=True, auto_add=True,
+                          exclude_filter=lambda path: any(isIgnored(part) for part in path.split(os.sep)))
+        self._notifier = pyinotify.ThreadedNotifier(manager, Handler())
+        self._notifier.daemon = True
+        self._notifier.start()
+        self.LOG.info("Watching %s with inotify" % self._rootPath)
+
+    def stop(self):
+        if self._notifier is not None:
+            self._notifier.stop()
+            self._notifier = None
+
+    # A directory deleted or moved away is reported as one deletion of its path, which takes everything under
+    # it along. A directory moved in is not followed by events for its content, so its files are listed here
+    def _onEvent(self, event):
+        if isIgnored(os.path.basename(event.pathname)):
+            return
+        if event.mask & (pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM):
+            changes = [(DELETED, event.pathname)]
+        elif event.dir and event.mask & pyinotify.IN_MOVED_TO:
+            changes = [(ADDED, path) for path in sorted(listFiles(event.pathname))]
+        elif event.dir:
+            return
+        elif event.mask & pyinotify.IN_MOVED_TO:
+            changes = [(ADDED, event.pathname)]
+        else:
+            changes = [(CHANGED, event.pathname)]
+        try:
+            self._callback(changes)
+        except:
+            self.LOG.exception("-> error handling change of %s" % event.pathname)
+
+def createWatcher(rootPath, callback, scheduler, mode="auto", period=2):
+    if mode in ["auto", "inotify"] and InotifyWatcher.isAvailable():
+        return InotifyWatcher(rootPath, callback)
+    if mode == "inotify":
+        logging.getLogger("gears.Repository").warn("pyinotify is not installed - falling back to polling")
+    return PollingWatcher(rootPath, callback, scheduler, period)
@@ -1,8 +1,9 @@
 #!/bin/bash
 
-keyName=`$DEVOPSGEARS get-resource-attribute $RESOURCE_ANCESTOR_NAME desc/key-name`
-login=`$DEVOPSGEARS get-resource-attribute $RESOURCE_ANCESTOR_NAME desc/login`
-ip=`$DEVOPSGEARS get-resource-attribute $RESOURCE_ANCESTOR_NAME dynamicState/privateIP`
+# One round trip to the engine for all three attributes, one value per line
+{ read keyName; read login; read ip; } <<EOF_ATTRIBUTES
+`$DEVOPSGEARS get-resource-attribute $RESOURCE_ANCESTOR_NAME desc/key-name desc/login dynamicState/privateIP`
+EOF_ATTRIBUTES
 
 cat - | ssh -i $KEYS/$keyName $login@$ip "cat > /tmp/$HANDLER_NAME.$HANDLER_TYPE; chmod +x $HANDLER_NAME.$HANDLER_TYPE"
 ssh -i $KEYS/$keyName $login@$ip "/tmp/$HANDLER_NAME.$HANDLER_TYPE" | `$DEVOPSGEARS get-resource-data $RESORCE_NAME`
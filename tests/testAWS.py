@@ -0,0 +1,143 @@
+from engine import Engine, Resource
+from engine.aws import EC2Monitor, EC2Launcher
+from engine.fakeaws import FakeSQSConnection, FakeEC2Connection
+import logging
+import threading
+
+__author__ = 'Denis Mikhalkin'
+
+import unittest
+
+class Test(unittest.TestCase):
+    def tearDown(self):
+        if hasattr(self, "engine"):
+            self.engine.stop()
+
+    def testConnectionsAreShared(self):
+        logging.basicConfig()
+        engine = Engine({"aws_config": {"profile_name": "test"}})
+        self.engine = engine
+        created = []
+        def connect(region, **kwargs):
+            created.append((region, kwargs))
+            return FakeSQSConnection(region)
+        engine.connections.setFactory("sqs", connect)
+
+        connections = []
+        threads = [threading.Thread(target=lambda: connections.append(engine.connections.get("sqs", "ap-southeast-2"))) for i in range(8)]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+        assert len(set(id(connection) for connection in connections)) == 1
+        assert created == [("ap-southeast-2", {"profile_name": "test"})]
+
+        assert engine.connections.get("sqs", "us-east-1") is not connections[0]
+        engine.connections.invalidate("sqs", "ap-southeast-2")
+        assert engine.connections.get("sqs", "ap-southeast-2") is not connections[0]
+        assert len(created) == 3
+
+    def createEngine(self, conn, config=None):
+        logging.basicConfig()
+        engine = Engine(config or {})
+        self.engine = engine
+        engine.connections.setFactory("ec2", lambda region, **kwargs: conn)
+        return engine
+
+    def testMonitorDescribesAllInstancesAtOnce(self):
+        conn = FakeEC2Connection(pendingDescribes=2)
+        engine = self.createEngine(conn)
+        monitor = EC2Monitor(engine, "local")
+        running = []
+        for i in range(50):
+            resource = Resource("instance%d" % i, "ec2instance", None)
+            conn.run_instances("ami-1").instances[0].add_tags({"Name": resource.name})
+            monitor.watch(resource, lambda resource, instance: running.append((resource.name, instance.state)))
+        monitor.poll()
+        assert running == []
+        monitor.poll()
+        assert sorted(running) == sorted(("instance%d" % i, "running") for i in range(50))
+        assert conn.requestsByAction["DescribeInstances"] == 2
+        assert monitor._job is None
+
+    def testMonitorBacksOffWhenThrottled(self):
+        conn = FakeEC2Connection()
+        engine = self.createEngine(conn)
+        monitor = EC2Monitor(engine, "local", period=10, maxPeriod=30)
+        monitor.watch(Resource("instance", "ec2instance", None), lambda resource, instance: None)
+        conn.throttle(3)
+        monitor.poll()
+        assert monitor.period == 20
+        monitor.poll()
+        monitor.poll()
+        assert monitor.period == 30
+        monitor.poll()
+        assert monitor.period == 15
+        monitor.poll()
+        assert monitor.period == 10
+        monitor.stop()
+
+    def testInstanceActivation(self):
+        conn = FakeEC2Connection(pendingDescribes=2)
+        engine = self.createEngine(conn, {"ec2": {"monitorPeriod": 0.05}})
+        instance = Resource("testinstance", "ec2instance", engine.resourceManager.root,
+                            behavior="engine.handlers.EC2InstanceHandler",
+                            desc={"region": "local", "image-id": "ami-1", "instance-type": "t2.micro",
+                                  "key-name": "key", "security-groups": ["default"]})
+        engine.resourceManager.addResource(instance)
+        engine.start()
+        assert instance.waitForState("ACTIVATED", 5)
+        assert instance.dynamicState["privateIP"] is not None
+
+    def createInstances(self, engine, count, imageId="ami-1"):
+        instances = [Resource("%s-instance%d" % (imageId, i), "ec2instance", engine.resourceManager.root,
+                              desc={"region": "local", "image-id": imageId, "instance-type": "t2.micro",
+                                    "key-name": "key", "security-groups": ["default"]}) for i in range(count)]
+        for instance in instances:
+            engine.resourceManager.addResource(instance)
+        return instances
+
+    def testBulkLaunch(self):
+        conn = FakeEC2Connection()
+        engine = self.createEngine(conn, {"ec2": {"monitorPeriod": 0.05, "launchBatchWindow": 0.1}})
+        engine.handlerManager.registerHandler("engine.handlers.EC2InstanceHandler")
+        instances = self.createInstances(engine, 20) + self.createInstances(engine, 5, "ami-2")
+        engine.start()
+        assert engine.resourceManager.waitForStates(instances, "ACTIVATED", 5)
+        assert conn.requestsByAction["RunInstances"] == 2
+        assert conn.requestsByAction["DescribeInstances"] < 25 + 10
+        assert len(set(instance.dynamicState["privateIP"] for instance in instances)) == 25
+
+    def testPartialLaunchFailsRemainingResources(self):
+        conn = FakeEC2Connection(capacity=3)
+        engine = self.createEngine(conn, {"ec2": {"monitorPeriod": 0.05, "launchBatchWindow": 0.1}})
+        engine.handlerManager.registerHandler("engine.handlers.EC2InstanceHandler")
+        instances = self.createInstances(engine, 5)
+        engine.start()
+        assert engine.resourceManager.waitForStates(instances[:3], "ACTIVATED", 5)
+        assert engine.resourceManager.waitForStates(instances[3:], "FAILED", 5)
+
+    def testTaggingIsOneCallPerInstance(self):
+        class FailingTags(FakeEC2Connection):
+            def create_tags(self, resource_ids, tags):
+                if tags.get("Name") == "ami-1-instance1":
+                    self.countRequest("CreateTags")
+                    raise Exception("InternalError")
+                return FakeEC2Connection.create_tags(self, resource_ids, tags)
+        conn = FailingTags()
+        engine = self.createEngine(conn, {"ec2": {"monitorPeriod": 0.05, "launchBatchWindow": 0.1}})
+        engine.handlerManager.registerHandler("engine.handlers.EC2InstanceHandler")
+        EC2Launcher.TAG_RETRY_DELAY = 0
+        try:
+            instances = self.createInstances(engine, 3)
+            engine.start()
+            assert engine.resourceManager.waitForStates([instances[0], instances[2]], "ACTIVATED", 5)
+            assert engine.resourceManager.waitForStates([instances[1]], "FAILED", 5)
+        finally:
+            EC2Launcher.TAG_RETRY_DELAY = 0.5
+        assert conn.requestsByAction["CreateTags"] == 2 + EC2Launcher.TAG_ATTEMPTS
+        assert conn.requestsByAction["TerminateInstances"] == 1
+        states = sorted((instance.tags.get("Name"), instance.state) for instance in conn.get_only_instances())
+        assert states[0] == (None, "terminated")
+        assert all(instance.tags.get("CreatedBy") == "DevOpsGears" for instance in conn.get_only_instances() if instance.state != "terminated")
+
+if __name__ == '__main__':
+    unittest.main()
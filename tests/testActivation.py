@@ -0,0 +1,112 @@
+from engine import Engine, Resource, EventCondition
+from engine.async import ResultObj
+import logging
+import threading
+from time import time
+
+__author__ = 'Denis Mikhalkin'
+
+import unittest
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        logging.basicConfig()
+
+    def tearDown(self):
+        self.engine.stop()
+
+    def createTree(self, depth, fanOut):
+        parents = [self.engine.resourceManager.root]
+        resources = list()
+        for level in range(depth):
+            children = list()
+            for parent in parents:
+                for i in range(fanOut):
+                    children.append(Resource("%s-%d" % (parent.name, i), "node", parent))
+            parents = children
+            resources.extend(children)
+        for resource in resources:
+            self.engine.resourceManager.addResource(resource)
+        return resources
+
+    def testWavesActivateConcurrently(self):
+        self.engine = Engine({"activation": {"concurrency": 100}})
+        inFlight = {"now": 0, "max": 0}
+        lock = threading.Lock()
+        def activate(eventName, resource, payload):
+            with lock:
+                inFlight["now"] += 1
+                inFlight["max"] = max(inFlight["max"], inFlight["now"])
+            result = ResultObj()
+            def complete():
+                with lock:
+                    inFlight["now"] -= 1
+                result.trigger(True)
+            threading.Timer(0.1, complete).start()
+            return result
+        self.engine.handlerManager.registerOn(activate, EventCondition("activate", "node"))
+        resources = self.createTree(3, 3)
+        started = time()
+        self.engine.start()
+        assert self.engine.resourceManager.waitForStates(resources, "ACTIVATED", 5)
+        assert time() - started < 1
+        assert inFlight["max"] == 27
+        plan = self.engine.resourceManager.planner.history[-1]
+        assert [wave["size"] for wave in plan.waves] == [3, 9, 27]
+        assert all(wave["activated"] == wave["size"] for wave in plan.waves)
+
+    def testConcurrencyLimit(self):
+        self.engine = Engine({"activation": {"concurrency": 2}})
+        inFlight = {"now": 0, "max": 0}
+        lock = threading.Lock()
+        def activate(eventName, resource, payload):
+            with lock:
+                inFlight["now"] += 1
+                inFlight["max"] = max(inFlight["max"], inFlight["now"])
+            result = ResultObj()
+            def complete():
+                with lock:
+                    inFlight["now"] -= 1
+                result.trigger(True)
+            threading.Timer(0.01, complete).start()
+            return result
+        self.engine.handlerManager.registerOn(activate, EventCondition("activate", "node"))
+        resources = self.createTree(1, 10)
+        self.engine.start()
+        assert self.engine.resourceManager.waitForStates(resources, "ACTIVATED", 5)
+        assert inFlight["max"] == 2
+
+    def testDeepTreeDoesNotRecurse(self):
+        self.engine = Engine({})
+        self.engine.handlerManager.registerOn(lambda eventName, resource, payload: True, EventCondition("activate", "node"))
+        resources = self.createTree(1500, 1)
+        self.engine.start()
+        assert self.engine.resourceManager.waitForStates(resources, "ACTIVATED", 5)
+        assert len(self.engine.resourceManager.planner.history[-1].waves) == 1500
+
+    def testFailedResourceDoesNotActivateChildren(self):
+        self.engine = Engine({})
+        self.engine.handlerManager.registerOn(lambda eventName, resource, payload: resource.name != "root-0",
+                                              EventCondition("activate", "node"))
+        self.createTree(2, 2)
+        self.engine.start()
+        manager = self.engine.resourceManager
+        assert manager.getResource("root-0").isState("FAILED")
+        assert manager.getResource("root-0-0").isState("REGISTERED")
+        assert manager.getResource("root-1-1").isState("ACTIVATED")
+
+    def testChildNamingParentByAltName(self):
+        self.engine = Engine({})
+        manager = self.engine.resourceManager
+        parent = Resource("Dev", "env", manager.root, altName="repo/dev")
+        child = Resource("repo/dev/app", "app", "repo/dev")
+        manager.addResource(parent)
+        manager.addResource(child)
+        assert manager.getChildren(parent) == [child]
+        self.engine.start()
+        assert manager.waitForStates([parent, child], "ACTIVATED", 5)
+        manager.removeResource(child)
+        assert manager.getChildren(parent) == []
+
+if __name__ == '__main__':
+    unittest.main()
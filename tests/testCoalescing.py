@@ -0,0 +1,76 @@
+from engine import Engine, Resource
+import logging
+from time import sleep
+
+__author__ = 'Denis Mikhalkin'
+
+import unittest
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        logging.basicConfig()
+
+    def tearDown(self):
+        self.engine.stop()
+
+    def createEngine(self, config=None):
+        self.engine = Engine(config or {})
+        self.events = list()
+        self.engine.eventBus.subscribe(lambda eventName, resource, payload: True,
+                                       lambda eventName, resource, payload: self.events.append((eventName, resource.name, payload)) or True,
+                                       allEvents=True)
+        return self.engine.eventBus
+
+    def testReplayKeepsOrderAndCoalesces(self):
+        bus = self.createEngine()
+        first = Resource("first", "file", None)
+        second = Resource("second", "file", None)
+        bus.suspendEvents()
+        bus.publish("register", first)
+        updated = bus.publish("update", first, {"path": "a"})
+        bus.publish("register", second)
+        assert bus.publish("update", first, {"path": "b"}) is updated
+        bus.publish("received", second, "one")
+        bus.publish("received", second, "two")
+        # Separate messages with the same body are not repeats
+        bus.publish("received", second, "two")
+        bus.publish("registered", second)
+        bus.publish("registered", second)
+        bus.publish("update", second, {"path": "c"})
+        bus.publish("delete", second)
+        assert self.events == []
+        bus.resumeEvents()
+        assert self.events == [("register", "first", None), ("update", "first", {"path": "b"}), ("register", "second", None),
+                               ("received", "second", "one"), ("received", "second", "two"), ("received", "second", "two"),
+                               ("registered", "second", None), ("delete", "second", None)]
+        assert updated.wait(1) == True
+        assert bus.stats()["coalesced"] == 3
+
+    def testFoldedPayloadsCompareByValue(self):
+        bus = self.createEngine({"eventBus": {"fold": ["refresh"]}})
+        resource = Resource("file", "file", None)
+        bus.suspendEvents()
+        folded = bus.publish("refresh", resource, {"a": 1, "b": [1, 2]})
+        assert bus.publish("refresh", resource, {"b": [1, 2], "a": 1}) is folded
+        bus.publish("refresh", resource, {"a": 2})
+        bus.publish("refresh", resource, "a")
+        assert bus.publish("refresh", resource, "a") is not folded
+        bus.resumeEvents()
+        assert self.events == [("refresh", "file", {"a": 1, "b": [1, 2]}), ("refresh", "file", {"a": 2}), ("refresh", "file", "a")]
+        assert bus.stats()["coalesced"] == 2
+
+    def testDebounce(self):
+        bus = self.createEngine({"eventBus": {"debounce": {"update": 0.1}}})
+        resource = Resource("file", "file", None)
+        results = [bus.publish("update", resource, i) for i in range(10)]
+        bus.publish("register", resource)
+        assert self.events == [("register", "file", None)]
+        assert results[-1].wait(2) == True
+        assert self.events == [("register", "file", None), ("update", "file", 9)]
+        assert all(result is results[0] for result in results)
+        assert bus.stats()["debounced"] == 9
+        sleep(0.2)
+        assert len(self.events) == 2
+
+if __name__ == '__main__':
+    unittest.main()
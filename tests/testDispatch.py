@@ -0,0 +1,51 @@
+from engine import Resource, ResourceCondition, EventCondition, DelegatedEventCondition
+from engine.dispatch import DispatchIndex
+
+__author__ = 'Denis Mikhalkin'
+
+import unittest
+
+class Test(unittest.TestCase):
+    def testIndexedLookup(self):
+        index = DispatchIndex()
+        index.add(EventCondition("received"), "any")
+        index.add(EventCondition("received", "sqs"), "sqs")
+        index.add(EventCondition("received", "sqs", "testqueue"), "testqueue")
+        index.add(EventCondition("received", "ec2instance"), "ec2")
+        index.add(DelegatedEventCondition("register", ResourceCondition("sqs")), "register")
+        queue = Resource("testqueue", "sqs", None)
+        other = Resource("otherqueue", "sqs", None)
+
+        assert index.lookup("received", queue) == ["any", "sqs", "testqueue"]
+        assert index.lookup("received", other) == ["any", "sqs"]
+        assert index.lookup("register", queue) == ["register"]
+        assert index.lookup("activate", queue) == []
+        assert index.lookup("received", None) == ["any"]
+
+    def testNonIndexableConditions(self):
+        index = DispatchIndex()
+        under = EventCondition("activated", "tomcat")
+        under.ancestor = "ec2instance"
+        index.add(under, "under")
+        index.add(lambda eventName, resource, payload: payload == "match", "lambda")
+        instance = Resource("appserver1", "ec2instance", None)
+        tomcat = Resource("tomcat", "tomcat", instance)
+
+        assert index.lookup("activated", tomcat, "match") == ["under", "lambda"]
+        assert index.lookup("activated", Resource("tomcat", "tomcat", None)) == []
+
+    def testRemove(self):
+        index = DispatchIndex()
+        first = index.add(EventCondition("received", "sqs"), "first")
+        index.add(EventCondition("received", "sqs"), "second")
+        queue = Resource("testqueue", "sqs", None)
+
+        assert index.remove(first)
+        assert not index.remove(first)
+        assert index.lookup("received", queue) == ["second"]
+        assert index.removeValue("second") == 1
+        assert index.lookup("received", queue) == []
+        assert len(index) == 0
+
+if __name__ == '__main__':
+    unittest.main()
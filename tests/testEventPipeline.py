@@ -0,0 +1,63 @@
+from engine import Engine, Resource, EventCondition
+from engine.pipeline import EventPipeline, PipelineFull
+import logging
+import threading
+from time import sleep
+
+__author__ = 'Denis Mikhalkin'
+
+import unittest
+
+class Test(unittest.TestCase):
+    def tearDown(self):
+        if hasattr(self, "engine"):
+            self.engine.stop()
+
+    def testPerKeyOrdering(self):
+        pipeline = EventPipeline(workers=4)
+        seen = {"a": [], "b": []}
+        finished = threading.Semaphore(0)
+        def task(key, i):
+            def run():
+                sleep(0.001)
+                seen[key].append(i)
+                finished.release()
+            return run
+        for i in range(50):
+            pipeline.submit("a", task("a", i))
+            pipeline.submit("b", task("b", i))
+        for i in range(100):
+            finished.acquire()
+        pipeline.stop()
+        assert seen["a"] == range(50)
+        assert seen["b"] == range(50)
+        assert pipeline.stats()["completed"] == 100
+
+    def testBackpressure(self):
+        pipeline = EventPipeline(workers=1, maxQueueSize=1)
+        release = threading.Event()
+        pipeline.submit("a", release.wait)
+        self.assertRaises(PipelineFull, pipeline.submit, "b", lambda: None, False)
+        self.assertRaises(PipelineFull, pipeline.submit, "b", lambda: None, True, 0.05)
+        release.set()
+        pipeline.submit("b", lambda: None, timeout=5)
+        pipeline.stop()
+        assert pipeline.stats()["rejected"] == 2
+
+    def testAsyncPublish(self):
+        logging.basicConfig()
+        engine = Engine({"eventBus": {"async": True, "workers": 2}})
+        self.engine = engine
+        handled = threading.Event()
+        def handler(eventName, resource, payload):
+            assert engine.eventBus._pipeline.isWorkerThread()
+            handled.set()
+            return True
+        engine.handlerManager.registerOn(handler, EventCondition("received", "sqs"))
+        completed = threading.Event()
+        engine.eventBus.publish("received", Resource("testqueue", "sqs", None), "message").success(completed.set)
+        assert completed.wait(5)
+        assert handled.is_set()
+
+if __name__ == '__main__':
+    unittest.main()
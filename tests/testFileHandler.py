@@ -0,0 +1,129 @@
+from engine import Engine, Resource
+from engine.handlers import FileHandler
+from engine.process import ProcessPool
+from engine.async import ResultObj
+import logging
+import os
+import shutil
+import stat
+import tempfile
+from time import time
+
+__author__ = 'Denis Mikhalkin'
+
+import unittest
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        logging.basicConfig()
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        if hasattr(self, "engine"):
+            self.engine.stop()
+        shutil.rmtree(self.path)
+
+    def writeHandler(self, name, content):
+        fullPath = os.path.join(self.path, name)
+        with open(fullPath, "w") as f:
+            f.write(content)
+        os.chmod(fullPath, stat.S_IRWXU)
+        return fullPath
+
+    def testExitCodeAndTimeout(self):
+        pool = ProcessPool(2)
+        failed = pool.submit(["/bin/sh", "-c", "echo output; exit 3"])
+        assert failed.wait(5) == False
+        assert failed.value["exitCode"] == 3
+        killed = pool.submit(["/bin/sh", "-c", "sleep 10"], timeout=0.2)
+        assert killed.wait(5) == False
+        assert killed.value["timedOut"]
+        pool.stop()
+
+    def testBackgroundChildrenDoNotHoldTheRun(self):
+        pool = ProcessPool(2)
+        started = time()
+        result = pool.submit(["/bin/sh", "-c", "sleep 3 & echo started; exit 0"])
+        assert result.wait(5) == True
+        assert time() - started < 2 and result.value["duration"] < 1
+        pool.stop()
+
+    def testConcurrencyLimitPerKey(self):
+        pool = ProcessPool(4)
+        started = time()
+        assert ResultObj.all_of([pool.submit(["/bin/sleep", "0.2"], key="a", limit=1) for i in range(3)]).wait(5)
+        assert time() - started >= 0.6
+        started = time()
+        assert ResultObj.all_of([pool.submit(["/bin/sleep", "0.2"], key="b") for i in range(3)]).wait(5)
+        assert time() - started < 0.6
+        pool.stop()
+
+    def testHandlerResultFollowsExitCode(self):
+        self.engine = Engine({"processes": {"workers": 2}})
+        handler = FileHandler(self.engine, self.writeHandler("on.received.sqs.sh", "#!/bin/sh\n[ \"$PAYLOAD\" = ok ]\n"))
+        self.engine.handlerManager.registerHandler(handler)
+        queue = Resource("testqueue", "sqs", None)
+        assert self.engine.eventBus.publish("received", queue, "ok").wait(5) == True
+        assert self.engine.eventBus.publish("received", queue, "not ok").wait(5) == False
+
+    def testMetadataIsReadOncePerVersion(self):
+        self.engine = Engine({"processes": {"workers": 2}})
+        fullPath = self.writeHandler("1.on.received.sqs.under.dev.sh", "echo not runnable\n")
+        handler = FileHandler(self.engine, fullPath)
+        assert handler.order == 1 and handler.type == "sh" and handler.condition.ancestor == "dev"
+        assert not handler.isRunnable()
+        metadata = handler.getMetadata()
+        assert handler.getMetadata() is metadata
+        self.writeHandler("1.on.received.sqs.under.dev.sh", "#!/bin/sh\nexit 0\n")
+        os.utime(fullPath, (metadata.mtime + 10, metadata.mtime + 10))
+        assert handler.isRunnable()
+        assert handler.getMetadata().shebang == "/bin/sh"
+
+    def testSameNameInAnotherRepository(self):
+        self.engine = Engine({"processes": {"workers": 2}})
+        fullPath = self.writeHandler("on.activated.tomcat.sh", "#!/bin/sh\n")
+        os.mkdir(os.path.join(self.path, "other"))
+        other = FileHandler(self.engine, self.writeHandler("other/on.activated.tomcat.sh", "#!/bin/sh\n"))
+        handler = FileHandler(self.engine, fullPath)
+        assert handler.condition is not other.condition
+        other.condition.resourceName = "changed"
+        assert handler.condition.resourceName is None
+
+    def testEnvironmentTemplate(self):
+        self.engine = Engine({"processes": {"workers": 2}})
+        handler = FileHandler(self.engine, self.writeHandler("on.received.sqs.under.dev.sh", "#!/bin/sh\n"))
+        queue = Resource("testqueue", "sqs", Resource("dev", "dev", None))
+        env = handler.createEnv(queue, "body")
+        assert env["HANDLER_NAME"] == "on.received.sqs.under.dev" and env["HANDLER_TYPE"] == "sh"
+        assert env["RESOURCE_NAME"] == "testqueue" and env["RESOURCE_ANCESTOR_NAME"] == "dev"
+        assert "RESOURCE_NAME" not in handler._env
+
+    def testPersistentHandler(self):
+        self.engine = Engine({"processes": {"workers": 2}})
+        script = "#!/bin/bash\n# gears: persistent\nwhile read line; do echo \"{\\\"success\\\": true, \\\"pid\\\": $$}\"; done\n"
+        fullPath = self.writeHandler("on.received.sqs.sh", script)
+        handler = FileHandler(self.engine, fullPath)
+        self.engine.handlerManager.registerHandler(handler)
+        queue = Resource("testqueue", "sqs", None)
+        first = self.engine.eventBus.publish("received", queue, "one")
+        second = self.engine.eventBus.publish("received", queue, "two")
+        assert first.wait(5) == True and second.wait(5) == True
+        assert first.value["reply"]["pid"] == second.value["reply"]["pid"]
+        # A new version of the file gets a new worker
+        os.utime(fullPath, (handler.getMetadata().mtime + 10, handler.getMetadata().mtime + 10))
+        third = self.engine.eventBus.publish("received", queue, "three")
+        assert third.wait(5) == True
+        assert third.value["reply"]["pid"] != first.value["reply"]["pid"]
+
+    def testPersistentHandlerSkipsStrayOutput(self):
+        self.engine = Engine({"processes": {"workers": 2}})
+        script = "#!/bin/bash\n# gears: persistent\nwhile read line; do echo \"debug: $line\"; echo 42; echo \"{\\\"success\\\": true, \\\"pid\\\": $$}\"; done\n"
+        handler = FileHandler(self.engine, self.writeHandler("on.received.sqs.sh", script))
+        self.engine.handlerManager.registerHandler(handler)
+        queue = Resource("testqueue", "sqs", None)
+        results = [self.engine.eventBus.publish("received", queue, payload) for payload in ["one", "two", "three"]]
+        assert all(result.wait(5) == True for result in results)
+        assert len(set(result.value["reply"]["pid"] for result in results)) == 1
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+from engine import Engine, Resource, EventCondition
+from engine.metrics import REGISTRY, MetricsRegistry
+from engine.fakeaws import FakeSQSConnection
+from engine.process import ProcessPool
+import logging
+import urllib2
+
+__author__ = 'Denis Mikhalkin'
+
+import unittest
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        logging.basicConfig()
+
+    def tearDown(self):
+        if hasattr(self, "engine"):
+            self.engine.stop()
+
+    def testRender(self):
+        registry = MetricsRegistry()
+        counter = registry.counter("test_total", "Test counter", ["event"])
+        counter.labels("activate").inc()
+        counter.labels("say \"hi\"").inc(2)
+        assert registry.counter("test_total", "Again", ["event"]) is counter
+        histogram = registry.histogram("test_seconds", "Test histogram", buckets=[0.1, 1])
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+        rendered = registry.render().splitlines()
+        assert rendered[:4] == ["# HELP test_total Test counter", "# TYPE test_total counter",
+                                "test_total{event=\"activate\"} 1", "test_total{event=\"say \\\"hi\\\"\"} 2"]
+        assert "test_seconds_bucket{le=\"0.1\"} 1" in rendered
+        assert "test_seconds_bucket{le=\"1\"} 2" in rendered
+        assert "test_seconds_bucket{le=\"+Inf\"} 3" in rendered
+        assert "test_seconds_count 3" in rendered
+        assert "test_seconds_sum 5.55" in rendered
+
+    def testEngineMetrics(self):
+        self.engine = Engine({})
+        calls = REGISTRY.get("gears_handler_calls_total")
+        seconds = REGISTRY.get("gears_handler_seconds")
+        def onPing(eventName, resource, payload):
+            return payload == "ok"
+        self.engine.handlerManager.registerOn(onPing, EventCondition("ping", "node"))
+        node = Resource("node", "node", self.engine.resourceManager.root)
+        self.engine.resourceManager.addResource(node)
+        name = "%s.onPing" % __name__
+        before = (calls.get("ping", name, "success"), calls.get("ping", name, "failure"), seconds.get("ping", name)[0])
+        self.engine.eventBus.publish("ping", node, "ok")
+        self.engine.eventBus.publish("ping", node, "not ok")
+        assert calls.get("ping", name, "success") == before[0] + 1
+        assert calls.get("ping", name, "failure") == before[1] + 1
+        assert seconds.get("ping", name)[0] == before[2] + 2
+
+        rendered = REGISTRY.render()
+        assert "gears_events_dispatched_total{event=\"ping\"}" in rendered
+        assert "gears_resources{state=\"REGISTERED\"}" in rendered
+        self.engine.stop()
+        del self.engine
+        assert "gears_resources{" not in REGISTRY.render()
+
+    def testAWSAndProcessMetrics(self):
+        self.engine = Engine({})
+        conn = FakeSQSConnection()
+        conn.create_queue("metrics")
+        self.engine.connections.setFactory("sqs", lambda region, **kwargs: conn)
+        calls = REGISTRY.get("gears_aws_calls_total")
+        before = calls.get("sqs", "get_messages", "success")
+        queue = self.engine.connections.get("sqs", "local").lookup("metrics")
+        queue.get_messages(num_messages=10)
+        assert calls.get("sqs", "get_messages", "success") == before + 1
+
+        pool = ProcessPool(1)
+        exits = REGISTRY.get("gears_process_exits_total")
+        before = exits.get("/bin/sh", 3)
+        assert pool.submit(["/bin/sh", "-c", "exit 3"]).wait(5) == False
+        assert exits.get("/bin/sh", 3) == before + 1
+        pool.stop()
+
+    def testEndpoint(self):
+        self.engine = Engine({"metrics": {"port": 0, "host": "127.0.0.1"}, "query": {"enabled": False}})
+        self.engine.start()
+        server = self.engine.getService("metricsServer", None)
+        response = urllib2.urlopen("http://127.0.0.1:%d/metrics" % server.port, timeout=5)
+        assert response.getcode() == 200
+        assert response.info()["Content-Type"].startswith("text/plain; version=0.0.4")
+        assert "# TYPE gears_resources gauge" in response.read()
+        self.engine.stop()
+        del self.engine
+        assert "gears_resources" not in REGISTRY.render()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+from engine import Engine, Resource
+from engine.handlers import FileHandler
+from engine.query import AttributePath, CLIENT
+import json
+import logging
+import os
+import shutil
+import socket
+import stat
+import subprocess
+import sys
+import tempfile
+
+__author__ = 'Denis Mikhalkin'
+
+import unittest
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        logging.basicConfig()
+        self.path = tempfile.mkdtemp()
+        self.engine = Engine({"query": {"socket": os.path.join(self.path, "gears.sock")}})
+        self.server = Resource("server", "ec2instance", self.engine.resourceManager.root,
+                               desc={"key-name": "mykey", "login": "ec2-user", "security-groups": ["Dev", "Web"]})
+        self.engine.resourceManager.addResource(self.server)
+        self.engine.start()
+        self.server.dynamicState = {"privateIP": "10.0.0.1"}
+
+    def tearDown(self):
+        self.engine.stop()
+        shutil.rmtree(self.path)
+
+    def client(self, *args):
+        process = subprocess.Popen([sys.executable, CLIENT] + list(args), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   env={"GEARS_SOCKET": self.engine.querySocket})
+        (output, errors) = process.communicate()
+        return (process.returncode, output)
+
+    def testAttributePath(self):
+        assert AttributePath.compile("desc/key-name") is AttributePath.compile("desc/key-name")
+        assert AttributePath("desc/security-groups/1").get(self.server) == "Web"
+        assert AttributePath("state").get(self.server) == "ACTIVATED"
+        assert AttributePath("desc/missing/key").get(self.server) is None
+        self.assertRaises(ValueError, AttributePath, "children")
+
+    def testClient(self):
+        assert self.client("get-resource-attribute", "server", "desc/key-name", "desc/login", "dynamicState/privateIP") == \
+               (0, "mykey\nec2-user\n10.0.0.1\n")
+        assert self.client("get-resource-attribute", "server", "desc/missing") == (0, "\n")
+        assert self.client("get-resource-attribute", "nothere", "desc/key-name")[0] == 1
+        assert self.client("get-resource-attribute", "server", "children")[0] == 1
+
+    def testBatch(self):
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(self.engine.querySocket)
+        replies = connection.makefile("rb")
+        request = [{"resources": ["server", "root", "nothere"], "attributes": ["type", "desc/login"]},
+                   {"resources": ["server"], "attributes": ["dynamicState"]}]
+        for i in range(2):
+            connection.sendall(json.dumps(request) + "\n")
+            reply = json.loads(replies.readline())
+            assert reply[0]["values"] == {"server": {"type": "ec2instance", "desc/login": "ec2-user"},
+                                          "root": {"type": "root", "desc/login": None},
+                                          "nothere": {"type": None, "desc/login": None}}
+            assert reply[0]["missing"] == ["nothere"]
+            assert reply[1]["values"]["server"]["dynamicState"] == {"privateIP": "10.0.0.1"}
+        connection.close()
+
+    def testHandlerEnvironment(self):
+        output = os.path.join(self.path, "output")
+        fullPath = os.path.join(self.path, "on.deployed.ec2instance.sh")
+        with open(fullPath, "w") as f:
+            f.write("#!/bin/sh\n$DEVOPSGEARS get-resource-attribute $RESOURCE_NAME dynamicState/privateIP > %s\n" % output)
+        os.chmod(fullPath, stat.S_IRWXU)
+        self.engine.handlerManager.registerHandler(FileHandler(self.engine, fullPath))
+        assert self.engine.eventBus.publish("deployed", self.server).wait(5) == True
+        with open(output) as f:
+            assert f.read() == "10.0.0.1\n"
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+from engine import Engine, Resource, EventCondition
+from engine.handlers import FileHandler
+from engine.remote import RemoteExecutor, OutputBatch
+import logging
+import os
+import shutil
+import stat
+import tempfile
+import threading
+from time import time
+
+__author__ = 'Denis Mikhalkin'
+
+import unittest
+
+# Stands in for ssh: skips the options, logs the destination and runs the command locally
+SSH = """#!/bin/sh
+while [ $# -gt 0 ]; do
+    case "$1" in
+        -o|-i|-O|-p|-l|-S) shift 2;;
+        -*) shift;;
+        *) break;;
+    esac
+done
+echo "$1" >> %(log)s
+shift
+[ $# -eq 0 ] && exit 0
+sleep %(delay)s
+exec sh -c "$*"
+"""
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        logging.basicConfig()
+        self.path = tempfile.mkdtemp()
+        self.log = os.path.join(self.path, "ssh.log")
+
+    def tearDown(self):
+        if hasattr(self, "engine"):
+            self.engine.stop()
+        shutil.rmtree(self.path)
+
+    def writeFile(self, name, content):
+        fullPath = os.path.join(self.path, name)
+        with open(fullPath, "w") as f:
+            f.write(content)
+        os.chmod(fullPath, stat.S_IRWXU)
+        return fullPath
+
+    def createEngine(self, delay=0, concurrency=16):
+        ssh = self.writeFile("ssh", SSH % {"log": self.log, "delay": delay})
+        self.engine = Engine({"remote": {"ssh": [ssh], "concurrency": concurrency}, "query": {"enabled": False}})
+        return self.engine
+
+    def createInstance(self, name, ip):
+        instance = Resource(name, "ec2instance", self.engine.resourceManager.root, desc={"key-name": "mykey", "login": "admin"})
+        instance.dynamicState = {"privateIP": ip}
+        app = Resource(name + "-app", "app", instance)
+        self.engine.resourceManager.registerResource(instance)
+        self.engine.resourceManager.registerResource(app)
+        return app
+
+    def testSshCommand(self):
+        self.createEngine()
+        app = self.createInstance("server", "10.0.0.1")
+        remote = RemoteExecutor(self.engine)
+        command = remote.sshCommand(remote.getInstance(app))
+        assert command[-1] == "admin@10.0.0.1"
+        assert "ControlMaster=auto" in command and "ControlPersist=600" in command
+
+    def testExecutePublishesOutputAsEvents(self):
+        self.createEngine()
+        app = self.createInstance("server", "10.0.0.1")
+        events = list()
+        self.engine.handlerManager.registerOn(lambda eventName, resource, payload: events.append((eventName, resource.name, payload)) or True,
+                                              EventCondition("output", "app"))
+        executed = threading.Event()
+        self.engine.handlerManager.registerOn(lambda eventName, resource, payload: events.append((eventName, resource.name, payload)) or executed.set() or True,
+                                              EventCondition("executed", "app"))
+        script = self.writeFile("deploy.sh", "#!/bin/sh\necho \"deploying $VERSION\"\necho done\nexit 3\n")
+        result = RemoteExecutor(self.engine).execute(app, script, {"VERSION": "1.0 beta"})
+        assert result.wait(5) == False
+        assert result.value["exitCode"] == 3 and result.value["host"] == "10.0.0.1"
+        assert executed.wait(5)
+        assert events[:1] == [("output", "server-app", {"lines": ["deploying 1.0 beta", "done"], "host": "10.0.0.1", "script": "deploy.sh"})]
+        assert events[1][0] == "executed" and events[1][2]["exitCode"] == 3
+
+    def testOutputIsPublishedInBatches(self):
+        batches = list()
+        output = OutputBatch(batches.append, 2)
+        for line in ["a", "b", "c"]:
+            output.add(line)
+        assert batches == [["a", "b"]]
+        output.close()
+        output.add("d")
+        output.close()
+        assert batches == [["a", "b"], ["c"]]
+
+    def testFanOutIsParallel(self):
+        self.createEngine(delay=0.3, concurrency=10)
+        apps = [self.createInstance("server%d" % i, "10.0.0.%d" % i) for i in range(10)]
+        script = self.writeFile("check.sh", "#!/bin/sh\nexit 0\n")
+        remote = RemoteExecutor(self.engine)
+        started = time()
+        assert remote.executeAll(apps, script).wait(10) == True
+        assert time() - started < 2
+        remote.stop()
+        with open(self.log) as f:
+            destinations = f.read().split()
+        # One run and one closed master connection per instance
+        assert sorted(destinations) == sorted(["admin@10.0.0.%d" % i for i in range(10)] * 2)
+
+    def testRemoteFileHandler(self):
+        self.createEngine()
+        app = self.createInstance("server", "10.0.0.1")
+        output = os.path.join(self.path, "output")
+        handler = FileHandler(self.engine, self.writeFile("on.deploy.app.sh", "#!/bin/sh\n# gears: remote\necho $RESOURCE_NAME > %s\n" % output))
+        assert handler.getMetadata().remote
+        self.engine.handlerManager.registerHandler(handler)
+        assert self.engine.eventBus.publish("deploy", app).wait(5) == True
+        with open(output) as f:
+            assert f.read() == "server-app\n"
+        with open(self.log) as f:
+            assert f.read() == "admin@10.0.0.1\n"
+
+    def testNoInstance(self):
+        self.createEngine()
+        script = self.writeFile("check.sh", "#!/bin/sh\nexit 0\n")
+        assert RemoteExecutor(self.engine).execute(Resource("app", "app", None), script).wait(1) == False
+
+if __name__ == '__main__':
+    unittest.main()
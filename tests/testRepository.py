@@ -0,0 +1,150 @@
+from engine import Engine, EventCondition
+from engine.watcher import PollingWatcher, CHANGED, DELETED
+from engine.resources import DescriptorParser
+import logging
+import os
+import shutil
+import tempfile
+
+__author__ = 'Denis Mikhalkin'
+
+import unittest
+
+QUEUE = """name: %s
+type: sqs
+desc:
+  region: ap-southeast-2
+  queueName: %s
+"""
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        logging.basicConfig()
+        self.path = tempfile.mkdtemp()
+        self.write("queue1.sqs", QUEUE % ("queue1", "queue1"))
+        self.write(".git/config", "ignored")
+
+    def tearDown(self):
+        if hasattr(self, "engine"):
+            self.engine.stop()
+        shutil.rmtree(self.path)
+
+    def write(self, name, content):
+        fullPath = os.path.join(self.path, name)
+        if not os.path.exists(os.path.dirname(fullPath)):
+            os.makedirs(os.path.dirname(fullPath))
+        with open(fullPath, "w") as f:
+            f.write(content)
+        # Make sure the change is visible even with coarse mtime resolution
+        stat = os.stat(fullPath)
+        os.utime(fullPath, (stat.st_atime, stat.st_mtime + 10))
+        return fullPath
+
+    def testPollingWatcherDetectsChanges(self):
+        changes = []
+        watcher = PollingWatcher(self.path, changes.extend, None)
+        watcher._files = watcher.snapshot()
+        queue2 = self.write("sub/queue2.sqs", QUEUE % ("queue2", "queue2"))
+        queue1 = self.write("queue1.sqs", QUEUE % ("queue1", "renamed"))
+        os.remove(queue2)
+        watcher.check()
+        assert changes == [(CHANGED, queue1)]
+        os.remove(queue1)
+        watcher.check()
+        assert changes[1:] == [(DELETED, queue1)]
+
+    def testChangesRaiseEvents(self):
+        engine = Engine({"repositoryPath": self.path, "watchRepository": "polling", "watchPeriod": 3600})
+        self.engine = engine
+        events = []
+        for eventName in ["registered", "update", "delete"]:
+            engine.handlerManager.registerOn(lambda eventName, resource, payload: events.append((eventName, resource.name)) or True,
+                                             EventCondition(eventName, "sqs"))
+        engine.start()
+        assert engine.resourceManager.getResource("queue1") is not None
+        assert len(engine.repository._resources) == 1
+        del events[:]
+
+        queue1 = self.write("queue1.sqs", QUEUE % ("queue1", "renamed"))
+        queue2 = self.write("queue2.sqs", QUEUE % ("queue2", "queue2"))
+        engine.repository._watcher.check()
+        assert events == [("update", "queue1"), ("registered", "queue2")]
+        assert engine.resourceManager.getResource("queue1").desc["queueName"] == "renamed"
+
+        os.remove(queue2)
+        engine.repository._watcher.check()
+        assert events[2:] == [("delete", "queue2")]
+        assert engine.resourceManager.getResource("queue2") is None
+
+    def testBehaviorChangeRegistersAgain(self):
+        engine = Engine({"repositoryPath": self.path, "watchRepository": "polling", "watchPeriod": 3600})
+        self.engine = engine
+        engine.start()
+        queue = engine.resourceManager.getResource("queue1")
+        self.write("queue1.sqs", QUEUE % ("queue1", "queue1") + "behavior: engine.handlers.EC2InstanceHandler\nraises: arrived\n")
+        engine.repository._watcher.check()
+        updated = engine.resourceManager.getResource("queue1")
+        assert updated is not queue and updated.raisesEvents == ["arrived"]
+        assert "engine.handlers.EC2InstanceHandler" in engine.handlerManager._behaviors
+
+        # A change to desc alone is applied in place
+        self.write("queue1.sqs", QUEUE % ("queue1", "renamed") + "behavior: engine.handlers.EC2InstanceHandler\nraises: arrived\n")
+        engine.repository._watcher.check()
+        assert engine.resourceManager.getResource("queue1") is updated and updated.desc["queueName"] == "renamed"
+
+    def testDeletedDirectoryTakesItsContent(self):
+        queue2 = self.write("sub/queue2.sqs", QUEUE % ("queue2", "queue2"))
+        handler = self.write("sub/deeper/on.received.sqs.sh", "#!/bin/bash\n")
+        engine = Engine({"repositoryPath": self.path, "watchRepository": "polling", "watchPeriod": 3600})
+        self.engine = engine
+        engine.start()
+        assert engine.resourceManager.getResource("queue2") is not None
+        shutil.rmtree(os.path.join(self.path, "sub"))
+        # What inotify reports for a directory that is deleted or moved away
+        engine.repository.applyChanges([(DELETED, os.path.join(self.path, "sub"))])
+        assert engine.resourceManager.getResource("queue2") is None
+        assert engine.repository.getFileResource(queue2) is None and engine.repository.getFileHandler(handler) is None
+        assert engine.resourceManager.getResource("queue1") is not None
+
+    def testHandlerChanges(self):
+        engine = Engine({"repositoryPath": self.path, "watchRepository": "polling", "watchPeriod": 3600})
+        self.engine = engine
+        engine.start()
+        queue = engine.resourceManager.getResource("queue1")
+        handler = self.write("on.received.sqs.sh", "#!/bin/bash\n")
+        engine.repository._watcher.check()
+        assert len(engine.handlerManager.getHandlers("received", queue)) == 1
+        os.remove(handler)
+        engine.repository._watcher.check()
+        assert len(engine.handlerManager.getHandlers("received", queue)) == 0
+
+    def testParseCache(self):
+        for i in range(2, 80):
+            self.write("queues/queue%d.sqs" % i, QUEUE % ("queue%d" % i, "queue%d" % i))
+        cachePath = os.path.join(self.path, ".parsecache")
+        config = {"repositoryPath": self.path, "parseCache": cachePath, "parseProcesses": 2, "parallelParseThreshold": 10}
+        engine = Engine(config)
+        assert engine.repository.stats["parsed"] == 79
+        assert engine.repository.stats["processes"] == 2
+        assert engine.resourceManager.getResource("queue79").desc["queueName"] == "queue79"
+        engine.stop()
+
+        self.write("queue1.sqs", QUEUE % ("queue1", "renamed"))
+        self.engine = Engine(config)
+        assert self.engine.repository.stats["parsed"] == 1
+        assert self.engine.repository.stats["cacheHits"] == 78
+        assert self.engine.resourceManager.getResource("queue1").desc["queueName"] == "renamed"
+        assert self.engine.resourceManager.getResource("queue79").desc["queueName"] == "queue79"
+
+    def testParserStats(self):
+        queue1 = os.path.join(self.path, "queue1.sqs")
+        missing = os.path.join(self.path, "missing.sqs")
+        parser = DescriptorParser(processes=2, parallelThreshold=1)
+        parser.parseAll([queue1, missing])
+        # Without parallel=True nothing is forked, whatever the threshold
+        assert parser.stats["parsed"] == 1 and parser.stats["processes"] == 1
+        parser.parseAll([queue1, missing])
+        assert parser.stats["cacheHits"] == 1 and parser.stats["missing"] == 1 and parser.stats["parsed"] == 0
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+from engine import Engine, Resource, ResourceCondition, EventCondition
+import logging
+import threading
+from time import time
+
+__author__ = 'Denis Mikhalkin'
+
+import unittest
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        logging.basicConfig()
+        self.engine = Engine({})
+
+    def tearDown(self):
+        self.engine.stop()
+
+    def testWaitForStateWakesOnTransition(self):
+        resource = Resource("testqueue", "sqs", self.engine.resourceManager.root)
+        resource.engine = self.engine
+        threading.Timer(0.05, resource.toState("ACTIVATED")).start()
+        started = time()
+        assert resource.waitForState("ACTIVATED", 5)
+        assert time() - started < 1
+
+    def testWaitForStateTimeout(self):
+        resource = Resource("testqueue", "sqs", self.engine.resourceManager.root)
+        assert not resource.waitForState("ACTIVATED", 0.05)
+
+    def testWaitForStates(self):
+        resources = [Resource("queue%d" % i, "sqs", self.engine.resourceManager.root) for i in range(50)]
+        for resource in resources:
+            resource.engine = self.engine
+        def activate():
+            for resource in resources:
+                resource.toState("ACTIVATED")()
+        threading.Timer(0.05, activate).start()
+        assert self.engine.resourceManager.waitForStates(resources, "ACTIVATED", 5)
+        assert not self.engine.resourceManager.waitForStates(resources, "FAILED", 0.05)
+
+    def testMatchingResourcesFromIndexes(self):
+        manager = self.engine.resourceManager
+        env = Resource("dev", "env", None)
+        server = Resource("server1", "ec2instance", env)
+        manager.registerResource(env)
+        manager.registerResource(server)
+        for i in range(3):
+            manager.registerResource(Resource("app%d" % i, "app", server, altName="alias%d" % i))
+        manager.registerResource(Resource("orphan", "app", None))
+        assert len(manager.getMatchingResources(ResourceCondition("app"))) == 4
+        assert [r.name for r in manager.getMatchingResources(ResourceCondition("app", "app1"))] == ["app1"]
+        under = ResourceCondition("app")
+        under.ancestor = "env"
+        assert [r.name for r in manager.getMatchingResources(under)] == ["app0", "app1", "app2"]
+        inside = EventCondition("activated", "app")
+        inside.parent = "ec2instance"
+        assert len(manager.getMatchingResources(inside)) == 3
+        assert [r.name for r in manager.getChildren(server)] == ["app0", "app1", "app2"]
+        manager.removeResource(manager.getResource("app1"))
+        assert [r.name for r in manager.getMatchingResources(under)] == ["app0", "app2"]
+        assert [r.name for r in manager.getChildren(server)] == ["app0", "app2"]
+
+    def testRemovedParentReleasesDescendants(self):
+        manager = self.engine.resourceManager
+        env = Resource("dev", "env", None)
+        server = Resource("server1", "ec2instance", env)
+        app = Resource("app", "app", server)
+        for resource in [env, server, app]:
+            manager.registerResource(resource)
+        under = ResourceCondition("app")
+        under.ancestor = "ec2instance"
+        assert manager.getMatchingResources(under) == [app]
+        manager.removeResource(server)
+        assert manager.getMatchingResources(under) == [] and app.parentResource is None
+        assert "ec2instance" not in manager._byAncestorType and "env" not in manager._byAncestorType
+        # Registered under the same name again, the server takes its children back
+        replacement = Resource("server1", "ec2instance", env)
+        manager.registerResource(replacement)
+        assert manager.getMatchingResources(under) == [app] and app.parentResource is replacement
+        assert manager.getChildren(replacement) == [app]
+
+    def testCompactResource(self):
+        resource = Resource("server1", "ec2instance", "dev", desc={"region": "local", "security-groups": ["default"]})
+        assert not hasattr(resource, "__dict__")
+        assert resource.state["name"] == "INVALID" and resource.state.order == -2
+        assert resource.state is Resource.STATES["INVALID"]
+        assert resource.desc == {"region": "local", "security-groups": ["default"]}
+        resource.desc["region"] = "changed"
+        assert resource.desc["region"] == "changed"
+        assert resource.type is Resource("server2", "".join(["ec2", "instance"]), None).type
+
+    def testBehaviorIsRegisteredOncePerClass(self):
+        import engine
+        loaded = list()
+        getClass = engine.get_class
+        engine.get_class = lambda path: loaded.append(path) or getClass(path)
+        try:
+            before = len(self.engine.handlerManager.handlers)
+            for i in range(200):
+                self.engine.resourceManager.registerResource(Resource("queue%d" % i, "sqs", self.engine.resourceManager.root,
+                                                                      desc={"region": "local", "queueName": "queue%d" % i},
+                                                                      behavior=["engine.handlers.SQSHandler", "engine.handlers.EC2InstanceHandler"]))
+        finally:
+            engine.get_class = getClass
+        assert loaded == ["engine.handlers.SQSHandler", "engine.handlers.EC2InstanceHandler"]
+        # subscribe for SQSHandler, register and activate for EC2InstanceHandler
+        assert len(self.engine.handlerManager.handlers) == before + 3
+        handler = self.engine.handlerManager.getBehavior("engine.handlers.SQSHandler")
+        assert self.engine.handlerManager.getHandlers("subscribe", Resource("queue0", "sqs", None)) == [handler]
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+from engine.async import ResultObj
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+__author__ = 'Denis Mikhalkin'
+
+import unittest
+
+class Test(unittest.TestCase):
+    def testCallbacksAreNotLost(self):
+        for attempt in range(20):
+            result = ResultObj()
+            calls = []
+            start = threading.Event()
+            def register():
+                start.wait()
+                for i in range(100):
+                    result.success(lambda: calls.append(1))
+            threads = [threading.Thread(target=register) for i in range(4)]
+            for thread in threads: thread.start()
+            start.set()
+            result.trigger(True)
+            for thread in threads: thread.join()
+            assert len(calls) == 400
+
+    def testAllOfWaitsForPending(self):
+        first = ResultObj()
+        second = ResultObj()
+        combined = ResultObj.all_of([first, ResultObj(True), second])
+        assert not combined.done()
+        first.trigger(True)
+        assert combined.wait(0.01) is None
+        second.trigger(False)
+        assert combined.wait(1) == False
+        assert ResultObj.all_of([]).wait() == True
+
+    def testAnyOf(self):
+        first = ResultObj()
+        second = ResultObj()
+        combined = ResultObj.any_of([first, second])
+        first.trigger(False)
+        assert not combined.done()
+        second.trigger(True)
+        assert combined.wait(1) == True
+        assert ResultObj.any_of([ResultObj(False)]).wait(1) == False
+
+    def testTriggerOnceAndChaining(self):
+        source = ResultObj()
+        target = ResultObj().trigger(source)
+        failures = []
+        target.failure(lambda: failures.append(1))
+        source.trigger(False)
+        source.trigger(True)
+        assert target.wait(1) == False
+        assert source.wait(1) == False
+        assert failures == [1]
+
+    def testExecutorCallbacks(self):
+        executor = ThreadPoolExecutor(1)
+        ran = []
+        done = threading.Event()
+        def callback():
+            ran.append(threading.current_thread())
+            done.set()
+        ResultObj(True).success(callback, executor)
+        assert done.wait(1)
+        assert ran[0] is not threading.current_thread()
+        executor.shutdown()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+from engine.handlers import SQSHandler, SQSConsumer
+from engine.fakeaws import FakeSQSConnection, FakeBatchResults
+from engine import Engine, ResourceCondition, Resource, EventCondition
+from engine.resources import FileResource
+import logging
+import threading
+
+__author__ = 'Denis Mikhalkin'
+
+import unittest
+
+class Test(unittest.TestCase):
+    def tearDown(self):
+        if hasattr(self, "engine"):
+            self.engine.stop()
+
+    def testBatchedConsumer(self):
+        logging.basicConfig()
+        engine = Engine({"sqs": {"consumer": True, "concurrency": 2, "waitTimeSeconds": 1}})
+        self.engine = engine
+        conn = FakeSQSConnection()
+        queue = conn.create_queue("testqueue")
+        for i in range(100):
+            queue.write(queue.new_message("message %d" % i))
+
+        engine.connections.setFactory("sqs", lambda region, **kwargs: conn)
+        engine.handlerManager.registerSubscribe(SQSHandler(engine), ResourceCondition(resourceType="sqs"))
+        engine.resourceManager.addResource(Resource("testqueue", "sqs", engine.resourceManager.root, desc=dict(region="local", queueName="testqueue"), raisesEvents=["received"]))
+        received = []
+        allReceived = threading.Event()
+        def onReceived(eventName, resource, payload):
+            received.append(payload)
+            if len(received) == 100:
+                allReceived.set()
+            return True
+        engine.handlerManager.registerOn(onReceived, EventCondition(eventName="received", resourceType="sqs"))
+
+        engine.start()
+        assert allReceived.wait(10)
+        assert sorted(received) == sorted("message %d" % i for i in range(100))
+        assert queue.count() == 0
+        # 100 writes + one cached lookup + 10 receives and 10 batch deletes, plus a few trailing empty polls
+        assert conn.requests < 100 + 2 + 20 + 6, conn.requests
+
+    def testOnlyDeletedMessagesAreCounted(self):
+        engine = Engine({"query": {"enabled": False}})
+        self.engine = engine
+        conn = FakeSQSConnection()
+        queue = conn.create_queue("testqueue")
+        for i in range(3):
+            queue.write(queue.new_message("message %d" % i))
+        resource = Resource("testqueue", "sqs", engine.resourceManager.root, desc=dict(region="local", queueName="testqueue"))
+        consumer = SQSConsumer(engine.eventBus, resource, "received", conn)
+        messages = queue.get_messages(num_messages=3)
+        # Already deleted, so its receipt handle is no longer valid
+        queue.delete_message_batch(messages[:1])
+        consumer._process(queue, messages)
+        assert consumer.received == 3 and consumer.deleted == 2
+        # One failed attempt, then the retry went through
+        failures = []
+        def failOnce(messages):
+            if len(failures) == 0:
+                failures.append(messages)
+                raise IOError("connection reset")
+            return FakeBatchResults([{"id": message.id} for message in messages], [])
+        queue.write(queue.new_message("message 3"))
+        queue.delete_message_batch = failOnce
+        consumer._process(queue, queue.get_messages(num_messages=1))
+        assert consumer.received == 4 and consumer.deleted == 3
+
+    def testOnlyRaisedEventsStartConsumers(self):
+        engine = Engine({"sqs": {"consumer": True, "waitTimeSeconds": 1}})
+        self.engine = engine
+        conn = FakeSQSConnection()
+        conn.create_queue("testqueue")
+        connected = []
+        engine.connections.setFactory("sqs", lambda region, **kwargs: connected.append(region) or conn)
+        handler = SQSHandler(engine)
+        queue = Resource("testqueue", "sqs", engine.resourceManager.root, desc=dict(region="local", queueName="testqueue"))
+        # Subscriptions to conditions without a type, like the engine's own "activated" one, reach queues too
+        assert handler.handleSubscribe(queue, {"eventName": "activated"}) == True
+        assert connected == []
+        assert handler.handleSubscribe(queue, {"eventName": "received"}) == True
+        assert connected == ["local"]
+
+        queue.raisesEvents = ["arrived"]
+        assert handler.handleSubscribe(queue, {"eventName": "received"}) == True
+        assert connected == ["local"]
+
+    def testRaisesFromDescriptor(self):
+        assert FileResource("/repo/queue.sqs", {"type": "sqs", "raises": "arrived"}).raisesEvents == ["arrived"]
+        assert FileResource("/repo/queue.sqs", {"type": "sqs", "raises": ["arrived", "left"]}).raisesEvents == ["arrived", "left"]
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+from engine import Engine
+import logging
+import threading
+from time import time, sleep
+
+__author__ = 'Denis Mikhalkin'
+
+import unittest
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        logging.basicConfig()
+        self.engine = Engine({"scheduler": {"executors": {"aws": 1}, "jitter": 0}})
+
+    def tearDown(self):
+        self.engine.stop()
+
+    def testSlowJobDoesNotDelayOtherExecutors(self):
+        scheduler = self.engine.scheduler
+        polled = threading.Event()
+        slow = scheduler.schedule("slow describe", lambda: sleep(1), 0.1, executor="aws")
+        poll = scheduler.schedule("queue poll", polled.set, 0.2, executor="io")
+        started = time()
+        assert polled.wait(2)
+        assert time() - started < 0.5
+        stats = scheduler.stats()
+        assert stats[slow.id]["executor"] == "aws"
+        assert stats[poll.id]["executor"] == "io" and stats[poll.id]["name"] == "queue poll"
+
+    def testStatsAndJitter(self):
+        scheduler = self.engine.scheduler
+        job = scheduler.schedule("job", lambda: None, 0.1, jitter=0.05)
+        assert job.trigger.jitter == 0.05
+        sleep(0.5)
+        stats = scheduler.stats()[job.id]
+        assert stats["runs"] >= 2
+        assert stats["lastLag"] is not None and stats["lastLag"] < 0.1
+        scheduler.reschedule(job, 0.2)
+        assert abs(job.trigger.jitter - 0.1) < 1e-9
+        scheduler.unschedule(job)
+        assert job.id not in scheduler.stats()
+
+    def testJobsWithTheSameName(self):
+        scheduler = self.engine.scheduler
+        failing = scheduler.schedule("monitor", lambda: 1 / 0, 0.1)
+        working = scheduler.schedule("monitor", lambda: None, 0.1)
+        sleep(0.35)
+        stats = scheduler.stats()
+        assert stats[failing.id]["errors"] >= 2 and stats[failing.id]["errors"] == stats[failing.id]["runs"]
+        assert stats[working.id]["runs"] >= 2 and stats[working.id]["errors"] == 0
+
+    def testUnknownExecutorFallsBackToDefault(self):
+        job = self.engine.scheduler.schedule("job", lambda: None, 60, executor="missing")
+        assert job.executor == "default"
+
+if __name__ == '__main__':
+    unittest.main()
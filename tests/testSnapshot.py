@@ -0,0 +1,118 @@
+from engine import Engine, Resource, Packed
+from engine.snapshot import Snapshot
+from engine.fakeaws import FakeEC2Connection
+import logging
+import os
+import shutil
+import stat
+import tempfile
+from time import sleep
+
+__author__ = 'Denis Mikhalkin'
+
+import unittest
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        logging.basicConfig()
+        self.path = tempfile.mkdtemp()
+        self.conn = FakeEC2Connection()
+        self.config = {"snapshotPath": os.path.join(self.path, "snapshot"), "ec2": {"monitorPeriod": 0.05, "launchBatchWindow": 0}}
+
+    def tearDown(self):
+        if hasattr(self, "engine"):
+            self.engine.stop()
+        shutil.rmtree(self.path)
+
+    def startEngine(self, imageId="ami-1"):
+        engine = Engine(self.config)
+        self.engine = engine
+        engine.connections.setFactory("ec2", lambda region, **kwargs: self.conn)
+        engine.handlerManager.registerHandler("engine.handlers.EC2InstanceHandler")
+        instance = Resource("testinstance", "ec2instance", engine.resourceManager.root,
+                            desc={"region": "local", "image-id": imageId, "instance-type": "t2.micro",
+                                  "key-name": "key", "security-groups": ["default"]})
+        engine.resourceManager.addResource(instance)
+        engine.start()
+        return (engine, instance)
+
+    def testWarmRestartSkipsActivation(self):
+        (engine, instance) = self.startEngine()
+        assert instance.waitForState("ACTIVATED", 5)
+        privateIP = instance.dynamicState["privateIP"]
+        engine.stop()
+
+        requests = self.conn.requests
+        (engine, instance) = self.startEngine()
+        assert instance.isState("ACTIVATED")
+        assert instance.dynamicState["privateIP"] == privateIP
+        assert self.conn.requests == requests
+
+    def testSavedWhileRunning(self):
+        self.config["snapshotPeriod"] = 0.1
+        (engine, instance) = self.startEngine()
+        assert instance.waitForState("ACTIVATED", 5)
+        for i in range(50):
+            snapshot = Snapshot.load(self.config["snapshotPath"])
+            if snapshot is not None and snapshot.resources.get("testinstance", {}).get("state") == "ACTIVATED": break
+            sleep(0.1)
+        assert snapshot.resources["testinstance"]["dynamicState"]["privateIP"] == instance.dynamicState["privateIP"]
+
+    def testDescIsComparedPacked(self):
+        (engine, instance) = self.startEngine()
+        assert instance.waitForState("ACTIVATED", 5)
+        engine.stop()
+        del self.engine
+
+        snapshot = Snapshot.load(self.config["snapshotPath"])
+        copy = Resource("testinstance", "ec2instance", "root", desc=instance.desc)
+        assert snapshot.restorableState(copy) is not None
+        assert type(copy._desc) is Packed
+        copy.desc = dict(instance.desc, **{"image-id": "ami-2"})
+        assert snapshot.restorableState(copy) is None
+
+    def testChangedResourceIsActivatedAgain(self):
+        (engine, instance) = self.startEngine()
+        assert instance.waitForState("ACTIVATED", 5)
+        engine.stop()
+
+        describes = self.conn.requestsByAction["DescribeInstances"]
+        (engine, instance) = self.startEngine("ami-2")
+        assert instance.waitForState("ACTIVATED", 5)
+        # Re-activation attaches to the instance that is already running under this name
+        assert self.conn.requestsByAction["DescribeInstances"] > describes
+
+    def testNewHandlerRunsForRestoredResource(self):
+        repository = os.path.join(self.path, "repository")
+        os.mkdir(repository)
+        self.config.update(repositoryPath=repository, query={"enabled": False})
+        def startEngine():
+            self.engine = Engine(self.config)
+            app = Resource("app1", "app", self.engine.resourceManager.root)
+            self.engine.resourceManager.addResource(app)
+            self.engine.start()
+            assert app.waitForState("ACTIVATED", 5)
+            return self.engine
+        startEngine().stop()
+
+        output = os.path.join(self.path, "output")
+        handler = os.path.join(repository, "on.activated.app.sh")
+        with open(handler, "w") as f:
+            f.write("#!/bin/sh\necho $RESOURCE_NAME >> %s\n" % output)
+        os.chmod(handler, stat.S_IRWXU)
+        startEngine()
+        for i in range(50):
+            if os.path.exists(output): break
+            sleep(0.1)
+        with open(output) as f:
+            assert f.read() == "app1\n"
+        self.engine.stop()
+
+        # Once the snapshot has the handler, the resource is restored again
+        startEngine()
+        sleep(0.5)
+        with open(output) as f:
+            assert f.read() == "app1\n"
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+from engine import Engine, Resource, EventCondition, ResourceCondition
+from engine.async import ResultObj
+from engine.handlers import FileHandler, SQSHandler
+from engine.fakeaws import FakeSQSConnection
+from engine import tracing
+import json
+import logging
+import os
+import shutil
+import stat
+import tempfile
+import threading
+
+__author__ = 'Denis Mikhalkin'
+
+import unittest
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        logging.basicConfig()
+        self.path = tempfile.mkdtemp()
+        self.tracesPath = os.path.join(self.path, "traces.json")
+        self.engine = Engine({"tracing": {"path": self.tracesPath}, "query": {"enabled": False}})
+
+    def tearDown(self):
+        self.engine.stop()
+        shutil.rmtree(self.path)
+
+    def testResultCallbacksRunInTheirSpan(self):
+        span = self.engine.tracer.startSpan("outer")
+        with tracing.activate(span):
+            result = ResultObj()
+        seen = list()
+        result.onComplete(lambda success: seen.append(tracing.current()))
+        threading.Thread(target=result.trigger, args=(True,)).start()
+        assert result.wait(5)
+        assert seen == [span]
+        assert tracing.current() is None
+
+    def testHandlerResultsKeepTheirSpan(self):
+        node = Resource("node", "node", self.engine.resourceManager.root)
+        self.engine.resourceManager.registerResource(node)
+        pending = ResultObj()
+        seen = list()
+        def handler(eventName, resource, payload):
+            result = ResultObj()
+            result.onComplete(lambda success: seen.append(tracing.current()))
+            pending.onComplete(result.trigger)
+            return result
+        self.engine.handlerManager.registerOn(handler, EventCondition("tick", "node"))
+        published = self.engine.eventBus.publish("tick", node)
+        threading.Thread(target=pending.trigger, args=(True,)).start()
+        assert published.wait(5)
+        assert [span.name for span in seen] == ["handler"]
+
+    def testActivationIsOneTrace(self):
+        output = os.path.join(self.path, "traceparent")
+        fullPath = os.path.join(self.path, "on.activate.app.sh")
+        with open(fullPath, "w") as f:
+            f.write("#!/bin/sh\necho $TRACEPARENT > %s\n" % output)
+        os.chmod(fullPath, stat.S_IRWXU)
+        self.engine.handlerManager.registerHandler(FileHandler(self.engine, fullPath))
+        server = Resource("server", "server", self.engine.resourceManager.root)
+        app = Resource("app", "app", server)
+        self.engine.resourceManager.addResource(server)
+        self.engine.resourceManager.addResource(app)
+        self.engine.start()
+        assert self.engine.resourceManager.waitForStates([server, app], "ACTIVATED", 5)
+
+        self.engine.tracer.export()
+        with open(self.tracesPath) as f:
+            spans = json.load(f)
+        start = [span for span in spans if span["name"] == "engine start"][0]
+        activations = [span for span in spans if span["name"] == "activate"]
+        assert sorted(span["tags"]["resource"] for span in activations) == ["app", "server"]
+        assert all(span["traceId"] == start["traceId"] for span in activations)
+        # The app is activated after its parent, as part of the parent's activation
+        byId = dict((span["id"], span) for span in spans)
+        appActivation = [span for span in activations if span["tags"]["resource"] == "app"][0]
+        ancestors = list()
+        parentId = appActivation.get("parentId")
+        while parentId is not None:
+            ancestors.append(byId[parentId]["name"])
+            parentId = byId[parentId].get("parentId")
+        assert ancestors[-1] == "engine start"
+        assert "activated" in ancestors
+
+        handlerSpan = [span for span in spans if span["name"] == "handler" and span["tags"]["handler"] == fullPath][0]
+        assert handlerSpan["parentId"] == appActivation["id"] and handlerSpan["tags"]["success"] == "true"
+        with open(output) as f:
+            assert f.read().strip() == "00-%s-%s-01" % (handlerSpan["traceId"], handlerSpan["id"])
+
+    def testScheduledJobsStartTraces(self):
+        ran = threading.Event()
+        node = Resource("node", "node", self.engine.resourceManager.root)
+        self.engine.resourceManager.registerResource(node)
+        self.engine.handlerManager.registerOn(lambda eventName, resource, payload: ran.set() or True, EventCondition("tick", "node"))
+        job = self.engine.scheduler.schedule("ticker", lambda: self.engine.eventBus.publish("tick", node), 0.05, jitter=0)
+        assert ran.wait(5)
+        self.engine.scheduler.unschedule(job)
+        spans = self.engine.tracer.spans()
+        tick = [span for span in spans if span.name == "tick"][0]
+        jobSpan = [span for span in spans if span.spanId == tick.parentId][0]
+        assert jobSpan.name == "job" and jobSpan.tags["job"] == "ticker" and jobSpan.parentId is None
+
+    def testSQSMessagesContinueTheSendersTrace(self):
+        self.engine.stop()
+        self.engine = Engine({"tracing": {"path": self.tracesPath}, "query": {"enabled": False},
+                              "sqs": {"consumer": True, "waitTimeSeconds": 1}})
+        conn = FakeSQSConnection()
+        queue = conn.create_queue("testqueue")
+        traceId = "4bf92f3577b34da6a3ce929d0e0e4736"
+        message = queue.new_message("traced")
+        message.message_attributes = {"traceparent": {"data_type": "String", "string_value": "00-%s-00f067aa0ba902b7-01" % traceId}}
+        queue.write(message)
+        queue.write(queue.new_message("untraced"))
+        self.engine.connections.setFactory("sqs", lambda region, **kwargs: conn)
+        self.engine.handlerManager.registerSubscribe(SQSHandler(self.engine), ResourceCondition(resourceType="sqs"))
+        received = list()
+        allReceived = threading.Event()
+        def onReceived(eventName, resource, payload):
+            received.append(payload)
+            if len(received) == 2:
+                allReceived.set()
+            return True
+        self.engine.resourceManager.addResource(Resource("testqueue", "sqs", self.engine.resourceManager.root,
+                                                         desc={"region": "local", "queueName": "testqueue"}))
+        # Subscribing starts the consumer, so the queue has to be there first
+        self.engine.handlerManager.registerOn(onReceived, EventCondition("received", "sqs"))
+        self.engine.start()
+        assert allReceived.wait(5)
+        spans = [span for span in self.engine.tracer.spans() if span.name == "received"]
+        assert len(spans) == 2
+        traced = [span for span in spans if span.traceId == traceId]
+        assert len(traced) == 1 and traced[0].parentId == "00f067aa0ba902b7"
+
+    def testDisabled(self):
+        engine = Engine({"query": {"enabled": False}})
+        try:
+            assert engine.tracer.startSpan("anything") is None
+            assert engine.eventBus.publish("tick", Resource("node", "node", None)).wait(1)
+        finally:
+            engine.stop()
+
+if __name__ == '__main__':
+    unittest.main()